@@ -1,15 +1,40 @@
+import errno
 import getpass
 import json
 import os
 import re
+import socket
+import threading
 import time
 import urllib
 import uuid
+from contextlib import contextmanager
 
 import requests
 from requests.auth import HTTPBasicAuth
 
-from pkg_util import prune
+from cache import SnapshotCache, ListingCache, FileInfoCache, CheckStateCache, DEFAULT_CACHE_SIZE, \
+    conditional_headers, fingerprint, file_key
+from deb_util import package_identity, ref_identity, file_checksums, stat_file
+from http_client import HttpClient, DeadlineExceeded, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_RETRIES
+from json_stream import iter_json_array
+from multipart import MultipartFileEncoder
+from parallel import map_ordered, start_threads, join_all, DEFAULT_WORKERS
+from pkg_util import prune, packages_not_in, package_set_fingerprint
+from plan import Plan, READ, WRITE, LOCAL
+from telemetry import UploadStats, UploadProgress
+
+# Size of the chunks read when streaming package listings
+STREAM_CHUNK_SIZE = 64 * 1024
+# Seconds between checks on a coalesced deploy, and after which a spool lock that hasn't been refreshed is
+# considered abandoned
+SPOOL_POLL_INTERVAL = 1.0
+SPOOL_LOCK_TIMEOUT = 600
+# Seconds between refreshes of a held spool lock
+SPOOL_LOCK_REFRESH_INTERVAL = SPOOL_LOCK_TIMEOUT / 4
+# File marking a deploy's spool directory as completely uploaded.  aptly only imports package files (.deb, .dsc
+# etc) from a directory, so the marker itself is never imported.
+SPOOL_READY = 'raptly-spool-ready'
 
 
 class RaptlyError(Exception):
@@ -42,6 +67,43 @@ def get_timestamp():
     return int(time.time())
 
 
+def listing_affected_by(base_url, url):
+    """Return the name of the listing (publish, repos or snapshots) changed by a mutating request on url,
+    or None if no listing is affected.
+    :param base_url: The base API url (e.g. https://repo.hogarthww.com/aptly/api)
+    :param url: The URL of the POST, PUT or DELETE request
+    """
+    path = url[len(base_url):].split('?')[0].strip('/').split('/')
+    if path[0] in ('publish', 'snapshots'):
+        return path[0]
+    if path[0] == 'repos':
+        if len(path) <= 2:
+            return 'repos'
+        if path[2] == 'snapshots':
+            return 'snapshots'
+    return None
+
+
+def error_message(error):
+    """Return the message of an exception as it would be reported to the user"""
+    if isinstance(error, AptlyApiError):
+        return error.msg
+    if isinstance(error, (RaptlyError, DeadlineExceeded)):
+        return error.value
+    return str(error) or type(error).__name__
+
+
+def import_warnings_for(file_name, warnings):
+    """Return those of aptly's import warnings that concern a package file - those naming the file, or its package
+    in aptly's name_version_arch form.
+    :param file_name: The base name of the package file (e.g. margherita_1.0.0_all.deb)
+    :param warnings: The 'Warnings' of aptly's import report
+    """
+    package_name = re.escape(re.sub(r'\.deb$', '', file_name))
+    pattern = re.compile(r'(^|[\s/\'"])%s(\.deb)?($|[\s:,\'"])' % package_name)
+    return [warning for warning in warnings if pattern.search(warning)]
+
+
 def local(public_repo_name):
     """Return local form of public repo name.
     Aptly REST API interprets '_' as '/' in repo names.
@@ -54,7 +116,11 @@ class AptlyApi:
     """Class that wraps calls to Aptly's REST API """
 
     def __init__(self, repo_url, verbose=False, skip_ssl=False, unstable_name='unstable', testing_name='testing',
-                 staging_name='staging', stable_name='stable', user=':', key=None, cert=None):
+                 staging_name='staging', stable_name='stable', user=':', key=None, cert=None,
+                 pool_size=DEFAULT_POOL_SIZE, keep_alive=True, session=None, cache_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE, workers=DEFAULT_WORKERS, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=None, deadline=None, retries=DEFAULT_RETRIES, hedge_percentile=None,
+                 upload_workers=DEFAULT_WORKERS, verify_hash=False):
         self.repo_url = repo_url
         self.aptly_api_base_url = repo_url
         self.version_url = '%s/version' % self.aptly_api_base_url
@@ -76,6 +142,50 @@ class AptlyApi:
         # Suppress SSL warnings for self-signed certificates
         requests.packages.urllib3.disable_warnings()
 
+        # Pooled keep-alive connections shared by every call made through this instance
+        self.http = HttpClient(auth=self.auth, cert=self.cert, verify=self.verify, pool_size=pool_size,
+                               keep_alive=keep_alive, session=session, base_url=self.aptly_api_base_url,
+                               connect_timeout=connect_timeout, read_timeout=read_timeout, deadline=deadline,
+                               retries=retries, hedge_percentile=hedge_percentile)
+
+        # Maximum number of API calls made concurrently
+        self.workers = workers
+        # Marks the threads making calls that already run alongside others on every worker - e.g. the repos of a
+        # train - so must not start workers of their own (see single_worker)
+        self.outer_worker = threading.local()
+        # Maximum number of package files uploaded concurrently
+        self.upload_workers = upload_workers
+        # Whether a package file is only skipped as already on the server if its SHA256 matches too
+        self.verify_hash = verify_hash
+        # Bytes and time of each upload, and time spent in each phase of deploy and check
+        self.upload_stats = UploadStats()
+
+        # Listings of publications, local repos and snapshots already fetched during this invocation
+        # Each listing is fetched under its own lock so that concurrent callers share a single fetch.  A listing
+        # invalidated while being fetched is returned to the caller but not memoized.
+        self.listings = {}
+        self.listing_locks = dict((name, threading.Lock()) for name in ('publish', 'repos', 'snapshots'))
+        self.listing_generations = dict((name, 0) for name in self.listing_locks)
+        self.listing_update_lock = threading.Lock()
+        # bytes_saved counts the listing bytes not decoded again because they were unchanged since the last run -
+        # whether the server said so (304) or they were fetched and found to match the cached fingerprint
+        self.listing_stats = {'fetched': 0, 'served': 0, 'revalidated': 0, 'bytes_saved': 0}
+        # While listings are shared (see shared_listings), the names of those changed since they were read
+        self.listings_shared = False
+        self.stale_listings = set()
+
+        # Optional local caches of (immutable) snapshot package lists, of listings from previous invocations and
+        # of the checksums and control fields of local package files
+        self.snapshot_cache = None
+        self.listing_cache = None
+        self.file_cache = None
+        self.check_states = None
+        if cache_dir:
+            self.snapshot_cache = SnapshotCache(cache_dir=cache_dir, max_size=cache_size)
+            self.listing_cache = ListingCache(cache_dir=cache_dir)
+            self.file_cache = FileInfoCache(cache_dir=cache_dir)
+            self.check_states = CheckStateCache(cache_dir=cache_dir)
+
         # Default distribution names
         self.unstable_name = unstable_name
         self.testing_name = testing_name
@@ -85,6 +195,31 @@ class AptlyApi:
         # The client local user name
         self.local_user = getpass.getuser()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close the pooled connections used by this instance and, if verbose, report connection usage."""
+        self.http.close()
+        if self.verbose:
+            stats = self.http.connection_stats()
+            print('Connections: %s opened, %s reused for %s requests'
+                  % (stats['opened'], stats['reused'], stats['requests']))
+            print('Listings: %s fetched, %s served from memory, %s unchanged since last run '
+                  '(%s bytes not decoded again)' % (self.listing_stats['fetched'], self.listing_stats['served'],
+                                                    self.listing_stats['revalidated'],
+                                                    self.listing_stats['bytes_saved']))
+            for endpoint, transfer in sorted(self.http.transfer_stats().items()):
+                print('Transfer %s: %s responses, %s bytes received, %s bytes decompressed'
+                      % (endpoint, transfer['responses'], transfer['received'], transfer['decoded']))
+            for endpoint, latency in sorted(self.http.latency_stats().items()):
+                print('Latency %s: %s requests, p50 %.3fs, p99 %.3fs, max %.3fs, %s retries, %s hedged (%s discarded)'
+                      % (endpoint, latency['requests'], latency['p50'] or 0, latency['p99'] or 0,
+                         latency['max'] or 0, latency['retries'], latency['hedged'], latency['discarded']))
+
     def delete_local_repo(self, base_url, local_repo_name):
         """Delete a local repo.
         :param base_url: The base API url (e.g. https://repo.hogarthww.com/aptly/api)
@@ -127,6 +262,27 @@ class AptlyApi:
             raise AptlyApiError(r.status_code, 'Aptly API Error - %s - HTTP Error: %s'
                                 % ('Failed to publish unstable snapshot', r.status_code))
 
+    def switch_published_snapshot(self, distribution, gpg_public_key_id, snapshot_name, public_repo_name):
+        """Switch a published distribution to another snapshot in place, so that it never disappears for apt clients.
+        :param distribution: The distribution name (e.g. unstable | testing | stable)
+        :param gpg_public_key_id: The GPG key the server will use to sign packages with
+        :param snapshot_name: The name of the snapshot to publish
+        :param public_repo_name: The public repo name (i.e. with slashes '/')
+        :return: False if the distribution isn't published, so there is nothing to switch
+        """
+        payload = {'Snapshots': [{'Component': 'main', 'Name': snapshot_name}],
+                   'Signing': {'GpgKey': gpg_public_key_id}}
+        headers = {'content-type': 'application/json'}
+        r = self.__do_put('%s/publish/%s/%s' % (self.aptly_api_base_url, local(public_repo_name), distribution),
+                          data=json.dumps(payload), headers=headers)
+        if r.status_code == requests.codes.not_found:
+            return False
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, 'Aptly API Error - %s - HTTP Error: %s'
+                                % ('Failed to switch %s to snapshot %s' % (distribution, snapshot_name),
+                                   r.status_code))
+        return True
+
     def drop_snapshot(self, snapshot_name):
         """Drop a snapshot.
          The equivalent cURL command: curl -v -X DELETE 'http://repo:8080/api/snapshots/snapshot-name?force=1'
@@ -137,28 +293,55 @@ class AptlyApi:
             print('Deleting snapshot: %s' % delete_snapshot_url)
 
         r = self.__do_delete(delete_snapshot_url)
+        self.__invalidate_snapshot(snapshot_name)
 
         if (r.status_code != requests.codes.ok) and (r.status_code != requests.codes.not_found):
             raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to delete snapshot: %s'
                                 % (r.status_code, delete_snapshot_url))
 
-    def filter_packages(self, package_query, snapshot_name):
+    def filter_packages(self, package_query, snapshot_name, stream=False):
+        """Return the packages in the snapshot matching the query.
+        :param package_query: Aptly package query
+        :param snapshot_name: The snapshot to filter
+        :param stream: If True, return a generator decoding package refs incrementally from the response
+        """
 
         urlencoded_query = urllib.urlencode({'q': package_query})
 
         filter_snapshot_url = '%s/snapshots/%s/packages?%s' % (self.aptly_api_base_url, snapshot_name, urlencoded_query)
 
-        r = self.__do_get(filter_snapshot_url)
+        r = self.__do_get(filter_snapshot_url, stream=stream)
         if self.verbose:
             print('Filtering snapshot of unstable: %s' % filter_snapshot_url)
 
         if r.status_code != requests.codes.ok:
+            r.close()
             raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to filter package: %s in snapshot: %s'
                                 % (r.status_code, package_query, snapshot_name))
 
+        if stream:
+            return self.__iter_json_array(r)
         new_packages = r.json()
         return new_packages
 
+    def filter_local_repo_packages(self, package_query, local_repo_name):
+        """Return the packages in the local repo matching the query - including any not yet published.
+        :param package_query: Aptly package query
+        :param local_repo_name: The local name of the repo (e.g. a4pizza_base)
+        """
+        urlencoded_query = urllib.urlencode({'q': package_query})
+
+        filter_repo_url = '%s/repos/%s/packages?%s' % (self.aptly_api_base_url, local_repo_name, urlencoded_query)
+
+        r = self.__do_get(filter_repo_url)
+        if self.verbose:
+            print('Filtering local repo: %s' % filter_repo_url)
+
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to filter package: %s in repo: %s'
+                                % (r.status_code, package_query, local_repo_name))
+        return r.json()
+
     def create_empty_snapshot_for_repo(self, public_repo_name):
         """Create an empty snapshot with the name <local_repo_name>.<create>.<8 char uuid>.<timestamp>.<local_user>
         :param public_repo_name: The public repo name
@@ -168,6 +351,7 @@ class AptlyApi:
         payload = {'Name': snapshot_name}
         headers = {'content-type': 'application/json'}
         r = self.__do_post('%s/snapshots' % self.aptly_api_base_url, data=json.dumps(payload), headers=headers)
+        self.__invalidate_snapshot(snapshot_name)
         if self.verbose:
             print('Creating snapshot %s for repo %s' % (snapshot_name, public_repo_name))
 
@@ -188,6 +372,7 @@ class AptlyApi:
                    'PackageRefs': package_refs}
         headers = {'content-type': 'application/json'}
         r = self.__do_post('%s/snapshots' % self.aptly_api_base_url, data=json.dumps(payload), headers=headers)
+        self.__invalidate_snapshot(target_snapshot_name)
         if self.verbose:
             print('Creating snapshot %s' % target_snapshot_name)
 
@@ -201,13 +386,27 @@ class AptlyApi:
         :param headers:
         :param url: The URL to make the DELETE request on.
         """
-        return requests.delete(url, cert=self.cert, auth=self.auth, verify=self.verify, data=data, headers=headers)
+        r = self.http.delete(url, data=data, headers=headers)
+        self.__invalidate_listing(url)
+        return r
 
-    def __do_get(self, url):
+    def __do_get(self, url, headers=None, stream=False):
         """Execute GET request on specified URL.
         :param url: The URL to make the GET request on.
+        :param headers: Request headers.
+        :param stream: If True, don't read the response body until it is consumed.
         """
-        return requests.get(url, cert=self.cert, auth=self.auth, verify=self.verify)
+        return self.http.get(url, headers=headers, stream=stream)
+
+    def __iter_json_array(self, r):
+        """Generator decoding the elements of the JSON array in a streamed response, closing it when done.
+        :param r: Response returned by a GET with stream=True
+        """
+        try:
+            for element in iter_json_array(self.http.iter_content(r, STREAM_CHUNK_SIZE)):
+                yield element
+        finally:
+            r.close()
 
     def __do_post(self, url, files=None, data=None, headers=None):
         """Execute POST request on specified URL.
@@ -216,8 +415,9 @@ class AptlyApi:
         :param data: Post data.
         :param headers: Request headers.
         """
-        return requests.post(url, cert=self.cert, auth=self.auth, verify=self.verify, data=data, headers=headers,
-                             files=files)
+        r = self.http.post(url, data=data, headers=headers, files=files)
+        self.__invalidate_listing(url)
+        return r
 
     def __do_put(self, url, data, headers):
         """Execute PUT request on specified URL.
@@ -225,7 +425,105 @@ class AptlyApi:
         :param data: Data payload of the PUT request.
         :param headers: Headers for the HTTP request.
         """
-        return requests.put(url, data=data, headers=headers, cert=self.cert, auth=self.auth, verify=self.verify)
+        r = self.http.put(url, data=data, headers=headers)
+        self.__invalidate_listing(url)
+        return r
+
+    def __get_listing(self, name, url):
+        """Return the JSON listing at url, fetching it at most once per invocation (until invalidated).
+        :param name: The listing name (publish, repos or snapshots)
+        :param url: The URL of the listing
+        """
+        with self.listing_locks[name]:
+            if name in self.listings:
+                self.__count_listing('served')
+                return self.listings[name]
+            generation = self.listing_generations[name]
+            listing = self.__fetch_listing(url)
+            with self.listing_update_lock:
+                if self.listing_generations[name] == generation:
+                    self.listings[name] = listing
+            return listing
+
+    def __fetch_listing(self, url):
+        """Fetch a listing, revalidating any copy cached by a previous invocation.
+        :param url: The URL of the listing
+        """
+        cached = self.listing_cache.get(url) if self.listing_cache is not None else None
+        r = self.__do_get(url, headers=conditional_headers(cached))
+        self.__count_listing('fetched')
+        if cached is not None and r.status_code == requests.codes.not_modified:
+            self.__count_listing('revalidated')
+            self.__count_listing('bytes_saved', cached['size'])
+            listing = cached['listing']
+        elif r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code,
+                                'Aptly API Error - %s - HTTP Error: %s' % (url, r.status_code))
+        else:
+            content_fingerprint = fingerprint(r.content)
+            etag = r.headers.get('ETag')
+            last_modified = r.headers.get('Last-Modified')
+            if cached is not None and cached['fingerprint'] == content_fingerprint:
+                # Unchanged - no need to decode it again
+                self.__count_listing('revalidated')
+                self.__count_listing('bytes_saved', len(r.content))
+                listing = cached['listing']
+            else:
+                listing = r.json()
+            if self.listing_cache is not None and (cached is None or cached['fingerprint'] != content_fingerprint
+                                                   or cached['etag'] != etag
+                                                   or cached['last_modified'] != last_modified):
+                self.listing_cache.put(url, listing, content_fingerprint, len(r.content), etag, last_modified)
+        return listing
+
+    def __count_listing(self, stat, value=1):
+        with self.listing_update_lock:
+            self.listing_stats[stat] += value
+
+    def __invalidate_listing(self, url):
+        """Forget the listing, if any, that a mutating request on url will change.
+        :param url: The URL of the POST, PUT or DELETE request
+        """
+        name = listing_affected_by(self.aptly_api_base_url, url)
+        if name is not None:
+            with self.listing_update_lock:
+                if self.listings_shared:
+                    self.stale_listings.add(name)
+                    return
+                self.listing_generations[name] += 1
+                self.listings.pop(name, None)
+
+    @contextmanager
+    def shared_listings(self):
+        """Context manager within which each listing is read at most once, however many changes are made.
+        This is only safe when every repo is changed by a single sequence of steps - e.g. a release train, in which
+        the step promoting one repo never needs to see the changes made to another.  Listings changed within the
+        block are invalidated at its end.
+        """
+        with self.listing_update_lock:
+            self.listings_shared = True
+        try:
+            yield
+        finally:
+            with self.listing_update_lock:
+                self.listings_shared = False
+                for name in self.stale_listings:
+                    self.listing_generations[name] += 1
+                    self.listings.pop(name, None)
+                self.stale_listings = set()
+
+    @contextmanager
+    def single_worker(self):
+        """Context manager within which the current thread runs plans and concurrent reads one call at a time.
+        For operations that are themselves run concurrently - e.g. the repos of a train - so that no more than the
+        configured number of calls are in flight, and the connection pool is never exhausted.
+        """
+        outer = getattr(self.outer_worker, 'active', False)
+        self.outer_worker.active = True
+        try:
+            yield
+        finally:
+            self.outer_worker.active = outer
 
     def pkg_list(self, public_repo_name, distribution):
         """Return the list of packages in the specified repo and distribution."""
@@ -255,22 +553,39 @@ class AptlyApi:
         return self.filter_packages(package_query, snapshot_name)
 
     def find_packages(self, publication):
-        """Return the list of packages for the specified publication."""
+        """Return the list of packages for the specified publication.
+        The packages of each source are fetched concurrently but listed in the order of the sources.
+        """
         sources = publication['Sources']
-        packages = []
         if publication['SourceKind'] == 'snapshot':
-            for source in sources:
-                source_name = source['Name']
-                packages += self.get_packages_from_snapshot(source_name)
+            get_packages = self.get_packages_from_snapshot
         elif publication['SourceKind'] == 'local':
-            for source in sources:
-                source_name = source['Name']
-                packages += self.get_packages_from_local_repo(source_name)
+            get_packages = self.get_packages_from_local_repo
         else:
-            pass
+            return []
 
+        packages = []
+        for source_packages in map_ordered(lambda source: get_packages(source['Name']), sources,
+                                           self.__nested_workers()):
+            packages += source_packages
         return packages
 
+    def iter_packages(self, publication):
+        """Generate the packages of the specified publication, decoding them incrementally source by source so
+        that the listings are never held in memory as raw JSON.  The requests for the sources are made
+        concurrently, as by find_packages, and their responses read in the order of the sources."""
+        if publication['SourceKind'] == 'snapshot':
+            get_packages = self.get_packages_from_snapshot
+        elif publication['SourceKind'] == 'local':
+            get_packages = self.get_packages_from_local_repo
+        else:
+            return
+
+        for source_packages in map_ordered(lambda source: get_packages(source['Name'], stream=True),
+                                           publication['Sources'], self.__nested_workers()):
+            for package_ref in source_packages:
+                yield package_ref
+
     def get_local_repo(self, public_repo_name):
         """Get the specified repo
         :param public_repo_name: Public name of the repo
@@ -297,24 +612,16 @@ class AptlyApi:
     def find_local_repos(self):
         """Find all local repos, sorted in order of creation"""
 
-        # Get all snapshots on the system
+        # Get all local repos on the system
         repos_rest_url = '%s/repos' % self.aptly_api_base_url
-        r = self.__do_get(repos_rest_url)
-        if r.status_code != requests.codes.ok:
-            raise AptlyApiError(r.status_code,
-                                'Aptly API Error - %s - HTTP Error: %s' % (repos_rest_url, r.status_code))
-        return r.json()
+        return self.__get_listing('repos', repos_rest_url)
 
     def find_snapshots(self):
         """Find all snapshots, sorted in order of creation"""
 
         # Get all snapshots on the system
         snapshots_rest_url = '%s/snapshots?sort=time' % self.aptly_api_base_url
-        r = self.__do_get(snapshots_rest_url)
-        if r.status_code != requests.codes.ok:
-            raise AptlyApiError(r.status_code,
-                                'Aptly API Error - %s - HTTP Error: %s' % (snapshots_rest_url, r.status_code))
-        return r.json()
+        return self.__get_listing('snapshots', snapshots_rest_url)
 
     def find_release_candidate_snapshots(self, local_repo_name, release_id):
         """Find snapshot release candidates matching either of the following two forms:
@@ -334,7 +641,15 @@ class AptlyApi:
         :param public_repo_name: The published repo name
         """
         publication = self.find_publication(distribution, public_repo_name)
+        return self.get_snapshot_of_publication(publication, distribution, public_repo_name)
 
+    def get_snapshot_of_publication(self, publication, distribution, public_repo_name):
+        """Get the single snapshot published by the publication found for the distribution and public repo name.
+        Throw RaptlyError if there is *not* a single snapshot source for the published repo and distribution.
+        :param publication: The publication or None if there is none
+        :param distribution: The distribution
+        :param public_repo_name: The published repo name
+        """
         if publication is None:
             raise RaptlyError("There is no '%s' distribution for repo '%s'" % (distribution, public_repo_name))
 
@@ -374,27 +689,66 @@ class AptlyApi:
 
         # Get all publications - i.e. published repos/snapshots
         publications_rest_url = '%s/publish' % self.aptly_api_base_url
-        r = self.__do_get(publications_rest_url)
-        if r.status_code != requests.codes.ok:
-            raise AptlyApiError(r.status_code,
-                                'Aptly API Error - %s - HTTP Error: %s' % (publications_rest_url, r.status_code))
-        return r.json()
+        return self.__get_listing('publish', publications_rest_url)
 
-    def get_packages_from_local_repo(self, local_repo_name):
+    def get_packages_from_local_repo(self, local_repo_name, stream=False):
+        """Return the package refs in the local repo.
+        :param local_repo_name: The local name of the repo (e.g. a4pizza_base)
+        :param stream: If True, return a generator decoding package refs incrementally from the response
+        """
         packages_rest_url = '%s/repos/%s/packages' % (self.aptly_api_base_url, local_repo_name)
-        r = self.__do_get(packages_rest_url)
+        r = self.__do_get(packages_rest_url, stream=stream)
         if r.status_code != requests.codes.ok:
+            r.close()
             raise AptlyApiError(r.status_code,
                                 'Aptly API Error - %s - HTTP Error: %s' % (packages_rest_url, r.status_code))
+        if stream:
+            return self.__iter_json_array(r)
         return r.json()
 
-    def get_packages_from_snapshot(self, snapshot_name):
+    def get_packages_from_snapshot(self, snapshot_name, stream=False):
+        """Return the package refs in the snapshot.
+        :param snapshot_name: The snapshot name
+        :param stream: If True, return a generator decoding package refs incrementally from the response.
+        A streamed package list is added to the snapshot cache once it has been completely read.
+        """
+        if self.snapshot_cache is not None:
+            package_refs = self.snapshot_cache.get(self.aptly_api_base_url, snapshot_name)
+            if package_refs is not None:
+                if self.verbose:
+                    print('Using cached packages of snapshot: %s' % snapshot_name)
+                return iter(package_refs) if stream else package_refs
+
         packages_rest_url = '%s/snapshots/%s/packages' % (self.aptly_api_base_url, snapshot_name)
-        r = self.__do_get(packages_rest_url)
+        r = self.__do_get(packages_rest_url, stream=stream)
         if r.status_code != requests.codes.ok:
+            r.close()
             raise AptlyApiError(r.status_code,
                                 'Aptly API Error - %s - HTTP Error: %s' % (packages_rest_url, r.status_code))
-        return r.json()
+        if stream:
+            if self.snapshot_cache is None:
+                return self.__iter_json_array(r)
+            return self.__cache_when_read(snapshot_name, self.__iter_json_array(r))
+        package_refs = r.json()
+        if self.snapshot_cache is not None:
+            self.snapshot_cache.put(self.aptly_api_base_url, snapshot_name, package_refs)
+        return package_refs
+
+    def __cache_when_read(self, snapshot_name, package_refs):
+        """Generate the streamed package refs of a snapshot, adding them to the snapshot cache once all have been
+        read."""
+        read = []
+        for package_ref in package_refs:
+            read.append(package_ref)
+            yield package_ref
+        self.snapshot_cache.put(self.aptly_api_base_url, snapshot_name, read)
+
+    def __invalidate_snapshot(self, snapshot_name):
+        """Forget any cached package list of the named snapshot - e.g. because it has been dropped or re-created
+        :param snapshot_name: The snapshot name
+        """
+        if self.snapshot_cache is not None:
+            self.snapshot_cache.invalidate(self.aptly_api_base_url, snapshot_name)
 
     def list_distributions(self, public_repo_name):
         """Return the list of published distributions for the specified repo."""
@@ -416,15 +770,9 @@ class AptlyApi:
         if self.verbose:
             print('Listing repos at: %s' % self.publish_url)
 
-        r = self.__do_get(self.publish_url)
-
         # Create a distinct list of publications
-        if r.status_code == requests.codes.ok:
-            publications = r.json()
-            return sorted(set([x['Prefix'] for x in publications]))
-        else:
-            raise AptlyApiError(r.status_code,
-                                'Aptly API Error - %s - HTTP Error: %s' % (self.publish_url, r.status_code))
+        publications = self.get_publications()
+        return sorted(set([x['Prefix'] for x in publications]))
 
     def version(self):
         """Report the Aptly API version. """
@@ -440,27 +788,35 @@ class AptlyApi:
             raise AptlyApiError(r.status_code,
                                 'Aptly API Error - %s - HTTP Error: %s' % (self.version_url, r.status_code))
 
-    def undeploy(self, public_repo_name, package_query, unstable_dist_name, dry_run):
+    def undeploy(self, public_repo_name, package_query, unstable_dist_name, dry_run, publish=True):
         """Un-deploy a package from the unstable distribution.
         :param public_repo_name: The name of the repository to un-deploy from
         :param package_query: Aptly query defining the package(s) to un-deploy
         :param unstable_dist_name: The name of the `unstable` distribution
         :param dry_run: If True, just report on what would have happened
+        :param publish: If False, only remove the packages from the repo, leaving republish_unstable to be called
+        once after a batch of changes.  The packages are then found by querying the local repo, which also holds
+        packages deployed but not yet published.
         """
-        package_refs = self.query_packages(public_repo_name=public_repo_name, distribution_name=unstable_dist_name,
-                                           package_query=package_query)
+        if publish:
+            package_refs = self.query_packages(public_repo_name=public_repo_name,
+                                               distribution_name=unstable_dist_name, package_query=package_query)
+        else:
+            package_refs = self.filter_local_repo_packages(package_query, local(public_repo_name))
 
-        if dry_run is False:
+        if dry_run is False and package_refs:
             retval = self.delete_packages(public_repo_name=public_repo_name, package_refs=package_refs)
-            self.republish_unstable(unstable_dist_name=unstable_dist_name, gpg_public_key_id=None,
-                                    public_repo_name=public_repo_name, reason='undeploy')
+            if publish:
+                self.republish_unstable(unstable_dist_name=unstable_dist_name, gpg_public_key_id=None,
+                                        public_repo_name=public_repo_name, reason='undeploy')
 
         return package_refs
 
-    def upload(self, package_filenames, upload_dir):
+    def upload(self, package_filenames, upload_dir, progress=None):
         """Upload a Debian package to the aptly server's pool.
         :param package_filenames: List of Debian package local file names
         :param upload_dir: The sub-directory on the server to upload to
+        :param progress: Optional UploadProgress to update as the files are sent
         """
 
         upload_file_url = '%s/files/%s' % (self.aptly_api_base_url, upload_dir)
@@ -468,12 +824,14 @@ class AptlyApi:
         if self.verbose:
             print('Uploading file to Aptly pool at: %s' % upload_file_url)
 
-        # Create list of file tuples for posting
-        files = []
-        for package_filename in package_filenames:
-            files.append(('file', open(package_filename, 'rb')))
-
-        r = self.__do_post(upload_file_url, files=files)
+        # Stream the files one at a time rather than building the whole request body in memory
+        body = MultipartFileEncoder(package_filenames, progress=progress.update if progress else None)
+        start = time.time()
+        try:
+            r = self.__do_post(upload_file_url, data=body, headers={'Content-Type': body.content_type})
+        finally:
+            body.close()
+        self.upload_stats.add_upload(package_filenames, len(body), time.time() - start)
 
         if r.status_code != requests.codes.ok:
             raise AptlyApiError(r.status_code,
@@ -500,6 +858,8 @@ class AptlyApi:
                                              distribution=dist_name)
         # Delete the local check repo
         self.delete_local_repo(self.aptly_api_base_url, local(check_public_repo_name))
+        if self.check_states is not None:
+            self.check_states.invalidate(self.aptly_api_base_url, check_public_repo_name)
 
     def check(self, public_repo_name, package_files, upload_dir, no_prune=False):
         """ Check package files with reference to the stable distribution
@@ -508,114 +868,632 @@ class AptlyApi:
         :param upload_dir: The sub-directory on the server to upload to
         :param no_prune: If True, the resulting check repo won't prune out old package versions
         """
+        return self.__run_plan(self.check_plan(public_repo_name, package_files, upload_dir, no_prune))['publish']
+
+    def check_plan(self, public_repo_name, package_files, upload_dir, no_prune=False):
+        """Return the plan run by check - see check for the parameters."""
         # Get the snapshot source of the stable distribution
         stable_distribution_name = 'stable'
-        stable_snapshot_name = self.get_snapshot_for_publication(distribution=stable_distribution_name,
-                                                                 public_repo_name=public_repo_name)
-        stable_package_refs = self.get_packages_from_snapshot(stable_snapshot_name)
-
-        # Create the new private check repo, if it doesn't already exist
         check_repo_public_name = self.get_check_repo_public_name(public_repo_name)
-        local_repo = self.find_local_repo(check_repo_public_name)
-        if local_repo is None:
-            self.create(check_repo_public_name, 'check')
-
-        source_snapshots = [stable_snapshot_name]
-        check_package_refs = []
-        # If the package file list contains anything
-        if package_files:
-            # Upload the package files to the private check repo
-            self.upload_packages(package_files, check_repo_public_name, upload_dir)
+        temp_new_pkgs_snapshot_name = '%s-snap-temp-new-pkgs' % local(check_repo_public_name)
+
+        def create_check_repo(results):
+            # Create the new private check repo, if it doesn't already exist
+            local_repo = self.find_local_repo(check_repo_public_name)
+            if local_repo is None:
+                self.create(check_repo_public_name, 'check')
+
+        def get_check_repo_packages(results):
+            if not package_files:
+                return []
+            return self.get_packages_from_local_repo(local(check_repo_public_name))
+
+        def get_published_snapshot(results):
+            publication = self.find_publication('check', check_repo_public_name)
+            return publication['Sources'][0]['Name'] if publication and publication['Sources'] else None
+
+        def get_state(results):
+            if self.check_states is None:
+                return None
+            return self.check_states.get(self.aptly_api_base_url, check_repo_public_name)
+
+        def upload(results):
+            # Upload to the private check repo the package files not already in the check repo or stable, or that
+            # differ from the server's copy of their package - e.g. rebuilt without a new version
+            if not package_files:
+                return {'uploaded': [], 'files': {}}
+            known_refs = dict((ref_identity(ref), ref) for ref in results['stable'] + results['check_repo'])
+            check_identities = set(ref_identity(ref) for ref in results['check_repo'])
+
+            # A file unchanged, by size, mtime and inode, since the last check found it the same as the server's copy
+            # of the same package is neither hashed nor compared again
+            last_files = (results['state'] or {}).get('files', {})
+            files = {}
+            unverified = []
+            for package_file in package_files:
+                key = file_key(stat_file(package_file))
+                try:
+                    identity = package_identity(package_file, self.file_cache)
+                except ValueError:
+                    identity = None
+                last = last_files.get(identity)
+                if last and last['key'] == key and last['ref'] == known_refs.get(identity):
+                    files[identity] = last
+                else:
+                    unverified.append((package_file, identity, key))
+
+            new_files = self.packages_to_upload([package_file for package_file, _, _ in unverified],
+                                                known_refs.values(), verify_hash=True)
+            for package_file, identity, key in unverified:
+                if identity in known_refs and package_file not in new_files:
+                    files[identity] = {'key': key, 'ref': known_refs[identity]}
+            # Files differing from the check repo's copy of their package replace it
+            replace = any(package_file in new_files and identity in check_identities
+                          for package_file, identity, _ in unverified)
+            self.upload_packages(new_files, check_repo_public_name, upload_dir, force_replace=replace)
+            return {'uploaded': new_files, 'files': files}
+
+        def is_unchanged(results):
+            # Nothing to do if nothing was uploaded and the check is of the same packages as the last one published
+            state = results['state']
+            if state is None or results['upload']['uploaded'] or results['published'] is None:
+                return False
+            packages = package_set_fingerprint(results['check_repo']) if package_files else None
+            return (state['snapshot'] == results['published'] and state['stable'] == results['stable_snapshot']
+                    and state['packages'] == packages and state['no_prune'] == no_prune)
+
+        def create_temp_snapshot(results):
             # Create a new, temporary snapshot of the check repo
-            temp_new_pkgs_snapshot_name = '%s-snap-temp-new-pkgs' % local(check_repo_public_name)
+            if not package_files or results['unchanged']:
+                return []
             self.drop_snapshot(temp_new_pkgs_snapshot_name)
             self.create_local_repo_snapshot(temp_new_pkgs_snapshot_name, check_repo_public_name)
-            check_package_refs += self.get_packages_from_snapshot(temp_new_pkgs_snapshot_name)
-            source_snapshots.append(temp_new_pkgs_snapshot_name)
-
-        # Create union snapshot of stable + check
-        union = stable_package_refs + check_package_refs
-        # Prune unless told not to
-        if not no_prune:
-            union = prune(union)
-
-        # Create a new snapshot of the union package list
-        target_check_snapshot_name = '%s.%s' % (local(check_repo_public_name), get_timestamp())
-        self.create_snapshot_from_package_refs(union, source_snapshots, target_check_snapshot_name)
-
-        # Publish the union snapshot as the check distribution
-        self.publish('check', check_repo_public_name, target_check_snapshot_name)
-
-        return check_repo_public_name
+            return self.get_packages_from_snapshot(temp_new_pkgs_snapshot_name)
+
+        def remember(check_snapshot_name, packages, results):
+            # Remember what was published, for the next check
+            if self.check_states is not None:
+                files = dict((results['state'] or {}).get('files', {}))
+                files.update(results['upload']['files'])
+                self.check_states.put(self.aptly_api_base_url, check_repo_public_name,
+                                      {'stable': results['stable_snapshot'],
+                                       'packages': packages, 'no_prune': no_prune, 'snapshot': check_snapshot_name,
+                                       'files': files})
+
+        def publish(results):
+            if results['unchanged']:
+                if self.verbose:
+                    print('Nothing changed since the last check of %s - not re-publishing' % public_repo_name)
+                # The files found unchanged this time needn't be compared next time either
+                remember(results['published'], results['state']['packages'], results)
+                return check_repo_public_name
+
+            source_snapshots = [results['stable_snapshot']]
+            # If the package file list contains anything
+            if package_files:
+                source_snapshots.append(temp_new_pkgs_snapshot_name)
+
+            # Create union snapshot of stable + check
+            union = results['stable'] + results['temp']
+            # Prune unless told not to
+            if not no_prune:
+                union = prune(union)
+
+            with self.upload_stats.phase('publish'):
+                # Create a new snapshot of the union package list
+                target_check_snapshot_name = '%s.%s' % (local(check_repo_public_name), get_timestamp())
+                self.create_snapshot_from_package_refs(union, source_snapshots, target_check_snapshot_name)
+
+                # Publish the union snapshot as the check distribution
+                self.publish('check', check_repo_public_name, target_check_snapshot_name)
+
+            remember(target_check_snapshot_name, package_set_fingerprint(results['temp']) if package_files else None,
+                     results)
+            return check_repo_public_name
+
+        plan = Plan('check %s' % public_repo_name)
+        plan.add('stable_snapshot', READ, 'Find the snapshot published as %s' % stable_distribution_name,
+                 lambda results: self.get_snapshot_for_publication(distribution=stable_distribution_name,
+                                                                   public_repo_name=public_repo_name))
+        plan.add('stable', READ, 'Get the packages published as %s' % stable_distribution_name,
+                 lambda results: self.get_packages_from_snapshot(results['stable_snapshot']),
+                 requires=['stable_snapshot'])
+        plan.add('state', LOCAL, 'Read what the last check published', get_state)
+        plan.add('create', WRITE, 'Create the check repo %s if needed' % check_repo_public_name, create_check_repo,
+                 requires=['stable_snapshot'])
+        plan.add('check_repo', READ, 'Get the packages in the check repo', get_check_repo_packages,
+                 requires=['create'])
+        plan.add('published', READ, 'Find the snapshot published as check', get_published_snapshot,
+                 requires=['create'])
+        plan.add('upload', WRITE, 'Upload and add the package files new or changed since %s or the last check'
+                 % stable_distribution_name, upload, requires=['stable', 'check_repo', 'state'])
+        plan.add('unchanged', LOCAL, 'Check whether anything changed since the last check', is_unchanged,
+                 requires=['upload', 'published'])
+        plan.add('temp', WRITE, 'Snapshot the check repo as %s' % temp_new_pkgs_snapshot_name, create_temp_snapshot,
+                 requires=['unchanged'])
+        plan.add('publish', WRITE, 'Combine the check repo with %s and publish it as check' % stable_distribution_name,
+                 publish, requires=['temp'])
+        return plan
 
     def get_check_repo_public_name(self, public_repo_name):
         return '%s.@%s@' % (public_repo_name, self.local_user)
 
-    def deploy(self, public_repo_name, package_files, gpg_public_key_id, upload_dir, unstable_dist_name='unstable'):
+    def deploy(self, public_repo_name, package_files, gpg_public_key_id, upload_dir, unstable_dist_name='unstable',
+               publish=True):
         """Deploy a Debian package to the specified distribution.
         :param public_repo_name: The name of the repository to deploy to
         :param package_files: List of Debian package local file names
         :param gpg_public_key_id: The fingerprint of the GPG key used by the server to sign packages
         :param unstable_dist_name: The name of the `unstable` distribution
         :param upload_dir: The sub-directory on the server to upload to
+        :param publish: If False, only add the packages to the repo, leaving republish_unstable to be called once
+        after a batch of deploys.  If True and there are no package files, re-publish even if the repo is unchanged -
+        e.g. to re-sign with another key
         """
-
-        # Upload the package files
-        self.upload_packages(package_files, public_repo_name, upload_dir)
-
-        # Snapshot the repo unstable distribution and re-publish
+        self.__run_plan(self.deploy_plan(public_repo_name, package_files, gpg_public_key_id, upload_dir,
+                                         unstable_dist_name, publish))
+
+    def deploy_plan(self, public_repo_name, package_files, gpg_public_key_id, upload_dir, unstable_dist_name='unstable',
+                    publish=True):
+        """Return the plan run by deploy - see deploy for the parameters."""
+
+        def upload(results):
+            self.upload_packages(results['select'], public_repo_name, upload_dir)
+
+        def republish(results):
+            # Snapshot the repo unstable distribution and re-publish.  If nothing was uploaded the repo is still as
+            # listed by the 'repo' step.
+            repo_packages = None if results['select'] else results['repo']
+            with self.upload_stats.phase('publish'):
+                self.republish_unstable(unstable_dist_name=unstable_dist_name, gpg_public_key_id=gpg_public_key_id,
+                                        public_repo_name=public_repo_name, reason='deploy',
+                                        repo_packages=repo_packages)
+
+        plan = Plan('deploy %s' % public_repo_name)
+        if not package_files:
+            if publish:
+                plan.add('publish', WRITE, 'Snapshot the repo and publish it as %s, even if unchanged'
+                         % unstable_dist_name,
+                         lambda results: self.republish_unstable(unstable_dist_name=unstable_dist_name,
+                                                                 gpg_public_key_id=gpg_public_key_id,
+                                                                 public_repo_name=public_repo_name, reason='deploy',
+                                                                 force=True))
+            return plan
+        plan.add('repo', READ, 'Get the packages in the repo',
+                 lambda results: self.get_packages_from_local_repo(local(public_repo_name)))
+        # The server's size or checksum of each package already in the repo is read
+        plan.add('select', READ, 'Choose the package files not already in the repo',
+                 lambda results: self.packages_to_upload(package_files, results['repo']), requires=['repo'])
+        plan.add('upload', WRITE, 'Upload and add the package files to the repo', upload, requires=['select'])
+        if publish:
+            plan.add('publish', WRITE, 'Snapshot the repo and publish it as %s' % unstable_dist_name, republish,
+                     requires=['upload'])
+        return plan
+
+    def deploy_coalesced(self, public_repo_name, package_files, gpg_public_key_id, unstable_dist_name='unstable'):
+        """Deploy packages through a per-repo spool shared by concurrent deploys, so that deploys arriving together
+        share one snapshot and publish rather than queueing behind each other.
+
+        Each deploy uploads its package files to its own server directory <local_repo_name>.spool.<id>, then adds
+        a marker file to say the upload is complete.  Whichever deploy then holds the repo's spool lock - a
+        snapshot named <local_repo_name>.spool-lock, which the server lets only one client create - imports every
+        marked directory, removes the markers and re-publishes unstable once.  Directories still being uploaded
+        are left for the next batch.  Every other deploy waits until its marker has gone and the lock is free, then
+        re-publishes unstable itself if it doesn't hold the repo's packages - e.g. because the holder failed to
+        publish the batch it had imported.  Files that failed to import are left in their deploy's directory, for
+        that deploy to report.
+
+        The holder refreshes the lock's description while it holds it, and a lock whose description is unchanged
+        for SPOOL_LOCK_TIMEOUT seconds is broken as abandoned - so no clocks of different hosts are compared.
+        :param public_repo_name: The name of the repository to deploy to
+        :param package_files: List of Debian package local file names
+        :param gpg_public_key_id: The fingerprint of the GPG key used by the server to sign packages
+        :param unstable_dist_name: The name of the `unstable` distribution
+        :raises RaptlyError: If any file failed to upload or to be imported
+        """
+        for package_file in package_files:
+            if not os.path.isfile(package_file):
+                raise IOError(errno.ENOENT, 'No such file or directory', package_file)
+        package_files = self.packages_to_upload(package_files,
+                                                self.get_packages_from_local_repo(local(public_repo_name)))
+        spool_dir = '%s.spool.%s' % (local(public_repo_name), str(uuid.uuid4())[:8])
+        lock_name = '%s.spool-lock' % local(public_repo_name)
+
+        results = self.__upload_files(package_files, spool_dir)
+        try:
+            self.__report_results(results, public_repo_name)
+            self.__mark_spool_ready(spool_dir)
+            with self.upload_stats.phase('publish'):
+                self.__await_spool(spool_dir, lock_name, public_repo_name, gpg_public_key_id, unstable_dist_name)
+            # Files that failed to import are left in our directory
+            failed = set(self.list_upload_dir(spool_dir)) - set([SPOOL_READY])
+        finally:
+            self.delete_upload_dir(spool_dir)
+        missing = [result['file'] for result in results if os.path.basename(result['path']) in failed]
+        if missing:
+            raise RaptlyError('Package files not added to repo %s:\n%s'
+                              % (public_repo_name, '\n'.join('  %s' % package_file for package_file in missing)))
+
+    def __await_spool(self, spool_dir, lock_name, public_repo_name, gpg_public_key_id, unstable_dist_name):
+        """Wait until a batch has imported our spool directory and unstable has been re-published - publishing the
+        batch if this deploy gets the spool lock first."""
+        # Set once a batch has taken our directory from the spool
+        in_batch = False
+        # Set if an abandoned lock was broken, since its batch may have been imported but not published
+        force = False
+        # The description of the lock last seen, and when it was first seen by this deploy
+        lock_seen = (None, None)
+        while True:
+            lock = self.get_snapshot(lock_name)
+            if lock is not None:
+                if lock.get('Description') != lock_seen[0]:
+                    lock_seen = (lock.get('Description'), time.time())
+                elif time.time() - lock_seen[1] > SPOOL_LOCK_TIMEOUT:
+                    if self.verbose:
+                        print('Breaking abandoned spool lock: %s' % lock.get('Description'))
+                    self.drop_snapshot(lock_name)
+                    lock = None
+                    force = True
+            if lock is None:
+                if in_batch:
+                    break
+                token = self.__acquire_spool_lock(lock_name)
+                if token is not None and self.__publish_spool(lock_name, token, public_repo_name, gpg_public_key_id,
+                                                              unstable_dist_name, force):
+                    return
+                if token is not None:
+                    # Our directory was already taken by a batch that has since been published
+                    break
+            elif not in_batch:
+                in_batch = SPOOL_READY not in self.list_upload_dir(spool_dir)
+            self.__wait(SPOOL_POLL_INTERVAL)
+
+        # The lock is released even if its holder failed to publish, so make sure our batch was published
         self.republish_unstable(unstable_dist_name=unstable_dist_name, gpg_public_key_id=gpg_public_key_id,
                                 public_repo_name=public_repo_name, reason='deploy')
 
-    def upload_packages(self, package_files, public_repo_name, upload_dir):
-        paths = self.upload(package_files, upload_dir)
-        # Deploy uploaded files to the repo
-        for path in paths:
-            add_package_to_repo_url = '%s/%s/%s/file/%s' \
-                                      % (self.aptly_api_base_url,
-                                         'repos',
-                                         local(public_repo_name),
-                                         path)
+    def __mark_spool_ready(self, spool_dir):
+        """Add the marker file saying that a deploy's spool directory has been completely uploaded."""
+        r = self.__do_post('%s/files/%s' % (self.aptly_api_base_url, spool_dir), files={'file': (SPOOL_READY, '')})
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to mark spool directory ready: %s'
+                                % (r.status_code, spool_dir))
+
+    def __spool_lock_description(self, token, refresh):
+        return 'raptly spool lock held by %s@%s (%s), refresh %s' % (self.local_user, socket.gethostname(), token,
+                                                                    refresh)
+
+    def __acquire_spool_lock(self, lock_name):
+        """Try to create the spool lock snapshot.
+        :return: A token identifying this hold of the lock if this client now holds it, otherwise None
+        """
+        token = str(uuid.uuid4())[:8]
+        payload = {'Name': lock_name, 'Description': self.__spool_lock_description(token, 0)}
+        r = self.__do_post('%s/snapshots' % self.aptly_api_base_url, data=json.dumps(payload),
+                           headers={'content-type': 'application/json'})
+        self.__invalidate_snapshot(lock_name)
+        if r.status_code == 201:
+            return token
+        if r.status_code == requests.codes.bad_request:
+            # Already exists - held by another deploy
+            return None
+        raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to create spool lock: %s' % (r.status_code, lock_name))
+
+    def __refresh_spool_lock(self, lock_name, token, stop):
+        """Change the description of the held spool lock every SPOOL_LOCK_REFRESH_INTERVAL until stop is set, to
+        show the other deploys that it hasn't been abandoned."""
+        refresh = 0
+        while not stop.wait(SPOOL_LOCK_REFRESH_INTERVAL):
+            refresh += 1
+            payload = {'Description': self.__spool_lock_description(token, refresh)}
+            try:
+                r = self.__do_put('%s/snapshots/%s' % (self.aptly_api_base_url, lock_name), data=json.dumps(payload),
+                                  headers={'content-type': 'application/json'})
+                if r.status_code != requests.codes.ok and self.verbose:
+                    print('Failed to refresh spool lock %s - HTTP %s' % (lock_name, r.status_code))
+            except requests.exceptions.RequestException as e:
+                if self.verbose:
+                    print('Failed to refresh spool lock %s - %s' % (lock_name, e))
+
+    def __publish_spool(self, lock_name, token, public_repo_name, gpg_public_key_id, unstable_dist_name,
+                        force=False):
+        """Import every completely uploaded spool directory into the repo and re-publish unstable, once for the
+        whole batch, then release the spool lock - which must be held.
+        :param token: The token returned by __acquire_spool_lock
+        :param force: Re-publish even if no directory is ready - e.g. after breaking the lock of a batch that was
+        imported but perhaps never published
+        :return: True if unstable was re-published (or found up to date), False if no directory was ready
+        """
+        stop = threading.Event()
+        refresher = start_threads(lambda: self.__refresh_spool_lock(lock_name, token, stop), 1)
+        try:
+            prefix = '%s.spool.' % local(public_repo_name)
+            ready = [upload_dir for upload_dir in self.list_upload_dirs() if upload_dir.startswith(prefix) and
+                     SPOOL_READY in self.list_upload_dir(upload_dir)]
+            if ready:
+                if self.verbose:
+                    print('Publishing spooled batch of %s deploys' % len(ready))
+                with self.upload_stats.phase('import'):
+                    for upload_dir in ready:
+                        report = self.add_upload_dir(upload_dir, public_repo_name)
+                        # Files that failed to import are left for their deploy to report
+                        for path in report['FailedFiles']:
+                            if self.verbose:
+                                print('Failed to import: %s' % path)
+                        self.__do_delete('%s/files/%s/%s' % (self.aptly_api_base_url, upload_dir, SPOOL_READY))
+            if not ready and not force:
+                return False
+            self.republish_unstable(unstable_dist_name=unstable_dist_name, gpg_public_key_id=gpg_public_key_id,
+                                    public_repo_name=public_repo_name, reason='deploy')
+            return True
+        finally:
+            stop.set()
+            join_all(refresher)
+            self.drop_snapshot(lock_name)
+
+    def __wait(self, seconds):
+        """Sleep, but not beyond the command deadline"""
+        remaining = self.http.remaining()
+        time.sleep(max(0, min(seconds, remaining)) if remaining is not None else seconds)
+
+    def get_snapshot(self, snapshot_name):
+        """Return the details (Name, CreatedAt, Description) of a snapshot, or None if it does not exist.
+        :param snapshot_name: The snapshot name
+        """
+        snapshot_url = '%s/snapshots/%s' % (self.aptly_api_base_url, snapshot_name)
+        r = self.__do_get(snapshot_url)
+        if r.status_code == requests.codes.not_found:
+            return None
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to get snapshot: %s'
+                                % (r.status_code, snapshot_name))
+        return r.json()
+
+    def list_upload_dirs(self):
+        """Return the names of the directories in the server's upload directory."""
+        r = self.__do_get('%s/files' % self.aptly_api_base_url)
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to list upload directories' % r.status_code)
+        return r.json()
+
+    def list_upload_dir(self, upload_dir):
+        """Return the names of the files in a directory of the server's upload directory - empty if there is no
+        such directory.
+        :param upload_dir: The directory in the server's upload directory
+        """
+        r = self.__do_get('%s/files/%s' % (self.aptly_api_base_url, upload_dir))
+        if r.status_code == requests.codes.not_found:
+            return []
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to list upload directory: %s'
+                                % (r.status_code, upload_dir))
+        return r.json()
+
+    def packages_to_upload(self, package_files, package_refs, verify_hash=None):
+        """Return the package files that need uploading, skipping those whose package (architecture, name and
+        version, read from the file) is among package_refs - e.g. when CI re-runs a pipeline without rebuilding -
+        and whose server copy has the same size as the file, or the same SHA256 if verify_hash is set.  A file
+        differing from the server's copy of its package, e.g. rebuilt without a new version, is uploaded with a
+        warning, for the server to reject or replace.
+        Files that can't be read as Debian packages are always uploaded, for the server to judge.
+        :param package_files: List of Debian package local file names
+        :param package_refs: The package refs already on the server (e.g. of the target repo)
+        :param verify_hash: If given, whether to compare SHA256 rather than size - overriding verify_hash
+        :raises IOError: If any of the package files does not exist
+        """
+        if verify_hash is None:
+            verify_hash = self.verify_hash
+        known_refs = dict((ref_identity(ref), ref) for ref in package_refs)
+
+        def needs_upload(package_file):
+            try:
+                package_ref = known_refs.get(package_identity(package_file, self.file_cache))
+            except ValueError:
+                return True
+            if package_ref is None:
+                return True
+            package = self.get_package(package_ref)
+            if verify_hash:
+                differs = package.get('SHA256') != file_checksums(package_file, self.file_cache)['sha256']
+            else:
+                differs = package.get('Size') not in (None, str(os.path.getsize(package_file)))
+            if differs:
+                print('WARNING: %s differs from %s already on server - rebuilt without a new version?'
+                      % (package_file, package_ref))
+                return True
             if self.verbose:
-                print('Adding file: %s to repo %s' % (add_package_to_repo_url, local(public_repo_name)))
+                print('Skipping %s - already on server as %s' % (package_file, package_ref))
+            return False
 
-            r = self.__do_post(add_package_to_repo_url)
-            if r.status_code != requests.codes.ok:
-                raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to add uploaded file to repo: %s'
-                                    % (r.status_code, local(public_repo_name)))
+        needed = map_ordered(needs_upload, package_files, self.__nested_workers())
+        return [package_file for package_file, upload in zip(package_files, needed) if upload]
 
-    def republish_unstable(self, unstable_dist_name, gpg_public_key_id, public_repo_name, reason):
-        """ Drop and re-publish the unstable distribution.  The unstable distribution is a published snapshot of the
+    def get_package(self, package_ref):
+        """Return the details (Package, Version, SHA256, Size etc.) of a package on the server.
+        :param package_ref: The aptly package ref (e.g. Pall margherita 1.0.0 9ed826d62d1e3010)
+        """
+        package_url = '%s/packages/%s' % (self.aptly_api_base_url, urllib.quote(package_ref))
+        r = self.__do_get(package_url)
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to get package: %s' % (r.status_code, package_ref))
+        return r.json()
+
+    def upload_packages(self, package_files, public_repo_name, upload_dir, force_replace=False):
+        """Upload package files and add them to a local repo.  Up to upload_workers files are uploaded at once,
+        each over its own connection, into a directory of their own on the server, which is then imported into the
+        repo in one operation and removed.
+        :param package_files: List of Debian package local file names
+        :param public_repo_name: The public repo name (i.e. with slashes '/')
+        :param upload_dir: The sub-directory on the server to upload to - a unique directory is created under it
+        :param force_replace: If True, replace packages in the repo with the same identity as a file but different
+        contents - e.g. a package rebuilt without a new version
+        :return: List, in the order of package_files, of dicts with keys 'file', 'path' (on the server) and 'error'
+        :raises IOError: If any of the package files does not exist - before anything is uploaded
+        :raises RaptlyError: If any file failed to upload or be added to the repo, listing each failed file
+        """
+        for package_file in package_files:
+            if not os.path.isfile(package_file):
+                raise IOError(errno.ENOENT, 'No such file or directory', package_file)
+        if not package_files:
+            return []
+
+        # A directory of this invocation's own, so that only its files are imported
+        batch_dir = '%s.%s' % (upload_dir, str(uuid.uuid4())[:8])
+        try:
+            results = self.__upload_files(package_files, batch_dir)
+            if any(result['path'] for result in results):
+                with self.upload_stats.phase('import'):
+                    report = self.add_upload_dir(batch_dir, public_repo_name, force_replace)
+                failed_files = set(os.path.basename(path) for path in report['FailedFiles'])
+                for result in results:
+                    if result['path'] and os.path.basename(result['path']) in failed_files:
+                        warnings = import_warnings_for(os.path.basename(result['path']), report['Warnings'])
+                        result['error'] = 'Failed to add to repo'
+                        if warnings:
+                            result['error'] += ': %s' % '; '.join(warnings)
+        finally:
+            self.delete_upload_dir(batch_dir)
+
+        self.__report_results(results, public_repo_name)
+        return results
+
+    def __upload_files(self, package_files, upload_dir):
+        """Upload package files, up to upload_workers at once, showing progress on a terminal.
+        :return: List, in the order of package_files, of dicts with keys 'file', 'path' (on the server) and 'error'
+        """
+        progress = UploadProgress(sum(len(MultipartFileEncoder([package_file])) for package_file in package_files),
+                                  len(package_files))
+        with self.upload_stats.phase('upload'):
+            results = map_ordered(lambda package_file: self.__upload_package(package_file, upload_dir, progress),
+                                  package_files, self.upload_workers)
+        progress.finish()
+        return results
+
+    def __report_results(self, results, public_repo_name):
+        """Print the per-file results if verbose and raise RaptlyError listing any failed files."""
+        failed = [result for result in results if result['error']]
+        if self.verbose:
+            for result in results:
+                print('%s %s' % ('FAILED' if result['error'] else 'Added ', result['file']))
+        if failed:
+            raise RaptlyError('Failed to add %s of %s package files to repo %s:\n%s'
+                              % (len(failed), len(results), public_repo_name,
+                                 '\n'.join('  %s - %s' % (result['file'], result['error']) for result in failed)))
+
+    def __upload_package(self, package_file, upload_dir, progress):
+        """Upload one package file, returning the result rather than raising."""
+        result = {'file': package_file, 'path': None, 'error': None}
+        try:
+            result['path'] = self.upload([package_file], upload_dir, progress)[0]
+            progress.file_done()
+        except AptlyApiError as e:
+            result['error'] = e.msg
+        except requests.exceptions.RequestException as e:
+            result['error'] = str(e)
+        return result
+
+    def add_upload_dir(self, upload_dir, public_repo_name, force_replace=False):
+        """Import all the package files in a directory uploaded to the server into a local repo.
+        :param upload_dir: The directory in the server's upload directory
+        :param public_repo_name: The public repo name (i.e. with slashes '/')
+        :param force_replace: If True, replace packages in the repo that conflict with those imported
+        :return: aptly's report - a dict with keys 'FailedFiles' (server paths), 'Added', 'Removed' and 'Warnings'
+        """
+        add_dir_to_repo_url = '%s/%s/%s/file/%s' \
+                              % (self.aptly_api_base_url,
+                                 'repos',
+                                 local(public_repo_name),
+                                 upload_dir)
+        if force_replace:
+            add_dir_to_repo_url += '?forceReplace=1'
+        if self.verbose:
+            print('Adding files in: %s to repo %s' % (add_dir_to_repo_url, local(public_repo_name)))
+
+        r = self.__do_post(add_dir_to_repo_url)
+        if r.status_code != requests.codes.ok:
+            raise AptlyApiError(r.status_code, '[HTTP %s] - Failed to add uploaded files to repo: %s'
+                                % (r.status_code, local(public_repo_name)))
+        response = r.json()
+        report = response.get('Report') or {}
+        return {'FailedFiles': response.get('FailedFiles') or [],
+                'Added': report.get('Added') or [],
+                'Removed': report.get('Removed') or [],
+                'Warnings': report.get('Warnings') or []}
+
+    def delete_upload_dir(self, upload_dir):
+        """Delete a directory, and any files left in it, from the server's upload directory.
+        :param upload_dir: The directory in the server's upload directory
+        """
+        r = self.__do_delete('%s/files/%s' % (self.aptly_api_base_url, upload_dir))
+        if r.status_code not in (requests.codes.ok, requests.codes.not_found) and self.verbose:
+            print('Failed to delete upload directory %s - HTTP %s' % (upload_dir, r.status_code))
+
+    def republish_unstable(self, unstable_dist_name, gpg_public_key_id, public_repo_name, reason, force=False,
+                           repo_packages=None):
+        """ Re-publish the unstable distribution.  The unstable distribution is a published snapshot of the
         local repository.
         :param unstable_dist_name: Name of the unstable distribution
         :param gpg_public_key_id: Non-default GPG key to use if required
         :param public_repo_name: The public repo name (i.e. with slashes '/')
         :param reason: The reason that this snapshot is being created (forms part of snapshot name)
+        :param force: If True, re-publish even if the local repo holds the same packages as the published snapshot
+        :param repo_packages: The package refs now in the local repo, if already fetched
+        :return: True if the distribution was re-published, False if it was already up to date
         """
         # The format of the snapshot name is: <local_repo_name>.<timestamp>
         snapshot_name = "%s.%s.%s.%s.%s" % (local(public_repo_name), reason, str(uuid.uuid1())[:8], get_timestamp(),
                                             self.local_user)
-        self.republish_dist(unstable_dist_name, gpg_public_key_id, public_repo_name, snapshot_name)
-
-    def republish_dist(self, dist_name, gpg_public_key_id, public_repo_name, local_repo_snapshot_name):
-        """ Drop and re-publish the named distribution.
+        return self.republish_dist(unstable_dist_name, gpg_public_key_id, public_repo_name, snapshot_name, force,
+                                   repo_packages)
+
+    def republish_dist(self, dist_name, gpg_public_key_id, public_repo_name, local_repo_snapshot_name, force=False,
+                       repo_packages=None):
+        """ Re-publish the named distribution from a new snapshot of the local repo, switching an existing publication
+        of a snapshot in place rather than dropping and re-creating it.  A publication of anything else - e.g. of
+        the local repo itself - can't be switched to a snapshot, so is dropped and re-created.  Nothing is done if
+        the distribution is already published from a snapshot holding exactly the packages now in the local repo.
         :param dist_name: The distribution name
         :param gpg_public_key_id: Non-default GPG key to use if required
         :param public_repo_name: The public repo name (i.e. with slashes '/')
         :param local_repo_snapshot_name: Name of the local repo snapshot to create
+        :param force: If True, re-publish even if the local repo is unchanged since the current publication
+        :param repo_packages: The package refs now in the local repo, if already fetched
+        :return: True if the distribution was re-published, False if it was already up to date
         """
-        # Drop any pre-existing publication of the unstable distribution
-        if self.find_publication(distribution=dist_name, public_repo_name=public_repo_name):
-            self.drop_published_distribution(self.aptly_api_base_url,
-                                             local_repo_name=local(public_repo_name),
-                                             distribution=dist_name)
+        publication = self.find_publication(distribution=dist_name, public_repo_name=public_repo_name)
+        if publication and not force and self.is_up_to_date(publication, public_repo_name, repo_packages):
+            if self.verbose:
+                print('Packages in %s unchanged since %s was published - not re-publishing'
+                      % (public_repo_name, dist_name))
+            return False
 
         # Create a new snapshot of the local repo
         self.create_local_repo_snapshot(local_repo_snapshot_name, public_repo_name)
 
-        # Publish the snapshot
+        # Switch the existing publication to the snapshot, or publish it if there is none
+        if publication and publication['SourceKind'] != 'snapshot':
+            self.drop_published_distribution(self.aptly_api_base_url, local(public_repo_name), dist_name)
+        elif publication and self.switch_published_snapshot(dist_name, gpg_public_key_id, local_repo_snapshot_name,
+                                                            public_repo_name):
+            return True
         self.publish_snapshot(self.aptly_api_base_url, dist_name, gpg_public_key_id, local_repo_snapshot_name,
                               local(public_repo_name))
+        return True
+
+    def is_up_to_date(self, publication, public_repo_name, repo_packages=None):
+        """Return True if a publication's single source snapshot holds exactly the packages now in the local repo.
+        The snapshot's packages are fetched once and then served from the snapshot cache, if there is one, so with
+        repo_packages given this usually costs no requests.
+        :param publication: The publication, as returned by find_publication
+        :param public_repo_name: The public repo name (i.e. with slashes '/')
+        :param repo_packages: The package refs now in the local repo - fetched if not given
+        """
+        if publication['SourceKind'] != 'snapshot' or len(publication['Sources']) != 1:
+            return False
+        snapshot_packages = self.get_packages_from_snapshot(publication['Sources'][0]['Name'])
+        if repo_packages is None:
+            repo_packages = self.get_packages_from_local_repo(local(public_repo_name), stream=True)
+        return package_set_fingerprint(snapshot_packages) == package_set_fingerprint(repo_packages)
 
     def create_local_repo_snapshot(self, local_repo_snapshot_name, public_repo_name):
         """ Create a snapshot for a local repo
@@ -628,6 +1506,7 @@ class AptlyApi:
         payload = {'Name': local_repo_snapshot_name}
         headers = {'content-type': 'application/json'}
         r = self.__do_post(create_snapshot_url, data=json.dumps(payload), headers=headers)
+        self.__invalidate_snapshot(local_repo_snapshot_name)
         if r.status_code != 201:
             raise AptlyApiError(r.status_code, 'Aptly API Error - %s - HTTP Error: %s'
                                 % ('Failed to create snapshot %s distribution of repo: %s' % (
@@ -640,100 +1519,129 @@ class AptlyApi:
         :param release_id: A unique ID for the test candidate (e.g. JIRA ticket number)
         :param dry_run: If True, just show what would happen.
         :param no_prune: If True, the resulting check repo won't prune out old package versions
+        :return: The packages of the release, those new since stable and the release candidate snapshot name
         """
-
-        # Get list of packages from stable distribution if it exists
-        stable_packages = []
-        stable_publication = self.find_publication(self.stable_name, public_repo_name)
-        if stable_publication is not None:
-            stable_packages = self.find_packages(stable_publication)
-
-        # Check for pre-existing release candidate with matching release_id sort by latest in case of > 1
-        matching_releases = sorted(self.find_release_candidate_snapshots(local(public_repo_name), release_id),
-                                   reverse=True)
-        # If there is a matching release candidate
-        if len(matching_releases) > 0:
+        results = self.__run_plan(self.test_plan(public_repo_name, package_query, release_id, dry_run, no_prune))
+        if results['existing']:
+            return results['stable'], [], results['existing']
+        release = results['release']
+        return release['union'], release['new'], results['candidate']
+
+    def test_plan(self, public_repo_name, package_query, release_id, dry_run, no_prune=False):
+        """Return the plan run by test - see test for the parameters."""
+
+        def get_stable_packages(results):
+            # Get list of packages from stable distribution if it exists
+            stable_publication = self.find_publication(self.stable_name, public_repo_name)
+            if stable_publication is None:
+                return []
+            return self.find_packages(stable_publication)
+
+        def find_existing_release(results):
+            # Check for pre-existing release candidate with matching release_id sort by latest in case of > 1
+            matching_releases = sorted(results['candidates'], reverse=True)
+            if len(matching_releases) == 0:
+                return None
             # Prohibit any attempt to modify this release
             if package_query is not None:
                 raise RaptlyError('Cannot modify existing release "%s"' % release_id)
+            # Use most recent if > 1
+            return matching_releases[0]['Name']
 
-            # Publish existing release as testing.  Use most recent if > 1
-            existing_release = matching_releases[0]['Name']
-            self.publish(self.testing_name, public_repo_name, existing_release)
-            return stable_packages, [], existing_release
+        def publish_existing_release(results):
+            if results['existing']:
+                self.publish(self.testing_name, public_repo_name, results['existing'])
 
-        # TODO - Exit if about to replace un-promoted testing - --force to override
+        def find_new_packages(results):
+            if results['existing']:
+                return None
 
-        if self.verbose:
-            print('Creating release candidate from packages: %s to %s' % (package_query, self.aptly_api_base_url))
+            # TODO - Exit if about to replace un-promoted testing - --force to override
 
-        # Get the snapshot source of the unstable distribution
-        unstable_snapshot_name = self.get_snapshot_for_publication(distribution=self.unstable_name,
-                                                                   public_repo_name=public_repo_name)
+            if self.verbose:
+                print('Creating release candidate from packages: %s to %s' % (package_query, self.aptly_api_base_url))
 
-        # Create list of new packages to add to what's already in stable
-        new_packages = []
-        if package_query is not None:
+            # Get the snapshot source of the unstable distribution
+            unstable_snapshot_name = self.get_snapshot_of_publication(results['unstable'],
+                                                                      distribution=self.unstable_name,
+                                                                      public_repo_name=public_repo_name)
             # Use the query to get list of matching packages from unstable
-            matching_packages = self.filter_packages(package_query, unstable_snapshot_name)
+            matching_packages = []
+            if package_query is not None:
+                matching_packages = self.filter_packages(package_query, unstable_snapshot_name)
+            return {'unstable_snapshot': unstable_snapshot_name, 'matching': matching_packages}
 
+        def create_release(results):
+            if results['existing']:
+                return None
             # Filter out any packages that are already released in stable
-            new_packages = [x for x in matching_packages if x not in stable_packages]
+            stable_packages = results['stable']
+            new_packages = packages_not_in(results['unstable_packages']['matching'], stable_packages)
 
-        # Create the union of new + stable
-        union = stable_packages + new_packages
-        # Prune unless told not to
-        if not no_prune:
-            union = prune(union)
+            # Create the union of new + stable
+            union = stable_packages + new_packages
+            # Prune unless told not to
+            if not no_prune:
+                union = prune(union)
+            return {'union': union, 'new': new_packages}
 
-        snapshot_release_candidate = None
         # Nothing to do if there are no packages or dry-run requested
-        if not dry_run and len(union) > 0:
-
-            # Drop and re-create a temporary snapshot from the list of new packages
-            temp_new_pkgs_snapshot_name = '%s-snap-temp-new-pkgs' % local(public_repo_name)
-            self.drop_snapshot(temp_new_pkgs_snapshot_name)
-            self.create_snapshot_from_package_refs(new_packages, [unstable_snapshot_name], temp_new_pkgs_snapshot_name)
-
-            # Drop and re-create a testing snapshot containing the union
+        def creating_candidate(results):
+            return not dry_run and results['release'] is not None and len(results['release']['union']) > 0
+
+        temp_new_pkgs_snapshot_name = '%s-snap-temp-new-pkgs' % local(public_repo_name)
+
+        def drop_temp_snapshot(results):
+            # Drop any temporary snapshot left by an earlier test, before re-creating it
+            if creating_candidate(results):
+                self.drop_snapshot(temp_new_pkgs_snapshot_name)
+
+        def create_temp_snapshot(results):
+            if creating_candidate(results):
+                # Re-create a temporary snapshot from the list of new packages
+                self.create_snapshot_from_package_refs(results['release']['new'],
+                                                       [results['unstable_packages']['unstable_snapshot']],
+                                                       temp_new_pkgs_snapshot_name)
+
+        def create_candidate_snapshot(results):
+            if not creating_candidate(results):
+                return None
+            # Create a testing snapshot containing the union
             snapshot_release_candidate = '%s.test.%s.%s.%s' % (local(public_repo_name), release_id, get_timestamp(),
                                                                self.local_user)
-            self.create_snapshot_from_package_refs(union, [temp_new_pkgs_snapshot_name], snapshot_release_candidate)
-
-            # Publish / Re-publish the testing distribution
-
-            # Check if testing exists
-            testing_publication = self.find_publication(self.testing_name, public_repo_name)
-            if testing_publication is None:
-                # Publish the release candidate snapshot
-                payload = {'SourceKind': 'snapshot',
-                           'Sources': [{'Name': snapshot_release_candidate}],
-                           'Architectures': ['amd64', 'all'],
-                           'Distribution': self.testing_name}
-                headers = {'content-type': 'application/json'}
-                r = self.__do_post('%s/publish/%s' % (self.aptly_api_base_url, local(public_repo_name)),
-                                   data=json.dumps(payload),
-                                   headers=headers)
-                if r.status_code != 201:
-                    raise AptlyApiError(r.status_code, 'Aptly API Error - %s - HTTP Error: %s'
-                                        % ('Failed to publish testing snapshot', r.status_code))
-            else:
-                # Re-publish the release candidate snapshot
-                payload = {'Snapshots': [{'Component': 'main', 'Name': snapshot_release_candidate}]}
-                headers = {'content-type': 'application/json'}
-                r = self.__do_put('%s/publish//%s/%s' % (
-                    self.aptly_api_base_url, local(public_repo_name), self.testing_name),
-                                  data=json.dumps(payload), headers=headers)
-
-                if r.status_code != requests.codes.ok:
-                    raise AptlyApiError(r.status_code, 'Aptly API Error - %s - HTTP Error: %s'
-                                        % ('Failed to promote to testing', r.status_code))
-
-            # Publish / re-publish the destination distribution
-            self.publish(dest_distribution_name=self.testing_name, public_repo_name=public_repo_name,
-                         source_snapshot=snapshot_release_candidate)
-
-        return union, new_packages, snapshot_release_candidate
+            self.create_snapshot_from_package_refs(results['release']['union'], [temp_new_pkgs_snapshot_name],
+                                                   snapshot_release_candidate)
+            return snapshot_release_candidate
+
+        def publish_candidate(results):
+            # Publish / re-publish the testing distribution
+            if results['candidate']:
+                self.publish(dest_distribution_name=self.testing_name, public_repo_name=public_repo_name,
+                             source_snapshot=results['candidate'])
+
+        plan = Plan('test %s %s' % (public_repo_name, release_id))
+        plan.add('stable', READ, 'Get the packages published as %s' % self.stable_name, get_stable_packages)
+        plan.add('candidates', READ, 'Find release candidate snapshots of %s' % release_id,
+                 lambda results: self.find_release_candidate_snapshots(local(public_repo_name), release_id))
+        plan.add('unstable', READ, 'Find the %s publication' % self.unstable_name,
+                 lambda results: self.find_publication(self.unstable_name, public_repo_name))
+        plan.add('existing', LOCAL, 'Choose the latest existing release candidate, if any', find_existing_release,
+                 requires=['candidates'])
+        plan.add('publish_existing', WRITE, 'Publish an existing release candidate as %s' % self.testing_name,
+                 publish_existing_release, requires=['existing'])
+        plan.add('unstable_packages', READ, 'Get the packages matching %s from %s'
+                 % (package_query, self.unstable_name), find_new_packages, requires=['existing', 'unstable'])
+        plan.add('release', LOCAL, 'Combine new packages with %s' % self.stable_name, create_release,
+                 requires=['stable', 'unstable_packages'])
+        plan.add('drop_temp', WRITE, 'Drop snapshot %s if a release candidate is to be created'
+                 % temp_new_pkgs_snapshot_name, drop_temp_snapshot, requires=['release'])
+        plan.add('temp', WRITE, 'Create snapshot %s of the new packages' % temp_new_pkgs_snapshot_name,
+                 create_temp_snapshot, requires=['drop_temp'])
+        plan.add('candidate', WRITE, 'Create the release candidate snapshot', create_candidate_snapshot,
+                 requires=['temp'])
+        plan.add('publish', WRITE, 'Publish the release candidate as %s' % self.testing_name, publish_candidate,
+                 requires=['candidate'])
+        return plan
 
     def stage(self, public_repo_name, testing_distribution_name, staging_distribution_name, release_id):
         """Promote a release from the testing to the staging distribution.
@@ -743,8 +1651,9 @@ class AptlyApi:
         :param staging_distribution_name: The name of the staging distribution (e.g. 'staging')
         """
 
-        self.__promote(public_repo_name=public_repo_name, source_distribution_name=testing_distribution_name,
-                       dest_distribution_name=staging_distribution_name, release_id=release_id)
+        self.__run_plan(self.promote_plan(public_repo_name=public_repo_name,
+                                          source_distribution_name=testing_distribution_name,
+                                          dest_distribution_name=staging_distribution_name, release_id=release_id))
 
     def release(self, public_repo_name, staging_distribution_name, stable_distribution_name, release_id):
         """Promote a release from the staging to the stable distribution.
@@ -754,41 +1663,125 @@ class AptlyApi:
         :param stable_distribution_name: The name of the stable distribution (e.g. 'stable')
         """
 
-        self.__promote(public_repo_name=public_repo_name, source_distribution_name=staging_distribution_name,
-                       dest_distribution_name=stable_distribution_name, release_id=release_id)
-
-    def __promote(self, public_repo_name, source_distribution_name, dest_distribution_name, release_id):
-        """Promote a release from the source to the destination distribution.
+        self.__run_plan(self.promote_plan(public_repo_name=public_repo_name,
+                                          source_distribution_name=staging_distribution_name,
+                                          dest_distribution_name=stable_distribution_name, release_id=release_id))
+
+    def train(self, public_repo_names, step, fail_fast=False):
+        """Run a step, such as promoting a release, for many repos at once with at most the configured number of
+        workers.  The repos share this instance's connections and each listing is read once for the whole train.
+        Each repo's own plan runs one step at a time, so calls in flight never exceed the number of workers.
+        :param public_repo_names: The published names of the repositories
+        :param step: Function of one argument - the public repo name - run for each repo
+        :param fail_fast: If True, start no more repos once one has failed
+        :return: List, in the order of public_repo_names, of dicts with keys 'repo', 'status' (ok, failed or skipped),
+        'result' of the step, 'error' and 'seconds'
+        """
+        failed = threading.Event()
+
+        def run(public_repo_name):
+            outcome = {'repo': public_repo_name, 'status': 'skipped', 'result': None, 'error': None, 'seconds': 0}
+            if fail_fast and failed.is_set():
+                return outcome
+            start = time.time()
+            try:
+                with self.single_worker():
+                    outcome['result'] = step(public_repo_name)
+                outcome['status'] = 'ok'
+            except Exception as e:
+                # Report the failure of this repo rather than abandoning the others
+                outcome['status'] = 'failed'
+                outcome['error'] = error_message(e)
+                failed.set()
+            outcome['seconds'] = time.time() - start
+            return outcome
+
+        with self.shared_listings():
+            return map_ordered(run, public_repo_names, max_workers=self.workers)
+
+    def test_train(self, public_repo_names, package_query, release_id, dry_run, no_prune=False, fail_fast=False):
+        """Create the test candidate release_id in each of the repos - see test and train.
+        The result of each repo is that of test.
+        """
+        return self.train(public_repo_names,
+                          lambda public_repo_name: self.test(public_repo_name, package_query, release_id, dry_run,
+                                                             no_prune),
+                          fail_fast)
+
+    def stage_train(self, public_repo_names, release_id, fail_fast=False):
+        """Promote release_id from testing to staging in each of the repos - see stage and train."""
+        return self.train(public_repo_names,
+                          lambda public_repo_name: self.stage(public_repo_name, self.testing_name, self.staging_name,
+                                                              release_id),
+                          fail_fast)
+
+    def release_train(self, public_repo_names, release_id, fail_fast=False):
+        """Promote release_id from staging to stable in each of the repos - see release and train."""
+        return self.train(public_repo_names,
+                          lambda public_repo_name: self.release(public_repo_name, self.staging_name, self.stable_name,
+                                                                release_id),
+                          fail_fast)
+
+    def promote_plan(self, public_repo_name, source_distribution_name, dest_distribution_name, release_id):
+        """Return the plan promoting a release from the source to the destination distribution.
         :param public_repo_name: The published name of the repository.
         :param release_id: The unique identifier of the release (e.g. JIRA ticket number)
         :param source_distribution_name: The distribution to promote from (e.g. 'staging')
         :param dest_distribution_name: The distribution to promote to (e.g. 'stable')
         """
 
-        if self.verbose:
-            print('Promoting release %s from %s to %s' % (release_id, source_distribution_name, dest_distribution_name))
-
-        # Get the currently published source
-        source_publication = self.find_publication(distribution=source_distribution_name,
-                                                   public_repo_name=public_repo_name)
-        # Check the source distribution is published
-        if source_publication is None:
-            raise RaptlyError('Cannot promote to %s.  Source distribution %s does not exist.' % (
-                dest_distribution_name, source_distribution_name))
-
-        published_source_snapshot = self.get_snapshot_for_publication(distribution=source_distribution_name,
-                                                                      public_repo_name=public_repo_name)
-
-        # If the release ID of the source publication doesn't match the specified ID
-        pattern = re.compile('.*\.%s\..*' % release_id)
-        if not pattern.match(published_source_snapshot):
-            raise RaptlyError(
-                'Cannot promote release %s.  It is not published as %s.  Please promote to %s first.'
-                % (release_id, source_distribution_name, source_distribution_name))
-
-        # Publish / re-publish the destination distribution
-        self.publish(dest_distribution_name=dest_distribution_name, public_repo_name=public_repo_name,
-                     source_snapshot=published_source_snapshot)
+        def find_source_snapshot(results):
+            if self.verbose:
+                print('Promoting release %s from %s to %s' % (release_id, source_distribution_name,
+                                                              dest_distribution_name))
+
+            # Get the currently published source
+            source_publication = self.find_publication(distribution=source_distribution_name,
+                                                       public_repo_name=public_repo_name)
+            # Check the source distribution is published
+            if source_publication is None:
+                raise RaptlyError('Cannot promote to %s.  Source distribution %s does not exist.' % (
+                    dest_distribution_name, source_distribution_name))
+
+            return self.get_snapshot_of_publication(source_publication, distribution=source_distribution_name,
+                                                    public_repo_name=public_repo_name)
+
+        def check_release(results):
+            # If the release ID of the source publication doesn't match the specified ID
+            pattern = re.compile('.*\.%s\..*' % release_id)
+            if not pattern.match(results['source']):
+                raise RaptlyError(
+                    'Cannot promote release %s.  It is not published as %s.  Please promote to %s first.'
+                    % (release_id, source_distribution_name, source_distribution_name))
+
+        def publish_release(results):
+            # Publish / re-publish the destination distribution
+            self.publish(dest_distribution_name=dest_distribution_name, public_repo_name=public_repo_name,
+                         source_snapshot=results['source'])
+
+        plan = Plan('promote %s %s from %s to %s' % (public_repo_name, release_id, source_distribution_name,
+                                                     dest_distribution_name))
+        plan.add('source', READ, 'Find the snapshot published as %s' % source_distribution_name, find_source_snapshot)
+        plan.add('check', LOCAL, 'Check the snapshot is of release %s' % release_id, check_release,
+                 requires=['source'])
+        plan.add('publish', WRITE, 'Publish the snapshot as %s' % dest_distribution_name, publish_release,
+                 requires=['check'])
+        return plan
+
+    def __nested_workers(self):
+        """Return the number of workers for concurrent calls made by the current thread - just 1 within
+        single_worker."""
+        return 1 if getattr(self.outer_worker, 'active', False) else self.workers
+
+    def __run_plan(self, plan):
+        """Run a plan with the configured number of workers and, if verbose, show the time taken by each step.
+        :return: Dict of the results of the steps by name
+        """
+        try:
+            return plan.run(max_workers=self.__nested_workers())
+        finally:
+            if self.verbose:
+                print(plan.format())
 
     def publish(self, dest_distribution_name, public_repo_name, source_snapshot):
         """Publish or re-publish the distribution from the source snapshot.
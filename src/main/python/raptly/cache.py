@@ -0,0 +1,301 @@
+"""
+Local on-disk caches of data fetched from the aptly server
+"""
+import hashlib
+import json
+import marshal
+import os
+import tempfile
+
+DEFAULT_CACHE_DIR = '~/.raptly/cache'
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_FILE_CACHE_SIZE = 16 * 1024 * 1024
+
+
+def write_atomically(path, content):
+    """Write content to path via a temporary file and rename, so that concurrent readers (and other raptly
+    processes) only ever see a complete file."""
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(content)
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def make_dirs(path):
+    """Create directory path if it doesn't already exist"""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another process may have created it first
+            if not os.path.isdir(path):
+                raise
+
+
+class SnapshotCache:
+    """Size-bounded, least-recently-used cache of snapshot package lists.
+    Aptly snapshots are immutable once created, so a snapshot's package list can be served locally until
+    the snapshot is dropped (or a snapshot of the same name is re-created).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        """
+        :param cache_dir: The cache root directory (e.g. ~/.raptly/cache)
+        :param max_size: Maximum total size in bytes of the cached package lists
+        """
+        self.dir = os.path.join(os.path.expanduser(cache_dir), 'snapshots')
+        self.max_size = max_size
+        make_dirs(self.dir)
+
+    def path(self, server_url, snapshot_name):
+        key = hashlib.sha1('%s\n%s' % (server_url, snapshot_name)).hexdigest()
+        return os.path.join(self.dir, '%s.json' % key)
+
+    def get(self, server_url, snapshot_name):
+        """Return the cached package refs of the snapshot or None if not cached.
+        :param server_url: The aptly API base URL
+        :param snapshot_name: The snapshot name
+        """
+        path = self.path(server_url, snapshot_name)
+        try:
+            with open(path, 'rb') as cache_file:
+                entry = json.load(cache_file)
+            # Mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('server') != server_url or entry.get('snapshot') != snapshot_name:
+            return None
+        return entry['packages']
+
+    def put(self, server_url, snapshot_name, package_refs):
+        """Cache the package refs of a snapshot, evicting least recently used entries if over size.
+        :param server_url: The aptly API base URL
+        :param snapshot_name: The snapshot name
+        :param package_refs: The snapshot's package refs
+        """
+        entry = {'server': server_url, 'snapshot': snapshot_name, 'packages': package_refs}
+        write_atomically(self.path(server_url, snapshot_name), json.dumps(entry))
+        self.evict()
+
+    def invalidate(self, server_url, snapshot_name):
+        """Remove a snapshot from the cache.
+        :param server_url: The aptly API base URL
+        :param snapshot_name: The snapshot name
+        """
+        try:
+            os.remove(self.path(server_url, snapshot_name))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within its size limit."""
+        evict_least_recently_used(self.dir, '.json', self.max_size)
+
+
+def evict_least_recently_used(directory, suffix, max_size):
+    """Remove the least recently modified files ending in suffix from directory until their total size is
+    at most max_size."""
+    entries = []
+    total_size = 0
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(suffix):
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+class ListingCache:
+    """Cache of the mutable aptly listings (/publish, /repos, /snapshots) kept between invocations.
+    Each entry holds the decoded listing together with the HTTP validators (ETag, Last-Modified) and a
+    fingerprint of the response body, so that an unchanged listing can be revalidated with a conditional GET
+    and need not be decoded again.  Decoded listings are stored with marshal, which loads much faster than JSON.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        :param cache_dir: The cache root directory (e.g. ~/.raptly/cache)
+        """
+        self.dir = os.path.join(os.path.expanduser(cache_dir), 'listings')
+        make_dirs(self.dir)
+
+    def path(self, url):
+        return os.path.join(self.dir, '%s.marshal' % hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """Return the cached entry for the listing URL or None if not cached.
+        An entry is a dict with keys: url, listing, fingerprint, size, etag, last_modified
+        :param url: The listing URL
+        """
+        try:
+            with open(self.path(url), 'rb') as cache_file:
+                entry = marshal.load(cache_file)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict) or entry.get('url') != url:
+            return None
+        return entry
+
+    def put(self, url, listing, fingerprint, size, etag=None, last_modified=None):
+        """Cache a listing.
+        :param url: The listing URL
+        :param listing: The decoded listing
+        :param fingerprint: Fingerprint of the response body
+        :param size: Size in bytes of the response body
+        :param etag: ETag response header, if any
+        :param last_modified: Last-Modified response header, if any
+        """
+        entry = {'url': url, 'listing': listing, 'fingerprint': fingerprint, 'size': size, 'etag': etag,
+                 'last_modified': last_modified}
+        write_atomically(self.path(url), marshal.dumps(entry))
+
+
+class FileInfoCache:
+    """Cache of facts about local package files - checksums and control fields - that are expensive to work out.
+    An entry is keyed by the file's absolute path and only used while the file's size, mtime and inode are
+    unchanged, so a rebuilt artifact is never mistaken for the old one.  Entries are written atomically, so
+    concurrent raptly processes on the same host at worst repeat each other's work.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_FILE_CACHE_SIZE):
+        """
+        :param cache_dir: The cache root directory (e.g. ~/.raptly/cache)
+        :param max_size: Maximum total size in bytes of the cache entries
+        """
+        self.dir = os.path.join(os.path.expanduser(cache_dir), 'files')
+        self.max_size = max_size
+        make_dirs(self.dir)
+        # Entries are small and many, so evict once per process rather than on every update
+        evict_least_recently_used(self.dir, '.json', self.max_size)
+
+    def path(self, file_name):
+        return os.path.join(self.dir, '%s.json' % hashlib.sha1(os.path.abspath(file_name)).hexdigest())
+
+    def get(self, file_name, stat=None):
+        """Return the cached facts about a file - a dict of any of 'sha256', 'md5' and 'control' - or an empty dict
+        if nothing is cached for the file as it is now.
+        :param file_name: The local file name
+        :param stat: The file's os.stat result, if already known
+        :raises OSError: If the file does not exist
+        """
+        stat = stat or os.stat(file_name)
+        try:
+            with open(self.path(file_name), 'rb') as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        if entry.get('path') != os.path.abspath(file_name) or entry.get('key') != file_key(stat):
+            return {}
+        return entry['facts']
+
+    def update(self, file_name, stat, **facts):
+        """Add facts to the file's cache entry, provided the file is unchanged since stat was taken - i.e. the
+        facts were worked out from the file as it still is.
+        :param file_name: The local file name
+        :param stat: The file's os.stat result taken before the facts were worked out
+        :param facts: The facts to cache - e.g. sha256='...'
+        """
+        try:
+            if file_key(os.stat(file_name)) != file_key(stat):
+                return
+        except OSError:
+            return
+        cached = self.get(file_name, stat)
+        cached.update(facts)
+        entry = {'path': os.path.abspath(file_name), 'key': file_key(stat), 'facts': cached}
+        write_atomically(self.path(file_name), json.dumps(entry))
+
+
+class CheckStateCache:
+    """What each of this user's check publications was made from, so that the next check of the same repo need only
+    upload and publish what has changed.  An entry is a dict with keys:
+      stable - the stable snapshot checked against
+      packages - fingerprint of the check repo packages included, or None if only stable was
+      no_prune - whether old versions were kept
+      snapshot - the check snapshot published
+      files - by package identity, the 'key' (see file_key) of the file last found the same as the server's package,
+              and that package's 'ref'
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        :param cache_dir: The cache root directory (e.g. ~/.raptly/cache)
+        """
+        self.dir = os.path.join(os.path.expanduser(cache_dir), 'checks')
+        make_dirs(self.dir)
+
+    def path(self, server_url, repo_name):
+        key = hashlib.sha1('%s\n%s' % (server_url, repo_name)).hexdigest()
+        return os.path.join(self.dir, '%s.json' % key)
+
+    def get(self, server_url, repo_name):
+        """Return the state of the last check publication of a check repo, or None if not known.
+        :param server_url: The aptly API base URL
+        :param repo_name: The public name of the check repo
+        """
+        try:
+            with open(self.path(server_url, repo_name), 'rb') as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('server') != server_url or entry.get('repo') != repo_name:
+            return None
+        return entry['state']
+
+    def put(self, server_url, repo_name, state):
+        """Record the state of a check repo's new check publication - see the class for its keys.
+        :param server_url: The aptly API base URL
+        :param repo_name: The public name of the check repo
+        """
+        entry = {'server': server_url, 'repo': repo_name, 'state': state}
+        write_atomically(self.path(server_url, repo_name), json.dumps(entry))
+
+    def invalidate(self, server_url, repo_name):
+        """Forget the state of a check repo - e.g. once it has been deleted."""
+        try:
+            os.remove(self.path(server_url, repo_name))
+        except OSError:
+            pass
+
+
+def file_key(stat):
+    """The (size, mtime, inode) of a file's os.stat result, which change whenever the file is rewritten"""
+    return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+
+def conditional_headers(entry):
+    """Return the request headers for a conditional GET revalidating the cached entry.
+    :param entry: Cached listing entry or None
+    """
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def fingerprint(content):
+    """Cheap fingerprint of a response body"""
+    return hashlib.sha1(content).hexdigest()
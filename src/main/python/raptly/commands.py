@@ -1,12 +1,22 @@
 import argparse
 import json
 import os
+import re
 
 import toml
 
 import view
 from _version import __version__
-from aptly_api import AptlyApi
+from aptly_api import AptlyApi, RaptlyError
+from cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from http_client import DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_RETRIES
+from parallel import DEFAULT_WORKERS
+
+
+# Options that may be set either on the command line or in the [default] section of ~/.raptly/config
+CONFIG_PARAMS = ('pool_size', 'no_keep_alive', 'workers', 'upload_workers', 'connect_timeout', 'read_timeout',
+                 'deadline', 'retries', 'no_retry', 'hedge_percentile', 'cache_dir', 'cache_size', 'no_cache',
+                 'verify_hash', 'upload_stats')
 
 
 # TODO - coloured output for new packages etc
@@ -42,6 +52,27 @@ def add_deploy_cmd(subparsers):
                             help='Public GPG key to use for signing on the server')
     cmd_parser.add_argument('-d', '--distribution', default='unstable',
                             help='Distribution name - default "unstable"')
+    cmd_parser.add_argument('--coalesce', dest='coalesce', action='store_true',
+                            help='Share one import and publish with deploys to the same repo arriving at the same time')
+    cmd_parser.add_argument('--no-publish', dest='no_publish', action='store_true',
+                            help="Add the packages to the repo but don't re-publish - see publish-unstable")
+    add_plan_arg(cmd_parser)
+    cmd_parser.set_defaults(func=run_remote_cmd)
+
+
+def add_publish_unstable_cmd(subparsers):
+    """ Add the parser for the "publish-unstable" command."""
+    cmd_parser = subparsers.add_parser('publish-unstable',
+                                       help='Snapshot the repo and publish it as "unstable" - e.g. after deploying '
+                                            'or un-deploying with --no-publish')
+    cmd_parser.add_argument('repo_name', help='The name of the APT repo - e.g. a4pizza/base')
+    cmd_parser.add_argument('-g', '--gpg-key', dest='gpg_key',
+                            help='Public GPG key to use for signing on the server')
+    cmd_parser.add_argument('-d', '--distribution', default='unstable',
+                            help='Distribution name - default "unstable"')
+    cmd_parser.add_argument('-f', '--force', action='store_true',
+                            help='Re-publish even if the repo holds the same packages as the current publication - '
+                                 'e.g. to re-sign it with a new key')
     cmd_parser.set_defaults(func=run_remote_cmd)
 
 
@@ -55,6 +86,7 @@ def add_check_cmd(subparsers):
     cmd_parser.add_argument('-c', '--clean', dest='clean', action='store_true', help="Clean check repo")
     cmd_parser.add_argument('-g', '--gpg-key', dest='gpg_key',
                             help='Public GPG key to use for signing on the server')
+    add_plan_arg(cmd_parser)
     cmd_parser.set_defaults(func=run_remote_cmd)
 
 
@@ -65,6 +97,8 @@ def add_undeploy_cmd(subparsers):
     cmd_parser.set_defaults(dry_run=False)
     cmd_parser.add_argument('repo_name', help='The name of the APT repo - e.g. a4pizza/base')
     cmd_parser.add_argument('packages', help='Packages to remove from unstable - a non-urlencoded Aptly package query')
+    cmd_parser.add_argument('--no-publish', dest='no_publish', action='store_true',
+                            help="Remove the packages from the repo but don't re-publish - see publish-unstable")
     cmd_parser.set_defaults(func=run_remote_cmd)
 
 
@@ -79,6 +113,7 @@ def add_test_cmd(subparsers):
     cmd_parser.add_argument('-n', '--no-prune', dest='no_prune', action='store_true', help="Don't prune old versions")
     cmd_parser.add_argument('repo_name', help='The name of the APT repo - e.g. a4pizza/base')
     cmd_parser.add_argument('release_id', help='The unique identifier of this candidate release - e.g. Jira ticket')
+    add_plan_arg(cmd_parser)
     cmd_parser.set_defaults(func=run_remote_cmd)
 
 
@@ -87,6 +122,7 @@ def add_stage_cmd(subparsers):
     cmd_parser = subparsers.add_parser('stage', help='Stage packages in "staging"')
     cmd_parser.add_argument('repo_name', help='The name of the APT repo - e.g. a4pizza/base')
     cmd_parser.add_argument('release_id', help='The unique identifier of the release - e.g. Jira ticket')
+    add_plan_arg(cmd_parser)
     cmd_parser.set_defaults(func=run_remote_cmd)
 
 
@@ -95,9 +131,35 @@ def add_release_cmd(subparsers):
     cmd_parser = subparsers.add_parser('release', help='Release packages to "stable"')
     cmd_parser.add_argument('repo_name', help='The name of the APT repo - e.g. a4pizza/base')
     cmd_parser.add_argument('release_id', help='The unique identifier of the release - e.g. Jira ticket')
+    add_plan_arg(cmd_parser)
     cmd_parser.set_defaults(func=run_remote_cmd)
 
 
+def add_train_cmds(subparsers):
+    """ Create the parsers for the "test-train", "stage-train" and "release-train" commands."""
+    test_parser = subparsers.add_parser('test-train', help='Put a candidate release into "testing" in many repos')
+    test_parser.add_argument('-d', '--dry-run', dest='dry_run', action='store_true', help='Just show what would happen')
+    test_parser.add_argument('-p', '--packages',
+                             help='Add packages from unstable - a non-urlencoded Aptly package query')
+    test_parser.add_argument('-n', '--no-prune', dest='no_prune', action='store_true',
+                             help="Don't prune old versions")
+    stage_parser = subparsers.add_parser('stage-train', help='Stage a release in "staging" in many repos')
+    release_parser = subparsers.add_parser('release-train', help='Release to "stable" in many repos')
+    for cmd_parser in (test_parser, stage_parser, release_parser):
+        cmd_parser.add_argument('release_id', help='The unique identifier of the release - e.g. Jira ticket')
+        cmd_parser.add_argument('repo_names', nargs='+', metavar='repo_name',
+                                help='The names of the APT repos - e.g. a4pizza/base a4pizza/extras')
+        cmd_parser.add_argument('--fail-fast', dest='fail_fast', action='store_true',
+                                help="Once a repo has failed, don't start any more")
+        cmd_parser.set_defaults(func=run_remote_cmd)
+
+
+def add_plan_arg(cmd_parser):
+    cmd_parser.add_argument('--plan', dest='plan', action='store_true',
+                            help='Just show the steps the command would take, and its critical path, without running '
+                                 'them')
+
+
 def add_aptly_version_cmd(subparsers):
     """ Create the parser for the "aptly API version" command."""
     cmd_parser = subparsers.add_parser('version', help='Show client and Aptly server version')
@@ -138,10 +200,12 @@ def create_cmd_parsers():
     add_create_cmd(subparsers)
     add_check_cmd(subparsers)
     add_deploy_cmd(subparsers)
+    add_publish_unstable_cmd(subparsers)
     add_undeploy_cmd(subparsers)
     add_test_cmd(subparsers)
     add_stage_cmd(subparsers)
     add_release_cmd(subparsers)
+    add_train_cmds(subparsers)
     add_aptly_version_cmd(subparsers)
     add_show_cmd(subparsers)
 
@@ -158,6 +222,52 @@ def create_cmd_parsers():
     options_group.add_argument('-k', '--skip-ssl', dest='skip_ssl', action='store_true',
                                help='Skip server SSL verification')
 
+    # Connection group
+    connection_group = cmd_parser.add_argument_group('Connection')
+    connection_group.add_argument('--pool-size', dest='pool_size', type=int,
+                                  help='Maximum number of pooled connections to the server - default %s'
+                                       % DEFAULT_POOL_SIZE)
+    connection_group.add_argument('--no-keep-alive', dest='no_keep_alive', action='store_true',
+                                  help="Don't keep connections alive between requests")
+    connection_group.add_argument('--workers', dest='workers', type=int,
+                                  help='Maximum number of concurrent requests - default %s' % DEFAULT_WORKERS)
+    connection_group.add_argument('--connect-timeout', dest='connect_timeout', type=float,
+                                  help='Seconds to wait to connect to the server - default %s'
+                                       % DEFAULT_CONNECT_TIMEOUT)
+    connection_group.add_argument('--read-timeout', dest='read_timeout', type=float,
+                                  help='Seconds to wait for the server to respond - default no limit')
+    connection_group.add_argument('--deadline', dest='deadline',
+                                  help='Time limit for the whole command - e.g. 120s, 5m')
+    connection_group.add_argument('--retries', dest='retries', type=int,
+                                  help='Maximum number of retries of a failed read - default %s' % DEFAULT_RETRIES)
+    connection_group.add_argument('--no-retry', dest='no_retry', action='store_true',
+                                  help="Don't retry failed reads")
+    connection_group.add_argument('--hedge-percentile', dest='hedge_percentile', type=float,
+                                  help='Send a second copy of a read still running after this percentile of '
+                                       'its latency (e.g. 95) - default off')
+
+    # Upload group
+    upload_group = cmd_parser.add_argument_group('Upload')
+    upload_group.add_argument('--upload-workers', dest='upload_workers', type=int,
+                              help='Maximum number of package files uploaded concurrently - default %s'
+                                   % DEFAULT_WORKERS)
+    upload_group.add_argument('--verify-hash', dest='verify_hash', action='store_true',
+                              help='Only skip uploading a package already on the server if its SHA256 matches, '
+                                   'rather than its size')
+    upload_group.add_argument('--upload-stats', dest='upload_stats', nargs='?', const='text', choices=['text', 'json'],
+                              help='At the end of deploy and check, print upload throughput and the time in each '
+                                   'phase - as text or a single JSON line')
+
+    # Cache group
+    cache_group = cmd_parser.add_argument_group('Cache')
+    cache_group.add_argument('--cache-dir', dest='cache_dir',
+                             help='Local cache directory - default %s' % DEFAULT_CACHE_DIR)
+    cache_group.add_argument('--cache-size', dest='cache_size', type=int,
+                             help='Maximum size of the local cache in MB - default %s'
+                                  % (DEFAULT_CACHE_SIZE / (1024 * 1024)))
+    cache_group.add_argument('--no-cache', dest='no_cache', action='store_true',
+                             help="Don't use the local cache")
+
     # SSL auth group
     auth_group = cmd_parser.add_argument_group('SSL auth',
                                                'Provide client private key and CA signed client cert')
@@ -175,61 +285,98 @@ def create_cmd_parsers():
 def show_repos_cmd(url, args, key, cert, with_checks):
     """Print repositories to stdout."""
 
-    repos = get_api(args=args, url=url, key=key, cert=cert).get_published_repos()
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        repos = api.get_published_repos()
     view.show_repos(repos, args.json, with_checks)
 
 
 def show_distributions_cmd(url, args, key, cert, with_checks):
     """Print distributions to stdout."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
-    dists = api.list_distributions(public_repo_name=args.repo_name)
-    checks = []
-    if with_checks:
-        checks = api.list_checks(public_repo_name=args.repo_name)
-    view.show_distributions(api, args.repo_name, dists, checks, args.json)
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        dists = api.list_distributions(public_repo_name=args.repo_name)
+        checks = []
+        if with_checks:
+            checks = api.list_checks(public_repo_name=args.repo_name)
+        view.show_distributions(api, args.repo_name, dists, checks, args.json)
 
 
 def check_cmd(args, url, key, cert):
     """Check packages with reference to stable in a 'check' distribution."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
+    if args.plan and args.clean:
+        raise RaptlyError('--plan and --clean cannot be used together')
 
-    if args.clean:
-        api.check_clean(public_repo_name=args.repo_name)
-    else:
-        # Check the packages in private repo and re-publish
-        check_repo_public_name = api.check(public_repo_name=args.repo_name, package_files=args.package_files,
-                                           upload_dir=api.local_user, no_prune=args.no_prune)
-        view.show_distribution(api, False, False, check_repo_public_name, 'check')
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        if args.plan:
+            print(api.check_plan(public_repo_name=args.repo_name, package_files=args.package_files,
+                                 upload_dir=api.local_user, no_prune=args.no_prune).format())
+        elif args.clean:
+            api.check_clean(public_repo_name=args.repo_name)
+        else:
+            # Check the packages in private repo and re-publish
+            check_repo_public_name = api.check(public_repo_name=args.repo_name, package_files=args.package_files,
+                                               upload_dir=api.local_user, no_prune=args.no_prune)
+            view.show_distribution(api, False, False, check_repo_public_name, 'check')
+            if args.upload_stats:
+                print(api.upload_stats.format(args.upload_stats))
 
 
 def deploy_cmd(args, url, key, cert):
     """Deploy package to unstable distribution."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
+    if args.coalesce and args.no_publish:
+        raise RaptlyError('--coalesce and --no-publish cannot be used together')
+    if args.coalesce and args.plan:
+        raise RaptlyError('--coalesce and --plan cannot be used together')
+
+    if not args.package_files and args.no_publish:
+        print('No package files and --no-publish: nothing to do')
+        return
+
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        if args.plan:
+            print(api.deploy_plan(public_repo_name=args.repo_name, package_files=args.package_files,
+                                  gpg_public_key_id=args.gpg_key, upload_dir=api.local_user,
+                                  unstable_dist_name=args.distribution, publish=not args.no_publish).format())
+            return
+        if args.package_files and args.coalesce:
+            # Spool the packages, to be published along with those of concurrent deploys
+            api.deploy_coalesced(public_repo_name=args.repo_name, package_files=args.package_files,
+                                 gpg_public_key_id=args.gpg_key, unstable_dist_name=args.distribution)
+        else:
+            # Deploy the packages and re-publish - with no package files, just re-publish even if unchanged, e.g. to
+            # re-sign with another key
+            api.deploy(public_repo_name=args.repo_name, package_files=args.package_files,
+                       gpg_public_key_id=args.gpg_key, upload_dir=api.local_user,
+                       unstable_dist_name=args.distribution, publish=not args.no_publish)
+            if args.no_publish:
+                print('Packages added to repo %s - run publish-unstable to publish them' % args.repo_name)
+                return
+
+        view.show_distribution(api, False, False, args.repo_name, 'unstable')
+        if args.upload_stats:
+            print(api.upload_stats.format(args.upload_stats))
 
-    if args.package_files:
-        # Deploy the packages and re-publish
-        api.deploy(public_repo_name=args.repo_name, package_files=args.package_files, gpg_public_key_id=args.gpg_key,
-                   upload_dir=api.local_user, unstable_dist_name=args.distribution)
-    else:
-        # No package files, just re-publish
-        api.republish_unstable(unstable_dist_name=args.distribution, public_repo_name=args.repo_name,
-                               gpg_public_key_id=args.gpg_key, reason='deploy')
 
-    view.show_distribution(api, False, False, args.repo_name, 'unstable')
+def publish_unstable_cmd(args, url, key, cert):
+    """Snapshot the repo and publish the unstable distribution."""
+
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        api.republish_unstable(unstable_dist_name=args.distribution, public_repo_name=args.repo_name,
+                               gpg_public_key_id=args.gpg_key, reason='publish', force=args.force)
+        view.show_distribution(api, False, False, args.repo_name, args.distribution)
 
 
 def undeploy_cmd(args, url, key, cert):
     """Un-deploy a package from unstable distribution."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
-
     unstable_dist_name = 'unstable'
 
-    deleted_packages = api.undeploy(public_repo_name=args.repo_name, package_query=args.packages,
-                                    unstable_dist_name=unstable_dist_name, dry_run=args.dry_run)
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        deleted_packages = api.undeploy(public_repo_name=args.repo_name, package_query=args.packages,
+                                        unstable_dist_name=unstable_dist_name, dry_run=args.dry_run,
+                                        publish=not args.no_publish)
 
     if len(deleted_packages) <= 0:
         print("Query matched no packages: nothing to do")
@@ -246,50 +393,111 @@ def undeploy_cmd(args, url, key, cert):
 def test_cmd(args, url, key, cert):
     """Release package to testing distribution."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
-
     public_repo_name = args.repo_name
     release_id = args.release_id
     is_dry_run = args.dry_run
     no_prune = args.no_prune
 
-    union, new_packages, snapshot_release_candidate = api.test(public_repo_name=public_repo_name,
-                                                               package_query=args.packages,
-                                                               release_id=release_id,
-                                                               dry_run=is_dry_run,
-                                                               no_prune=no_prune)
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        if args.plan:
+            print(api.test_plan(public_repo_name=public_repo_name, package_query=args.packages, release_id=release_id,
+                                dry_run=is_dry_run, no_prune=no_prune).format())
+            return
+        union, new_packages, snapshot_release_candidate = api.test(public_repo_name=public_repo_name,
+                                                                   package_query=args.packages,
+                                                                   release_id=release_id,
+                                                                   dry_run=is_dry_run,
+                                                                   no_prune=no_prune)
 
-    view.show_test_cmd_output(api, is_dry_run, new_packages, public_repo_name, release_id,
-                              snapshot_release_candidate,
-                              union)
+        view.show_test_cmd_output(api, is_dry_run, new_packages, public_repo_name, release_id,
+                                  snapshot_release_candidate,
+                                  union)
 
 
 def stage_cmd(args, url, key, cert):
     """Release package to staging distribution."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
     public_repo_name = args.repo_name
     release_id = args.release_id
 
-    api.stage(public_repo_name=public_repo_name, testing_distribution_name='testing',
-              staging_distribution_name='staging', release_id=release_id)
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        if args.plan:
+            print(api.promote_plan(public_repo_name=public_repo_name, source_distribution_name='testing',
+                                   dest_distribution_name='staging', release_id=release_id).format())
+            return
+        api.stage(public_repo_name=public_repo_name, testing_distribution_name='testing',
+                  staging_distribution_name='staging', release_id=release_id)
 
-    print('Staged release %s:' % release_id)
-    view.show_distribution(api, False, False, public_repo_name, 'staging')
+        print('Staged release %s:' % release_id)
+        view.show_distribution(api, False, False, public_repo_name, 'staging')
 
 
 def release_cmd(args, url, key, cert):
     """Release package to stable distribution."""
 
-    api = get_api(args=args, url=url, key=key, cert=cert)
-    api.release(public_repo_name=args.repo_name, staging_distribution_name='staging',
-                stable_distribution_name='stable', release_id=args.release_id)
-    print('Released %s to stable:' % args.release_id)
-    view.show_distribution(api, False, False, args.repo_name, 'stable')
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        if args.plan:
+            print(api.promote_plan(public_repo_name=args.repo_name, source_distribution_name='staging',
+                                   dest_distribution_name='stable', release_id=args.release_id).format())
+            return
+        api.release(public_repo_name=args.repo_name, staging_distribution_name='staging',
+                    stable_distribution_name='stable', release_id=args.release_id)
+        print('Released %s to stable:' % args.release_id)
+        view.show_distribution(api, False, False, args.repo_name, 'stable')
+
+
+def train_cmd(args, url, key, cert):
+    """Run test, stage or release for many repos at once."""
+
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        if args.command == 'test-train':
+            outcomes = api.test_train(args.repo_names, package_query=args.packages, release_id=args.release_id,
+                                      dry_run=args.dry_run, no_prune=args.no_prune, fail_fast=args.fail_fast)
+            title = 'Test candidate %s%s' % (args.release_id, ' (dry run)' if args.dry_run else '')
+        elif args.command == 'stage-train':
+            outcomes = api.stage_train(args.repo_names, release_id=args.release_id, fail_fast=args.fail_fast)
+            title = 'Staged release %s' % args.release_id
+        else:
+            outcomes = api.release_train(args.repo_names, release_id=args.release_id, fail_fast=args.fail_fast)
+            title = 'Released %s to stable' % args.release_id
+
+    view.show_train(title, outcomes)
+    failures = len([outcome for outcome in outcomes if outcome['status'] != 'ok'])
+    if failures:
+        raise RaptlyError('%s of %s repos not done' % (failures, len(outcomes)))
 
 
 def get_api(args, url, key, cert):
-    return AptlyApi(repo_url=url.rstrip("/"), verbose=args.verbose, skip_ssl=args.skip_ssl, user=args.user, key=key, cert=cert)
+    workers = default_if_none(args.workers, DEFAULT_WORKERS)
+    upload_workers = default_if_none(args.upload_workers, DEFAULT_WORKERS)
+    if workers < 1 or upload_workers < 1:
+        raise RaptlyError('--workers and --upload-workers must be at least 1')
+    cache_dir = None if args.no_cache else args.cache_dir or DEFAULT_CACHE_DIR
+    cache_size = args.cache_size * 1024 * 1024 if args.cache_size else DEFAULT_CACHE_SIZE
+    return AptlyApi(repo_url=url.rstrip("/"), verbose=args.verbose, skip_ssl=args.skip_ssl, user=args.user, key=key,
+                    cert=cert, pool_size=args.pool_size or DEFAULT_POOL_SIZE, keep_alive=not args.no_keep_alive,
+                    cache_dir=cache_dir, cache_size=cache_size, workers=workers,
+                    connect_timeout=default_if_none(args.connect_timeout, DEFAULT_CONNECT_TIMEOUT),
+                    read_timeout=args.read_timeout,
+                    deadline=parse_duration(args.deadline) if args.deadline else None,
+                    retries=0 if args.no_retry else default_if_none(args.retries, DEFAULT_RETRIES),
+                    hedge_percentile=args.hedge_percentile, upload_workers=upload_workers,
+                    verify_hash=args.verify_hash)
+
+
+def default_if_none(value, default):
+    """Return value, or default if value is None - unlike `value or default`, an explicit 0 is kept"""
+    return default if value is None else value
+
+
+def parse_duration(duration):
+    """Parse a duration such as 90, 120s, 5m or 1h into seconds.
+    :raises RaptlyError: If the duration is not valid
+    """
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([smh]?)\s*$', str(duration))
+    if not match:
+        raise RaptlyError('Invalid duration: %s' % duration)
+    return float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
 
 
 def version_cmd(args, url, key, cert):
@@ -301,7 +509,8 @@ def version_cmd(args, url, key, cert):
 
     # Try to get the server version
     try:
-        version = get_api(args=args, url=url, key=key, cert=cert).version()
+        with get_api(args=args, url=url, key=key, cert=cert) as api:
+            version = api.version()
         if args.json:
             print json.dumps(version)
         else:
@@ -314,8 +523,8 @@ def create_cmd(args, url, key, cert):
     """Create a repository
     :param args: Command line arguments.
     """
-    api = get_api(args=args, url=url, key=key, cert=cert)
-    api.create(public_repo_name=args.repo_name, unstable_distribution_name='unstable')
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        api.create(public_repo_name=args.repo_name, unstable_distribution_name='unstable')
 
 
 def run_remote_cmd(args):
@@ -335,6 +544,10 @@ def run_remote_cmd(args):
         print('Please set Aptly server URL in the config file ~/.raptly/config or by using --url option')
         return
 
+    # Connection and cache settings may also come from the config file
+    for param_name in CONFIG_PARAMS:
+        setattr(args, param_name, get_param_value(param_name, args, config))
+
     if args.command == 'show':
         show_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'create':
@@ -343,12 +556,16 @@ def run_remote_cmd(args):
         check_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'deploy':
         deploy_cmd(args=args, url=url, key=key, cert=cert)
+    if args.command == 'publish-unstable':
+        publish_unstable_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'undeploy':
         undeploy_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'test':
         test_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'stage':
         stage_cmd(args=args, url=url, key=key, cert=cert)
+    if args.command in ('test-train', 'stage-train', 'release-train'):
+        train_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'release':
         release_cmd(args=args, url=url, key=key, cert=cert)
     if args.command == 'version':
@@ -374,22 +591,24 @@ def show_cmd(url, args, key=None, cert=None):
         return
 
     # If both repo name and a distribution name are specified show the whole works
-    api = get_api(args=args, url=url, key=key, cert=cert)
-    view.show_distribution(api, args.prune, args.json, public_repo_name=args.repo_name,
-                           distribution=args.distribution)
+    with get_api(args=args, url=url, key=key, cert=cert) as api:
+        view.show_distribution(api, args.prune, args.json, public_repo_name=args.repo_name,
+                               distribution=args.distribution)
 
 
 def get_param_value(param_name, args, config):
     """Get value of a named command parameter either from args or from config.
     """
     param_val = None
-    # If param_name is available in config use it
-    if config and config.get('default', None) and config['default'].get(param_name, None):
+    # If param_name is available in config use it - even if it is 0 or false
+    if config and config.get('default', None) and config['default'].get(param_name, None) is not None:
         param_val = config['default'][param_name]
 
-    # If param_name option is available in args, override the value from config
-    if args and vars(args)[param_name]:
-        param_val = vars(args)[param_name]
+    # If param_name option is available in args, override the value from config.  A flag that isn't given is
+    # False, which mustn't override a flag set in config.
+    arg_val = vars(args)[param_name] if args else None
+    if arg_val is not None and arg_val is not False:
+        param_val = arg_val
 
     return param_val
 
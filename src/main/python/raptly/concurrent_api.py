@@ -0,0 +1,99 @@
+"""
+Concurrent counterpart of AptlyApi for driving many repositories at once from an orchestrator.
+
+Operations run on a bounded thread pool and each call returns a multiprocessing.pool.AsyncResult (with ready(),
+wait() and get() methods).  These are not coroutines: raptly targets Python 2.7, which has no asyncio, so they
+can't be awaited in an event loop.  All operations share the single AptlyApi instance and therefore its pool of
+keep-alive connections and its per-invocation listing memo.
+"""
+from multiprocessing.pool import ThreadPool
+
+from parallel import DEFAULT_WORKERS
+
+
+class ConcurrentAptlyApi:
+    """Run AptlyApi workflow operations concurrently, at most max_concurrency at a time.  Each operation runs its
+    own plan one step at a time, so at most max_concurrency calls are in flight - which should not exceed the
+    pool_size of the AptlyApi.
+
+    Example:
+
+        with ConcurrentAptlyApi(AptlyApi(url, pool_size=8), max_concurrency=8) as concurrent_api:
+            results = [concurrent_api.stage(repo, 'testing', 'staging', 'TKT-123') for repo in repos]
+            for result in results:
+                result.get()
+    """
+
+    def __init__(self, api, max_concurrency=DEFAULT_WORKERS):
+        """
+        :param api: The AptlyApi instance to share between all operations
+        :param max_concurrency: Maximum number of operations running at once
+        """
+        self.api = api
+        self.pool = ThreadPool(max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Wait for submitted operations to finish, then close the shared connections."""
+        self.pool.close()
+        self.pool.join()
+        self.api.close()
+
+    def submit(self, func, *args, **kwargs):
+        """Run any function (e.g. an AptlyApi method) on the pool.
+        :return: AsyncResult of the call, whose get() re-raises any exception raised by the function
+        """
+        return self.pool.apply_async(self.run_single_worker, (func,) + args, kwargs)
+
+    def run_single_worker(self, func, *args, **kwargs):
+        with self.api.single_worker():
+            return func(*args, **kwargs)
+
+    def deploy(self, *args, **kwargs):
+        """See AptlyApi.deploy"""
+        return self.submit(self.api.deploy, *args, **kwargs)
+
+    def undeploy(self, *args, **kwargs):
+        """See AptlyApi.undeploy"""
+        return self.submit(self.api.undeploy, *args, **kwargs)
+
+    def republish_unstable(self, *args, **kwargs):
+        """See AptlyApi.republish_unstable"""
+        return self.submit(self.api.republish_unstable, *args, **kwargs)
+
+    def check(self, *args, **kwargs):
+        """See AptlyApi.check"""
+        return self.submit(self.api.check, *args, **kwargs)
+
+    def test(self, *args, **kwargs):
+        """See AptlyApi.test"""
+        return self.submit(self.api.test, *args, **kwargs)
+
+    def stage(self, *args, **kwargs):
+        """See AptlyApi.stage"""
+        return self.submit(self.api.stage, *args, **kwargs)
+
+    def release(self, *args, **kwargs):
+        """See AptlyApi.release"""
+        return self.submit(self.api.release, *args, **kwargs)
+
+    def get_published_repos(self):
+        """See AptlyApi.get_published_repos"""
+        return self.submit(self.api.get_published_repos)
+
+    def list_distributions(self, *args, **kwargs):
+        """See AptlyApi.list_distributions"""
+        return self.submit(self.api.list_distributions, *args, **kwargs)
+
+    def find_publication(self, *args, **kwargs):
+        """See AptlyApi.find_publication"""
+        return self.submit(self.api.find_publication, *args, **kwargs)
+
+    def pkg_list(self, *args, **kwargs):
+        """See AptlyApi.pkg_list"""
+        return self.submit(self.api.pkg_list, *args, **kwargs)
@@ -0,0 +1,283 @@
+"""
+Methods for reading the identity of local Debian package (.deb) files without unpacking them.
+
+Only the ar headers and the start of the control archive are read - typically a few KB, however large the
+package - and the control tarball is decompressed as a stream: gzip and uncompressed always, xz with the lzma
+module (or backports.lzma) if installed, otherwise by piping through the xz command.
+"""
+import bz2
+import hashlib
+import os
+import subprocess
+import zlib
+
+from parallel import map_ordered, DEFAULT_WORKERS
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_SIZE = 60
+CHUNK_SIZE = 64 * 1024
+CONTROL_CHUNK_SIZE = 4 * 1024
+TAR_BLOCK_SIZE = 512
+
+
+def iter_ar_members(deb):
+    """Generate (name, size) for each member of an ar archive, leaving the file positioned at the member's data.
+    Data not read by the caller is skipped.
+    :param deb: Binary file object of the archive
+    :raises ValueError: If the file is not an ar archive
+    """
+    if deb.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError('Not a Debian package: %s' % getattr(deb, 'name', deb))
+    offset = len(AR_MAGIC)
+    while True:
+        deb.seek(offset)
+        header = deb.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+        name = header[:16].strip().rstrip('/')
+        size = int(header[48:58].strip())
+        yield name, size
+        # Members are padded to an even offset
+        offset += AR_HEADER_SIZE + size + size % 2
+
+
+def parse_control(text):
+    """Parse the fields of a Debian control file into a dict.  Continuation lines are joined to their field."""
+    fields = {}
+    field = None
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and field:
+            fields[field] += '\n' + line.strip()
+        elif ':' in line:
+            field, value = line.split(':', 1)
+            field = field.strip()
+            fields[field] = value.strip()
+    return fields
+
+
+def read_control(deb_file):
+    """Return the control fields (Package, Version, Architecture etc.) of a .deb file.
+    :param deb_file: Local file name of the package
+    :raises IOError: If the file does not exist
+    :raises ValueError: If the file is not a Debian package or its control archive can't be read
+    """
+    with open(deb_file, 'rb') as deb:
+        return read_control_from(deb)
+
+
+def read_control_from(deb):
+    """Return the control fields of a .deb read from a file object, reading no further than the control file.
+    :param deb: Binary, seekable, file object of the package
+    :raises ValueError: If the file is not a Debian package or its control archive can't be read
+    """
+    name = getattr(deb, 'name', 'package')
+    for member_name, size in iter_ar_members(deb):
+        if member_name.startswith('control.tar'):
+            chunks = decompress(member_name, iter_chunks(deb, size, CONTROL_CHUNK_SIZE))
+            control = find_tar_member(chunks, 'control')
+            if control is None:
+                raise ValueError('No control file in %s' % name)
+            return parse_control(control)
+    raise ValueError('No control archive in %s' % name)
+
+
+def iter_chunks(f, size, chunk_size):
+    """Generate the next size bytes of a file in chunks of at most chunk_size"""
+    while size > 0:
+        chunk = f.read(min(size, chunk_size))
+        if not chunk:
+            raise ValueError('Truncated archive member')
+        size -= len(chunk)
+        yield chunk
+
+
+def decompress(member_name, chunks):
+    """Generate the decompressed data of an archive member from its chunks, by the member name's extension.
+    :raises ValueError: If the compression isn't supported
+    """
+    extension = os.path.splitext(member_name)[1]
+    if extension == '.tar':
+        return chunks
+    if extension == '.gz':
+        return iter_decompressed(zlib.decompressobj(16 + zlib.MAX_WBITS), chunks)
+    if extension == '.bz2':
+        return iter_decompressed(bz2.BZ2Decompressor(), chunks)
+    if extension == '.xz':
+        if lzma is not None:
+            return iter_decompressed(lzma.LZMADecompressor(), chunks)
+        return iter_xz_command(chunks)
+    raise ValueError('Unsupported compression of %s' % member_name)
+
+
+def iter_decompressed(decompressor, chunks):
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+
+def iter_xz_command(chunks):
+    """Decompress xz data with the xz command - for when no lzma module is installed"""
+    try:
+        xz = subprocess.Popen(['xz', '--decompress', '--stdout'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+    except OSError:
+        raise ValueError('Reading xz compressed packages needs the lzma module (backports.lzma) or xz command')
+    out, err = xz.communicate(''.join(chunks))
+    if xz.returncode != 0:
+        raise ValueError('xz failed: %s' % err.strip())
+    yield out
+
+
+class ChunkReader:
+    """Read exact numbers of bytes from a stream of chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+
+    def read(self, size):
+        """Read size bytes, or fewer at the end of the stream"""
+        while len(self.buf) < size:
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                break
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def find_tar_member(chunks, wanted):
+    """Return the content of the regular file named wanted (with or without a leading './') in a tar stream,
+    stopping as soon as it has been read, or None if there is no such file.
+    :param chunks: Iterable of chunks of the uncompressed tar archive
+    """
+    reader = ChunkReader(chunks)
+    long_name = None
+    while True:
+        header = reader.read(TAR_BLOCK_SIZE)
+        if len(header) < TAR_BLOCK_SIZE or header == '\0' * TAR_BLOCK_SIZE:
+            return None
+        name = header[:100].rstrip('\0')
+        if header[257:262] == 'ustar' and header[345:500].strip('\0'):
+            name = '%s/%s' % (header[345:500].rstrip('\0'), name)
+        try:
+            size = int(header[124:136].strip('\0 ') or '0', 8)
+        except ValueError:
+            raise ValueError('Invalid tar header')
+        type_flag = header[156]
+        padded_size = size + (-size % TAR_BLOCK_SIZE)
+        if type_flag == 'L':
+            # GNU long name of the next member
+            long_name = reader.read(padded_size)[:size].rstrip('\0')
+            continue
+        if long_name is not None:
+            name, long_name = long_name, None
+        if name.startswith('./'):
+            name = name[2:]
+        if name == wanted and type_flag in ('0', '\0'):
+            content = reader.read(size)
+            if len(content) < size:
+                raise ValueError('Truncated tar member %s' % name)
+            return content
+        reader.read(padded_size)
+
+
+def package_identity(deb_file, file_cache=None):
+    """Return the identity of a .deb file as the start of an aptly package ref - 'P<arch> <name> <version>'.
+    :param file_cache: Optional FileInfoCache
+    :raises ValueError: If the file is not a Debian package
+    """
+    return inspect_deb(deb_file, file_cache)['Identity']
+
+
+def inspect_deb(deb_file, file_cache=None):
+    """Return the control fields of a .deb file along with its 'Filename', 'Size' and 'Identity', the start of
+    its aptly package ref - 'P<arch> <name> <version>'.
+    :param deb_file: Local file name of the package
+    :param file_cache: Optional FileInfoCache of control fields read on previous runs
+    :raises IOError: If the file does not exist
+    :raises ValueError: If the file is not a Debian package
+    """
+    stat = stat_file(deb_file)
+    cached = file_cache.get(deb_file, stat) if file_cache is not None else {}
+    if 'control' in cached:
+        info = cached['control']
+    else:
+        info = read_control(deb_file)
+        if file_cache is not None:
+            file_cache.update(deb_file, stat, control=info)
+    info['Filename'] = deb_file
+    info['Size'] = stat.st_size
+    try:
+        info['Identity'] = 'P%s %s %s' % (info['Architecture'], info['Package'], info['Version'])
+    except KeyError as e:
+        raise ValueError('No %s field in control file of %s' % (e.args[0], deb_file))
+    return info
+
+
+def inspect_debs(deb_files, max_workers=DEFAULT_WORKERS, file_cache=None):
+    """Inspect many .deb files in parallel.  Files that can't be read are reported rather than raised.
+    :param deb_files: List of .deb file names
+    :param max_workers: Maximum number of files read at once
+    :param file_cache: Optional FileInfoCache
+    :return: List, in the order of deb_files, of dicts with keys 'file', 'info' (see inspect_deb) and 'error'
+    """
+    def inspect(deb_file):
+        try:
+            return {'file': deb_file, 'info': inspect_deb(deb_file, file_cache), 'error': None}
+        except (IOError, ValueError) as e:
+            return {'file': deb_file, 'info': None, 'error': str(e)}
+    return map_ordered(inspect, deb_files, max_workers)
+
+
+def inspect_directory(directory, max_workers=DEFAULT_WORKERS, file_cache=None):
+    """Inspect all the .deb files in a directory in parallel.
+    :return: See inspect_debs, in file name order
+    """
+    deb_files = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.deb'))
+    return inspect_debs(deb_files, max_workers, file_cache)
+
+
+def ref_identity(package_ref):
+    """Return the identity part of an aptly package ref, i.e. without the files hash - 'P<arch> <name> <version>'"""
+    return ' '.join(package_ref.split()[:3])
+
+
+def file_checksums(file_name, file_cache=None):
+    """Return the SHA256 and MD5 hex digests of a file, read once in chunks, as a dict with keys 'sha256' and 'md5'.
+    :param file_name: Local file name
+    :param file_cache: Optional FileInfoCache - checksums of a file unchanged since a previous run are not recomputed
+    :raises IOError: If the file does not exist
+    """
+    stat = stat_file(file_name)
+    cached = file_cache.get(file_name, stat) if file_cache is not None else {}
+    if 'sha256' in cached and 'md5' in cached:
+        return {'sha256': cached['sha256'], 'md5': cached['md5']}
+
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha256.update(chunk)
+            md5.update(chunk)
+    checksums = {'sha256': sha256.hexdigest(), 'md5': md5.hexdigest()}
+    if file_cache is not None:
+        file_cache.update(file_name, stat, **checksums)
+    return checksums
+
+
+def stat_file(file_name):
+    """os.stat a file, raising IOError like open() if it does not exist"""
+    try:
+        return os.stat(file_name)
+    except OSError as e:
+        raise IOError(e.errno, e.strerror, file_name)
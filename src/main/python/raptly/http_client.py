@@ -0,0 +1,393 @@
+"""
+Pooled HTTP transport used by AptlyApi to talk to the aptly REST API
+"""
+import collections
+import random
+import threading
+import time
+import urlparse
+from Queue import Queue, Empty
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from parallel import current_step
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.2
+MAX_BACKOFF = 5.0
+# Responses to a GET worth retrying - typically aptly busy behind a proxy during a long publish
+RETRY_STATUSES = (429, 502, 503, 504)
+# Latency samples kept per endpoint, and needed before hedging is attempted
+LATENCY_SAMPLES = 1000
+MIN_HEDGE_SAMPLES = 20
+
+# Path segments of aptly API URLs that name the endpoint rather than a repo, snapshot, file etc.
+ENDPOINT_SEGMENTS = ('version', 'repos', 'snapshots', 'publish', 'files', 'packages', 'file', 'diff')
+
+
+def endpoint_name(base_url, method, url):
+    """Name the API endpoint of a request, with the names of repos, snapshots etc. replaced by '*' -
+    e.g. 'GET /snapshots/*/packages'.
+    :param base_url: The base API url (e.g. https://repo.hogarthww.com/aptly/api)
+    :param method: The HTTP method
+    :param url: The request URL
+    """
+    path = urlparse.urlsplit(url[len(base_url):] if url.startswith(base_url) else url).path
+    segments = [segment if segment in ENDPOINT_SEGMENTS else '*' for segment in path.split('/') if segment]
+    return '%s /%s' % (method, '/'.join(segments))
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a command runs out of time before or during a request"""
+
+    def __init__(self, deadline, step):
+        """
+        :param deadline: The command deadline in seconds
+        :param step: Description of the workflow step and request that were running, or about to run, when time
+        ran out - see describe_request
+        """
+        self.value = 'Deadline of %ss exceeded during %s' % (deadline, step)
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def describe_request(method, url):
+    """Describe a request for error messages, naming the workflow step it is made for, if any - e.g.
+    'deploy a4pizza/base: upload (POST https://repo.hogarthww.com/aptly/api/files/root.45fc5653)'
+    """
+    step = current_step()
+    return '%s (%s %s)' % (step, method, url) if step else '%s %s' % (method, url)
+
+
+def percentile(samples, p):
+    """Return the p'th percentile (nearest rank) of a sequence of numbers, or None if it is empty"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF, cap=MAX_BACKOFF):
+    """Exponential backoff with full jitter: a random delay up to base * 2^attempt seconds, at most cap"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Counter:
+    """Thread safe counter"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.value += 1
+
+
+def counting_connection_cls(connection_cls, counter):
+    """Return a subclass of the connection class that counts every new socket connection it opens."""
+
+    class CountingConnection(connection_cls):
+        def connect(self):
+            counter.increment()
+            return connection_cls.connect(self)
+
+    return CountingConnection
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools count the connections (and so the TCP/TLS handshakes) they open."""
+
+    def __init__(self, counter, **kwargs):
+        self.counter = counter
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        pool_classes = {}
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            pool_classes[scheme] = type('Counting%s' % pool_cls.__name__, (pool_cls,), {
+                'ConnectionCls': counting_connection_cls(pool_cls.ConnectionCls, self.counter)})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+
+class HttpClient:
+    """Wraps a requests.Session so that every call made during a raptly command re-uses the same pool of
+    keep-alive connections, avoiding a new TCP connect and TLS handshake per request."""
+
+    def __init__(self, auth=None, cert=None, verify=True, pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                 session=None, base_url='', connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=None,
+                 deadline=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, hedge_percentile=None):
+        """
+        :param auth: Requests auth object (e.g. HTTPBasicAuth)
+        :param cert: Client (cert, key) tuple
+        :param verify: Whether to verify the server SSL certificate
+        :param pool_size: Maximum number of pooled connections kept open per host
+        :param keep_alive: If False, ask the server to close each connection after use
+        :param session: Optional pre-built session (or compatible transport) to use instead of a new one
+        :param base_url: The base API url, used to name endpoints in transfer stats
+        :param connect_timeout: Seconds to wait for a connection to the server, or None to wait forever
+        :param read_timeout: Seconds to wait for the server to send data, or None to wait forever
+        :param deadline: Seconds from now within which every request must complete, or None for no deadline
+        :param retries: Maximum number of times a failed GET is retried.  Other methods are never retried.
+        :param backoff: Base delay in seconds of the jittered exponential backoff between retries
+        :param hedge_percentile: If set (e.g. 95), a GET still running after this percentile of its endpoint's
+        latency is raced against a second identical request and the first response used
+        """
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.deadline_time = time.time() + deadline if deadline is not None else None
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        # Recent latencies per endpoint, and counts of retries, hedged requests and the discarded responses of
+        # hedged requests
+        self.latencies = {}
+        self.latency_counts = {}
+        self.latencies_lock = threading.Lock()
+        self.requests = Counter()
+        self.connections = Counter()
+        # Bytes received (compressed) and decoded per endpoint
+        self.transfers = {}
+        self.transfers_lock = threading.Lock()
+        self.session = session if session is not None else requests.Session()
+        self.session.auth = auth
+        self.session.cert = cert
+        self.session.verify = verify
+        if session is None:
+            adapter = CountingAdapter(self.connections, pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        # Package listings are highly repetitive and compress well
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Make a request.  Unless stream=True, the response body is read and its transfer recorded.
+        GETs, being idempotent, are retried on connection errors, timeouts and RETRY_STATUSES responses, and
+        may be hedged.  The last response is returned once retries are exhausted.
+        """
+        endpoint = endpoint_name(self.base_url, method, url)
+        step = describe_request(method, url)
+        start = time.time()
+        attempt = 0
+        while True:
+            try:
+                if method == 'GET' and self.hedge_percentile and not kwargs.get('stream'):
+                    r = self.hedged_request(endpoint, method, url, step, **kwargs)
+                else:
+                    r = self.single_request(method, url, step, **kwargs)
+                if method != 'GET' or r.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    break
+                delay = self.retry_delay(attempt, r)
+                # Return the connection of a streamed response to the pool before trying again
+                r.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if method != 'GET' or attempt >= self.retries:
+                    raise
+                delay = self.retry_delay(attempt)
+            if self.remaining() is not None and delay >= self.remaining():
+                # Not enough time left to wait and try again - fail now with the step that ran out of time
+                raise DeadlineExceeded(self.deadline, step)
+            attempt += 1
+            self.count_latency(endpoint, 'retries')
+            time.sleep(delay)
+        self.record_latency(endpoint, time.time() - start)
+        return r
+
+    def single_request(self, method, url, step, **kwargs):
+        """Make one attempt at a request, within the deadline.
+        :param step: Description of the request, for errors - see describe_request
+        """
+        self.requests.increment()
+        timeout = self.timeout(step)
+        try:
+            r = self.session.request(method, url, timeout=timeout, **kwargs)
+            if not kwargs.get('stream'):
+                self.record_transfer(r, len(r.content))
+        except requests.exceptions.Timeout:
+            if self.remaining() is not None and self.remaining() <= 0:
+                raise DeadlineExceeded(self.deadline, step)
+            raise
+        return r
+
+    def hedged_request(self, endpoint, method, url, step, **kwargs):
+        """Make a request and, if it has not completed within the hedge percentile of the endpoint's latency,
+        a second identical one.  The first successful response is returned; the other request is left to finish
+        in the background, then its response is closed - returning its connection to the pool - and counted as
+        discarded.
+        """
+        threshold = self.hedge_threshold(endpoint)
+        if threshold is None:
+            return self.single_request(method, url, step, **kwargs)
+
+        results = Queue()
+
+        def attempt():
+            try:
+                results.put((self.single_request(method, url, step, **kwargs), None))
+            except Exception as e:
+                results.put((None, e))
+
+        def start():
+            thread = threading.Thread(target=attempt)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        pending = 1
+        try:
+            r, error = results.get(timeout=threshold)
+            pending -= 1
+        except Empty:
+            self.count_latency(endpoint, 'hedged')
+            start()
+            pending += 1
+            r, error = results.get()
+            pending -= 1
+        # Prefer a good response from the other request if the first to finish failed
+        if pending and (error is not None or r.status_code in RETRY_STATUSES):
+            self.discard(endpoint, r)
+            r, error = results.get()
+            pending -= 1
+        if pending:
+            discarder = threading.Thread(target=lambda: self.discard(endpoint, results.get()[0]))
+            discarder.daemon = True
+            discarder.start()
+        if error is not None:
+            raise error
+        return r
+
+    def discard(self, endpoint, r):
+        """Close the response, if any, of a hedged request that lost, and count it."""
+        if r is not None:
+            r.close()
+        self.count_latency(endpoint, 'discarded')
+
+    def hedge_threshold(self, endpoint):
+        """Seconds to wait before hedging a request to the endpoint, or None until enough latencies are known"""
+        with self.latencies_lock:
+            samples = list(self.latencies.get(endpoint, ()))
+        if len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        threshold = percentile(samples, self.hedge_percentile)
+        remaining = self.remaining()
+        return min(threshold, remaining) if remaining is not None else threshold
+
+    def retry_delay(self, attempt, r=None):
+        """Backoff before retry number attempt + 1, honouring any Retry-After (in seconds) sent by the server"""
+        delay = backoff_delay(attempt, self.backoff)
+        retry_after = r.headers.get('Retry-After') if r is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), MAX_BACKOFF))
+        return delay
+
+    def record_latency(self, endpoint, latency):
+        """Record the time taken, including any retries, to complete a request to the endpoint"""
+        with self.latencies_lock:
+            self.latencies.setdefault(endpoint, collections.deque(maxlen=LATENCY_SAMPLES)).append(latency)
+        self.count_latency(endpoint, 'requests')
+
+    def count_latency(self, endpoint, name):
+        with self.latencies_lock:
+            counts = self.latency_counts.setdefault(endpoint, {'requests': 0, 'retries': 0, 'hedged': 0,
+                                                               'discarded': 0})
+            counts[name] += 1
+
+    def latency_stats(self):
+        """Return the per-endpoint latency stats: {endpoint: {requests, retries, hedged, discarded, p50, p99, max}},
+        latencies being in seconds
+        """
+        with self.latencies_lock:
+            stats = {}
+            for endpoint, counts in self.latency_counts.items():
+                samples = list(self.latencies.get(endpoint, ()))
+                stats[endpoint] = dict(counts, p50=percentile(samples, 50), p99=percentile(samples, 99),
+                                       max=max(samples) if samples else None)
+            return stats
+
+    def remaining(self):
+        """Seconds left before the deadline, or None if there is no deadline"""
+        if self.deadline_time is None:
+            return None
+        return self.deadline_time - time.time()
+
+    def timeout(self, step):
+        """Return the (connect, read) timeout for the next request, limited by the time left before the deadline.
+        :param step: Description of the request about to be made
+        :raises DeadlineExceeded: If there is no time left
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return self.connect_timeout, self.read_timeout
+        if remaining <= 0:
+            raise DeadlineExceeded(self.deadline, step)
+        return (min(self.connect_timeout, remaining) if self.connect_timeout is not None else remaining,
+                min(self.read_timeout, remaining) if self.read_timeout is not None else remaining)
+
+    def iter_content(self, r, chunk_size):
+        """Generate the decompressed content of a streamed response, recording its transfer once fully read.
+        :param r: Response of a request made with stream=True
+        :param chunk_size: Size of the chunks to read
+        :raises DeadlineExceeded: If the deadline passes before the response has been read
+        """
+        decoded = 0
+        for chunk in r.iter_content(chunk_size):
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                r.close()
+                raise DeadlineExceeded(self.deadline, describe_request(r.request.method if r.request else 'GET',
+                                                                       r.url))
+            decoded += len(chunk)
+            yield chunk
+        self.record_transfer(r, decoded)
+
+    def record_transfer(self, r, decoded):
+        """Record the bytes received over the wire and after decompression for the endpoint of the response.
+        :param r: A fully read response
+        :param decoded: The size of the decompressed response body
+        """
+        tell = getattr(r.raw, 'tell', None)
+        received = tell() if tell is not None else decoded
+        endpoint = endpoint_name(self.base_url, r.request.method if r.request else '', r.url or '')
+        with self.transfers_lock:
+            stats = self.transfers.setdefault(endpoint, {'responses': 0, 'received': 0, 'decoded': 0})
+            stats['responses'] += 1
+            stats['received'] += received
+            stats['decoded'] += decoded
+
+    def transfer_stats(self):
+        """Return a copy of the per-endpoint transfer stats: {endpoint: {responses, received, decoded}}"""
+        with self.transfers_lock:
+            return dict((endpoint, dict(stats)) for endpoint, stats in self.transfers.items())
+
+    def connection_stats(self):
+        """Return the number of requests made and the number of connections opened and re-used to make them.
+        :return: Dict with keys 'requests', 'opened' and 'reused'
+        """
+        return {'requests': self.requests.value,
+                'opened': self.connections.value,
+                'reused': max(self.requests.value - self.connections.value, 0)}
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
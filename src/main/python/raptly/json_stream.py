@@ -0,0 +1,48 @@
+"""
+Incremental decoding of JSON arrays, such as aptly package listings, from a stream of chunks
+"""
+import json
+import re
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(chunks):
+    """Decode a JSON array read as a sequence of string chunks, yielding each element as soon as it is complete.
+    Only the current, partially received, element is held in memory - never the whole array.
+    :param chunks: Iterable of string chunks of the JSON text (e.g. response.iter_content())
+    :raises ValueError: If the text is not a JSON array or is truncated
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    started = False
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected JSON array but found: %r' % buf[pos:pos + 20])
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Element incomplete - wait for more data
+                break
+            # A number at the very end of the buffer may continue in the next chunk
+            if WHITESPACE.match(buf, end).end() == len(buf):
+                break
+            yield value
+            pos = end
+        buf = buf[pos:]
+    raise ValueError('Truncated JSON array')
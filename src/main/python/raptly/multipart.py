@@ -0,0 +1,105 @@
+"""
+Streaming multipart/form-data encoding of package files for upload to the aptly server
+"""
+import errno
+import os
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartFileEncoder:
+    """File-like multipart/form-data body that reads each file in chunks as the request is sent.
+
+    Only one file is open at a time and it is closed as soon as it has been read, so memory use stays flat
+    however large the files are.  The total length is known in advance so the request is sent with a
+    Content-Length rather than chunked.
+    """
+
+    def __init__(self, file_names, field_name='file', boundary=None, progress=None):
+        """
+        :param file_names: List of local file names to encode
+        :param field_name: Form field name of each file
+        :param boundary: Multipart boundary - generated if not given
+        :param progress: Optional function called with the number of bytes each time some of the body is read
+        :raises IOError: If any of the files does not exist
+        """
+        self.boundary = boundary or uuid.uuid4().hex
+        self.progress = progress
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        # Sequence of parts, each either a string or the name of a file to stream
+        self.parts = []
+        self.length = 0
+        for file_name in file_names:
+            if not os.path.isfile(file_name):
+                raise IOError(errno.ENOENT, 'No such file or directory', file_name)
+            header = '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' \
+                     'Content-Type: application/octet-stream\r\n\r\n' \
+                     % (self.boundary, field_name, os.path.basename(file_name))
+            self.add_part(header, len(header))
+            self.add_part(file_name, os.path.getsize(file_name), is_file=True)
+            self.add_part('\r\n', 2)
+        trailer = '--%s--\r\n' % self.boundary
+        self.add_part(trailer, len(trailer))
+        self.current = None
+        self.remaining = ''
+
+    def add_part(self, part, size, is_file=False):
+        self.parts.append((part, is_file))
+        self.length += size
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body, or the rest of it if size is negative.
+        :return: The bytes read, or '' at the end of the body
+        """
+        chunks = []
+        wanted = size
+        while wanted != 0:
+            chunk = self.read_part(wanted)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if wanted > 0:
+                wanted -= len(chunk)
+        data = ''.join(chunks)
+        if self.progress is not None and data:
+            self.progress(len(data))
+        return data
+
+    def read_part(self, size):
+        """Read up to size bytes from the current part, moving to the next part when it is exhausted."""
+        while True:
+            if self.current is not None:
+                chunk = self.current.read(size if size > 0 else CHUNK_SIZE)
+                if chunk:
+                    return chunk
+                self.current.close()
+                self.current = None
+            elif self.remaining:
+                if size < 0:
+                    size = len(self.remaining)
+                chunk, self.remaining = self.remaining[:size], self.remaining[size:]
+                return chunk
+            if not self.parts:
+                return ''
+            part, is_file = self.parts.pop(0)
+            if is_file:
+                self.current = open(part, 'rb')
+            else:
+                self.remaining = part
+
+    def close(self):
+        """Close the file being read, if any - e.g. if the upload was abandoned part way through."""
+        if self.current is not None:
+            self.current.close()
+            self.current = None
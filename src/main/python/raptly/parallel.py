@@ -0,0 +1,91 @@
+"""
+Bounded concurrency helpers for running independent aptly API calls at the same time
+"""
+import sys
+import threading
+from contextlib import contextmanager
+from Queue import Queue, Empty
+
+DEFAULT_WORKERS = 4
+
+# The workflow step each thread is running - see running_step
+steps = threading.local()
+
+
+@contextmanager
+def running_step(name):
+    """Context manager naming the workflow step (e.g. 'deploy a4pizza/base: upload') that the current thread runs
+    within it, so that errors such as running out of time can say which step failed.
+    :param name: The name of the step, or None to leave the current one
+    """
+    outer = current_step()
+    steps.name = name or outer
+    try:
+        yield
+    finally:
+        steps.name = outer
+
+
+def current_step():
+    """Return the name of the workflow step the current thread is running, or None"""
+    return getattr(steps, 'name', None)
+
+
+def map_ordered(func, items, max_workers=DEFAULT_WORKERS):
+    """Apply func to every item using at most max_workers threads and return the results in the order of items.
+    The first exception raised by func cancels every call not yet started and is re-raised once the calls
+    already in flight have finished.
+    :param func: Function of one argument
+    :param items: The items to apply func to
+    :param max_workers: Maximum number of concurrent calls
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    # The workers carry on the step of the calling thread
+    step = current_step()
+    pending = Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+    errors = []
+    cancelled = threading.Event()
+
+    def worker():
+        while not cancelled.is_set():
+            try:
+                index, item = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                with running_step(step):
+                    results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+                cancelled.set()
+
+    join_all(start_threads(worker, min(max_workers, len(items))))
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def start_threads(target, count):
+    """Start count daemon threads running target"""
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def join_all(threads):
+    """Wait for threads to finish while remaining responsive to KeyboardInterrupt"""
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
@@ -2,6 +2,8 @@
 Methods for manipulating lists of packages returned by aptly
 """
 # from aptly_api import pkg_ref_version_key
+import hashlib
+
 from debian_version import compare_versions
 
 
@@ -19,18 +21,36 @@ def sort_by_name_and_version(packages):
 
 def prune(packages):
     """Prune package list to include only the latest version of each package in the list.
-    It sorts the package list first by name and version in order to do this.
-    :return: Pruned package list
+    The packages may be any iterable - e.g. a generator streaming package refs - and only the latest version of
+    each package seen so far is held in memory.
+    :return: Pruned package list, sorted by name
+    """
+    latest = {}
+    for pkg in packages:
+        fields = pkg[1:].split()
+        package_name = fields[1]
+        # On equal versions the last one seen wins
+        if package_name not in latest or compare_versions(fields[2], latest[package_name][1:].split()[2]) >= 0:
+            latest[package_name] = pkg
+    return sort_by_name(latest.values())
+
+
+def packages_not_in(packages, other_packages):
+    """Return the packages that are not among other_packages, in their original order.
+    Membership is tested against a set, so the cost is linear in the number of packages, not their product.
+    :param packages: Iterable of package refs
+    :param other_packages: Iterable of package refs to leave out - e.g. those already released as stable
+    """
+    other_packages = set(other_packages)
+    return [pkg for pkg in packages if pkg not in other_packages]
+
+
+def package_set_fingerprint(packages):
+    """Fingerprint of a set of package refs that doesn't depend on their order, e.g. to tell whether a repo still
+    holds exactly the packages of a snapshot.
+    :param packages: Any iterable of package refs - e.g. a generator streaming them
     """
-    sorted_by_name_and_version = sort_by_name_and_version(packages)
-    visited = set()
-    pruned = []
-    for pkg in reversed(sorted_by_name_and_version):
-        package_name = pkg[1:].split()[1]
-        if package_name not in visited:
-            pruned.append(pkg)
-            visited.add(package_name)
-    return list(reversed(pruned))
+    return hashlib.sha1('\n'.join(sorted(set(packages)))).hexdigest()
 
 
 def pkg_ref_version_key(mycmp):
@@ -0,0 +1,154 @@
+"""
+Plans of aptly API operations with explicit dependencies, run by an executor that performs independent steps
+at the same time
+"""
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+from parallel import running_step, DEFAULT_WORKERS
+
+# Kinds of step
+READ = 'read'
+WRITE = 'write'
+LOCAL = 'local'
+
+
+class Step:
+    """One operation of a plan"""
+
+    def __init__(self, name, kind, description, func, requires):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.func = func
+        self.requires = list(requires)
+        # Seconds taken to run the step, once it has been run
+        self.seconds = None
+
+
+class Plan:
+    """A workflow as a list of steps, each of which may require that other steps finish first.
+
+    Each step is a function taking the dict, by step name, of the results of the steps already finished and
+    returning its own result.  Steps may only require steps added before them, so a plan can't have cycles and
+    its steps are always listed in an order they could be run in one at a time.
+    """
+
+    def __init__(self, title):
+        """
+        :param title: What the plan does - e.g. 'test a4pizza/base PIZZA-123'
+        """
+        self.title = title
+        self.steps = []
+        self.results = {}
+
+    def add(self, name, kind, description, func, requires=()):
+        """Add a step to the plan.
+        :param name: Name of the step, unique in the plan.  Its result is stored under this name.
+        :param kind: READ or WRITE for a step calling the API, LOCAL for one that doesn't
+        :param description: What the step does
+        :param func: Function of one argument - the dict of results of the steps finished so far
+        :param requires: Names of the steps that must finish before this one starts
+        :raises ValueError: If the name is already used or a required step hasn't been added
+        """
+        names = [step.name for step in self.steps]
+        if name in names:
+            raise ValueError('Step %s already in plan %s' % (name, self.title))
+        for required in requires:
+            if required not in names:
+                raise ValueError('Step %s requires unknown step %s' % (name, required))
+        self.steps.append(Step(name, kind, description, func, requires))
+
+    def run(self, max_workers=DEFAULT_WORKERS):
+        """Run the steps, starting each as soon as the steps it requires have finished, with at most max_workers
+        running at once.  The first exception raised by a step stops any step not yet started and is re-raised
+        once the steps already running have finished.
+        :return: Dict of the results of the steps by name
+        """
+        if max_workers <= 1:
+            for step in self.steps:
+                self.results[step.name] = self.run_step(step)
+            return self.results
+
+        finished = Queue()
+        waiting = list(self.steps)
+        running = 0
+        errors = []
+
+        def run_step(step):
+            try:
+                finished.put((step, self.run_step(step), None))
+            except Exception:
+                finished.put((step, None, sys.exc_info()))
+
+        while True:
+            if not errors:
+                ready = [step for step in waiting if all(name in self.results for name in step.requires)]
+                for step in ready[:max_workers - running]:
+                    waiting.remove(step)
+                    thread = threading.Thread(target=run_step, args=(step,))
+                    thread.daemon = True
+                    thread.start()
+                    running += 1
+            if running == 0:
+                break
+            try:
+                step, result, error = finished.get(timeout=0.1)
+            except Empty:
+                # Remain responsive to KeyboardInterrupt
+                continue
+            running -= 1
+            if error is not None:
+                errors.append(error)
+            else:
+                self.results[step.name] = result
+
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+        return self.results
+
+    def run_step(self, step):
+        start = time.time()
+        try:
+            with running_step('%s: %s' % (self.title, step.name)):
+                return step.func(self.results)
+        finally:
+            step.seconds = time.time() - start
+
+    def timings(self):
+        """Return the seconds taken by each step that has been run, by step name"""
+        return dict((step.name, step.seconds) for step in self.steps if step.seconds is not None)
+
+    def critical_path(self):
+        """Return the names of the chain of steps that bounds the time taken by the plan.  Once the plan has been run
+        this is the chain that took longest, otherwise the chain with the most API calls.
+        """
+        longest = {}
+        for step in self.steps:
+            if step.seconds is not None:
+                cost = step.seconds
+            else:
+                cost = 0 if step.kind == LOCAL else 1
+            before = max([longest[name] for name in step.requires] or [(0, [])], key=lambda chain: chain[0])
+            longest[step.name] = (before[0] + cost, before[1] + [step.name])
+        if not longest:
+            return []
+        return max(longest.values(), key=lambda chain: chain[0])[1]
+
+    def format(self):
+        """Return the plan as text - a line per step, with the time it took if it has been run, and the critical
+        path."""
+        lines = ['Plan: %s' % self.title]
+        width = max([len(step.name) for step in self.steps] or [0])
+        for step in self.steps:
+            line = '  %-*s  %-5s  %s' % (width, step.name, step.kind, step.description)
+            if step.requires:
+                line += ' (after %s)' % ', '.join(step.requires)
+            if step.seconds is not None:
+                line += ' - %.3fs' % step.seconds
+            lines.append(line)
+        lines.append('Critical path: %s' % ' -> '.join(self.critical_path()))
+        return '\n'.join(lines)
@@ -0,0 +1,122 @@
+"""
+Upload throughput telemetry - per-file transfer rates, time spent in each phase of a command and live progress
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+MB = 1024 * 1024.0
+
+
+def mb_per_second(num_bytes, seconds):
+    return round(num_bytes / MB / seconds, 2) if seconds > 0 else None
+
+
+class UploadStats:
+    """Thread safe record of the files uploaded during a command and of the time spent in each of its phases
+    (e.g. upload, import, publish)."""
+
+    def __init__(self):
+        self.files = []
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add_upload(self, file_names, num_bytes, seconds):
+        """Record one upload request.
+        :param file_names: The local file names sent in the request
+        :param num_bytes: The size of the request body
+        :param seconds: The time taken to send the request and receive the response
+        """
+        with self.lock:
+            self.files.append({'files': list(file_names), 'bytes': num_bytes, 'seconds': round(seconds, 3),
+                               'mb_per_second': mb_per_second(num_bytes, seconds)})
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent in its block to the named phase"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = round(self.phases.get(name, 0) + time.time() - start, 3)
+
+    def summary(self):
+        """Return the stats as a dict, ready to be dumped as JSON"""
+        with self.lock:
+            total_bytes = sum(upload['bytes'] for upload in self.files)
+            return {'uploads': [dict(upload) for upload in self.files],
+                    'files': sum(len(upload['files']) for upload in self.files),
+                    'bytes': total_bytes,
+                    'phases': dict(self.phases),
+                    'mb_per_second': mb_per_second(total_bytes, self.phases.get('upload', 0))}
+
+    def format(self, output_format='text'):
+        """Return the stats formatted for a person ('text') or for CI logs ('json' - a single line)"""
+        summary = self.summary()
+        if output_format == 'json':
+            return json.dumps(summary, sort_keys=True)
+        lines = []
+        for upload in summary['uploads']:
+            lines.append('Uploaded %s: %s bytes in %.3fs (%s MB/s)' % (', '.join(upload['files']), upload['bytes'],
+                                                                       upload['seconds'], upload['mb_per_second']))
+        lines.append('Uploaded %s files, %s bytes (%s MB/s overall)'
+                     % (summary['files'], summary['bytes'], summary['mb_per_second']))
+        for name, seconds in sorted(summary['phases'].items()):
+            lines.append('Time in %s: %.3fs' % (name, seconds))
+        return '\n'.join(lines)
+
+
+class UploadProgress:
+    """Live, single line, progress display of uploads - only shown when writing to a terminal."""
+
+    def __init__(self, total_bytes, total_files, stream=None, interval=0.2):
+        """
+        :param total_bytes: Total size of the request bodies to send
+        :param total_files: Number of files to send
+        :param stream: Where to display progress - default sys.stderr
+        :param interval: Minimum seconds between updates of the display
+        """
+        self.stream = stream or sys.stderr
+        self.enabled = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.sent_bytes = 0
+        self.sent_files = 0
+        self.interval = interval
+        self.start = time.time()
+        self.last_shown = 0
+        self.lock = threading.Lock()
+
+    def update(self, num_bytes):
+        """Record num_bytes more sent"""
+        with self.lock:
+            self.sent_bytes += num_bytes
+            self.show()
+
+    def file_done(self):
+        with self.lock:
+            self.sent_files += 1
+            self.show(force=True)
+
+    def show(self, force=False):
+        now = time.time()
+        if not self.enabled or (not force and now - self.last_shown < self.interval):
+            return
+        self.last_shown = now
+        percent = 100.0 * self.sent_bytes / self.total_bytes if self.total_bytes else 100.0
+        rate = mb_per_second(self.sent_bytes, now - self.start)
+        self.stream.write('\rUploading: %s/%s files, %.1f/%.1f MB (%.0f%%) %s MB/s   '
+                          % (self.sent_files, self.total_files, self.sent_bytes / MB, self.total_bytes / MB, percent,
+                             '-' if rate is None else rate))
+        self.stream.flush()
+
+    def finish(self):
+        """End the progress line"""
+        with self.lock:
+            if self.enabled:
+                self.show(force=True)
+                self.stream.write('\n')
+                self.stream.flush()
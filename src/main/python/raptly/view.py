@@ -7,14 +7,16 @@ from debian_version import compare_versions
 from pkg_util import sort_by_name_and_version, prune, pkg_ref_version_key
 
 
-def print_package_refs(package_refs):
+def print_package_refs(package_refs, is_sorted=False):
     """Print package refs to stdout - sort first by version then by name
     :param package_refs: List of aptly package references
+    :param is_sorted: Whether the package refs are already sorted by name and version, so need not be sorted again
     """
-    sorted_by_version = sorted(package_refs, key=pkg_ref_version_key(compare_versions))
-    sorted_by_name = sorted(sorted_by_version, key=lambda pr: pr[1:].split()[1])
+    if not is_sorted:
+        sorted_by_version = sorted(package_refs, key=pkg_ref_version_key(compare_versions))
+        package_refs = sorted(sorted_by_version, key=lambda pr: pr[1:].split()[1])
 
-    for package_ref in sorted_by_name:
+    for package_ref in package_refs:
         package_ref_fields = package_ref[1:].split()
         print '  %s_%s_%s' % (package_ref_fields[1], package_ref_fields[2], package_ref_fields[0])
 
@@ -46,7 +48,9 @@ def show_distribution(api, is_pruned, is_json, public_repo_name, distribution):
     #    package_name   = [1]
     #    debian_version = [2]
     # Correct Debian version sorting provided by debian_version.compare_versions
-    unsorted = api.find_packages(matching_publication)
+    # Package refs are decoded incrementally so large distributions are never held in memory as raw JSON, but
+    # sorting needs every package ref of an unpruned listing - those are still held in memory, once.
+    unsorted = api.iter_packages(matching_publication)
 
     # If caller wants the list pruned:
     if is_pruned:
@@ -58,7 +62,7 @@ def show_distribution(api, is_pruned, is_json, public_repo_name, distribution):
         print json.dumps(final_list)
     else:
         # Print out one package name per line
-        print_package_refs(final_list)
+        print_package_refs(final_list, is_sorted=True)
 
 
 def show_repos(repos, is_json=False, with_checks=False):
@@ -138,3 +142,22 @@ def show_test_cmd_output(api, is_dry_run, new_packages, public_repo_name, releas
     print('Distribution: %s' % api.testing_name)
     print('Packages:')
     print_package_refs(union)
+
+
+def show_train(title, outcomes):
+    """Show the outcome of a release train for each repo
+    :param title: What the train did - e.g. 'Released TKT-1234 to stable'
+    :param outcomes: List of outcomes per repo, as returned by AptlyApi.train
+    """
+    print('%s:' % title)
+    width = max([len(outcome['repo']) for outcome in outcomes] or [0])
+    for outcome in outcomes:
+        line = '  %-*s  %-7s' % (width, outcome['repo'], outcome['status'])
+        if outcome['status'] != 'skipped':
+            line += '  %.2fs' % outcome['seconds']
+        if outcome['error']:
+            line += '  %s' % outcome['error']
+        print(line.rstrip())
+    counts = dict((status, len([outcome for outcome in outcomes if outcome['status'] == status]))
+                  for status in ('ok', 'failed', 'skipped'))
+    print('%s repos: %s ok, %s failed, %s skipped' % (len(outcomes), counts['ok'], counts['failed'], counts['skipped']))
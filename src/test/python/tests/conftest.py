@@ -0,0 +1,347 @@
+"""
+In-memory stand-in for the aptly REST API, mounted as a requests transport adapter so AptlyApi can be exercised
+without an aptly server.
+"""
+import cgi
+import hashlib
+import io
+import json
+import re
+import subprocess
+import tarfile
+import threading
+import time
+import urllib
+import urlparse
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from raptly.aptly_api import AptlyApi
+
+STUB_URL = 'http://aptly.stub/api'
+
+
+def deb_ref(file_name, content):
+    """Package ref for an uploaded file named <name>_<version>_<arch>.deb"""
+    name, version, arch = file_name[:-len('.deb')].split('_')
+    return 'P%s %s %s %s' % (arch, name, version, hashlib.md5(content).hexdigest()[:16])
+
+
+def matches(package_ref, package_query):
+    """Minimal aptly package query support: '|' separated <name>, <name>_<version> or <name>_<version>_<arch>"""
+    arch, name, version = package_ref[1:].split()[:3]
+    for term in package_query.split('|'):
+        term = term.strip()
+        if term in (name, '%s_%s' % (name, version), '%s_%s_%s' % (name, version, arch)):
+            return True
+    return False
+
+
+def build_deb(path, name, version, arch, payload='', control_compression='gz'):
+    """Write a minimal Debian package: an ar archive of debian-binary, control.tar.<compression> and data.tar.gz
+    :param control_compression: 'gz', 'xz' or '' for an uncompressed control.tar
+    """
+    def tar(files, compression):
+        content = io.BytesIO()
+        with tarfile.open(fileobj=content, mode='w:gz' if compression == 'gz' else 'w') as tar_file:
+            for file_name, data in files:
+                info = tarfile.TarInfo(file_name)
+                info.size = len(data)
+                tar_file.addfile(info, io.BytesIO(data))
+        if compression == 'xz':
+            xz = subprocess.Popen(['xz', '--stdout'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            return xz.communicate(content.getvalue())[0]
+        return content.getvalue()
+
+    control = 'Package: %s\nVersion: %s\nArchitecture: %s\nDescription: %s\n more about %s\n' \
+              % (name, version, arch, name, name)
+    control_tar = 'control.tar.%s' % control_compression if control_compression else 'control.tar'
+    members = [('debian-binary', '2.0\n'),
+               (control_tar, tar([('./md5sums', '0' * 32 + '  usr/share/%s/payload\n' % name), ('./control', control)],
+                                 control_compression)),
+               ('data.tar.gz', tar([('./usr/share/%s/payload' % name, payload)], 'gz'))]
+    with open(path, 'wb') as deb:
+        deb.write('!<arch>\n')
+        for member_name, data in members:
+            deb.write('%-16s%-12s%-6s%-6s%-8s%-10s`\n' % (member_name, 0, 0, 0, 100644, len(data)))
+            deb.write(data)
+            if len(data) % 2:
+                deb.write('\n')
+    return path
+
+
+class AptlyStub(BaseAdapter):
+    """Transport adapter implementing the subset of the aptly REST API used by raptly."""
+
+    def __init__(self):
+        BaseAdapter.__init__(self)
+        self.repos = {}
+        self.snapshots = []
+        self.publications = []
+        self.uploads = {}
+        # Details of each package added, by package ref
+        self.packages = {}
+        # Names of uploaded files that fail to import, as a corrupt package would
+        self.rejects = set()
+        self.requests = []
+        # Set to emit ETags and honour If-None-Match
+        self.etags = False
+        self.bytes_sent = 0
+        # Like aptly, handle one request at a time
+        self.lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlparse.urlsplit(request.url)
+        path = urllib.unquote(url.path[len(urlparse.urlsplit(STUB_URL).path):])
+        query = dict(urlparse.parse_qsl(url.query))
+        with self.lock:
+            self.requests.append((request.method, path))
+            status, body = self.dispatch(request, path, query)
+            return self.build_response(request, status, body)
+
+    def build_response(self, request, status, body):
+        content = json.dumps(body) if body is not None else ''
+        headers = {'Content-Type': 'application/json'}
+        if self.etags and request.method == 'GET' and status == 200:
+            headers['ETag'] = '"%s"' % hashlib.md5(content).hexdigest()
+            if request.headers.get('If-None-Match') == headers['ETag']:
+                status = 304
+                content = ''
+        headers['Content-Length'] = str(len(content))
+        self.bytes_sent += len(content)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+    def count(self, method, path_pattern):
+        """Number of requests made matching method and path regex"""
+        return len([r for r in self.requests if r[0] == method and re.match('^%s$' % path_pattern, r[1])])
+
+    # Aptly API
+
+    def dispatch(self, request, path, query):
+        method = request.method
+        data = json.loads(request.body) if request.body and 'json' in request.headers.get('content-type', '') \
+            else None
+        parts = path.strip('/').split('/')
+
+        if path == '/version':
+            return 200, {'Version': '1.2.0'}
+
+        if parts[0] == 'repos':
+            if len(parts) == 1 and method == 'GET':
+                return 200, [{'Name': name, 'Comment': '', 'DefaultDistribution': '', 'DefaultComponent': ''}
+                             for name in sorted(self.repos)]
+            if len(parts) == 1 and method == 'POST':
+                if data['Name'] in self.repos:
+                    return 400, {'error': 'local repo with name %s already exists' % data['Name']}
+                self.repos[data['Name']] = set()
+                return 201, {'Name': data['Name']}
+            name = parts[1]
+            if name not in self.repos:
+                return 404, {'error': 'local repo with name %s not found' % name}
+            if len(parts) == 2 and method == 'DELETE':
+                del self.repos[name]
+                return 200, {}
+            if parts[2] == 'packages' and method == 'GET':
+                return 200, self.query(self.repos[name], query.get('q'))
+            if parts[2] == 'packages' and method == 'DELETE':
+                self.repos[name] -= set(data['PackageRefs'])
+                return 200, {}
+            if parts[2] == 'snapshots' and method == 'POST':
+                return self.create_snapshot(data['Name'], self.repos[name])
+            if parts[2] == 'file' and method == 'POST':
+                return self.add_files(name, parts[3], parts[4] if len(parts) > 4 else None,
+                                      query.get('forceReplace') == '1')
+
+        if parts[0] == 'snapshots':
+            if len(parts) == 1 and method == 'GET':
+                return 200, [self.snapshot_info(s) for s in self.snapshots]
+            if len(parts) == 1 and method == 'POST':
+                refs = set(data.get('PackageRefs') or [])
+                for source in data.get('SourceSnapshots') or []:
+                    if self.find_snapshot(source) is None:
+                        return 404, {'error': 'snapshot with name %s not found' % source}
+                return self.create_snapshot(data['Name'], refs, data.get('Description', ''))
+            snapshot = self.find_snapshot(parts[1])
+            if snapshot is None:
+                return 404, {'error': 'snapshot with name %s not found' % parts[1]}
+            if len(parts) == 2 and method == 'GET':
+                return 200, self.snapshot_info(snapshot)
+            if len(parts) == 2 and method == 'DELETE':
+                self.snapshots.remove(snapshot)
+                return 200, {}
+            if len(parts) == 2 and method == 'PUT':
+                snapshot['Description'] = data.get('Description', snapshot['Description'])
+                return 200, self.snapshot_info(snapshot)
+            if parts[2] == 'packages' and method == 'GET':
+                return 200, self.query(snapshot['refs'], query.get('q'))
+
+        if parts[0] == 'publish':
+            if len(parts) == 1 and method == 'GET':
+                return 200, [self.publication_info(p) for p in self.publications]
+            parts = [p for p in parts if p]
+            prefix = parts[1].replace('_', '/')
+            if method == 'POST':
+                if self.find_publication(prefix, data['Distribution']) is not None:
+                    return 400, {'error': 'prefix/distribution already used'}
+                for source in data['Sources']:
+                    if self.find_snapshot(source['Name']) is None:
+                        return 404, {'error': 'snapshot with name %s not found' % source['Name']}
+                self.publications.append({'Prefix': prefix, 'Distribution': data['Distribution'],
+                                          'SourceKind': data['SourceKind'],
+                                          'Sources': [{'Component': 'main', 'Name': s['Name']}
+                                                      for s in data['Sources']]})
+                return 201, {}
+            publication = self.find_publication(prefix, parts[2])
+            if publication is None:
+                return 404, {'error': 'published repo with prefix/distribution %s/%s not found' % (prefix, parts[2])}
+            if method == 'PUT':
+                if publication['SourceKind'] != 'snapshot' and 'Snapshots' in data:
+                    return 400, {'error': 'snapshots can only be switched in a publication of snapshots'}
+                publication['Sources'] = [{'Component': s['Component'], 'Name': s['Name']}
+                                          for s in data['Snapshots']]
+                return 200, {}
+            if method == 'DELETE':
+                self.publications.remove(publication)
+                return 200, {}
+
+        if parts[0] == 'packages' and len(parts) == 2 and method == 'GET':
+            if parts[1] not in self.packages:
+                return 404, {'error': 'package not found'}
+            return 200, self.packages[parts[1]]
+
+        if parts[0] == 'files':
+            if len(parts) == 1 and method == 'GET':
+                return 200, sorted(self.uploads)
+            if len(parts) == 2 and method == 'GET':
+                if parts[1] not in self.uploads:
+                    return 404, {'error': 'directory %s not found' % parts[1]}
+                return 200, sorted(self.uploads[parts[1]])
+            if len(parts) == 2 and method == 'POST':
+                return 200, self.upload(parts[1], request)
+            if len(parts) == 2 and method == 'DELETE':
+                self.uploads.pop(parts[1], None)
+                return 200, {}
+            if len(parts) == 3 and method == 'DELETE':
+                self.uploads.get(parts[1], {}).pop(parts[2], None)
+                return 200, {}
+
+        return 404, {'error': 'not found: %s %s' % (method, path)}
+
+    def query(self, refs, package_query):
+        if package_query:
+            refs = [ref for ref in refs if matches(ref, package_query)]
+        return sorted(refs)
+
+    def find_snapshot(self, name):
+        for snapshot in self.snapshots:
+            if snapshot['Name'] == name:
+                return snapshot
+        return None
+
+    def find_publication(self, prefix, distribution):
+        for publication in self.publications:
+            if publication['Prefix'] == prefix and publication['Distribution'] == distribution:
+                return publication
+        return None
+
+    def snapshot_info(self, snapshot):
+        return {'Name': snapshot['Name'], 'CreatedAt': snapshot['CreatedAt'],
+                'Description': snapshot.get('Description', '')}
+
+    def publication_info(self, publication):
+        return dict(publication)
+
+    def create_snapshot(self, name, refs, description=''):
+        if self.find_snapshot(name) is not None:
+            return 400, {'error': 'snapshot with name %s already exists' % name}
+        self.snapshots.append({'Name': name, 'CreatedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'refs': set(refs),
+                               'Description': description})
+        return 201, {'Name': name}
+
+    def upload(self, upload_dir, request):
+        body = request.body.read() if hasattr(request.body, 'read') else request.body
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': request.headers['Content-Type'],
+                   'CONTENT_LENGTH': str(len(body))}
+        form = cgi.FieldStorage(fp=io.BytesIO(body), environ=environ)
+        files = self.uploads.setdefault(upload_dir, {})
+        paths = []
+        for field in form.list:
+            files[field.filename] = field.value
+            paths.append('%s/%s' % (upload_dir, field.filename))
+        return paths
+
+    def add_files(self, repo_name, upload_dir, file_name, force_replace=False):
+        files = self.uploads.get(upload_dir, {})
+        # Like aptly, only package files are imported from a directory
+        names = [file_name] if file_name else sorted(name for name in files if name.endswith('.deb'))
+        added = []
+        failed = []
+        warnings = []
+        for name in names:
+            path = '/var/aptly/upload/%s/%s' % (upload_dir, name)
+            if name not in files or name in self.rejects:
+                failed.append(path)
+                warnings.append('Unable to read file %s: not a Debian package' % path)
+                continue
+            content = files.pop(name)
+            ref = deb_ref(name, content)
+            self.packages[ref] = {'Key': ref, 'SHA256': hashlib.sha256(content).hexdigest(), 'Size': str(len(content))}
+            if force_replace:
+                identity = ref.split()[:3]
+                self.repos[repo_name] = set(r for r in self.repos[repo_name] if r.split()[:3] != identity)
+            self.repos[repo_name].add(ref)
+            added.append('%s added' % name[:-len('.deb')])
+        if not files:
+            self.uploads.pop(upload_dir, None)
+        return 200, {'FailedFiles': failed, 'Report': {'Warnings': warnings, 'Added': added, 'Removed': []}}
+
+
+@pytest.fixture
+def stub():
+    return AptlyStub()
+
+
+def stub_api(stub, **kwargs):
+    """AptlyApi talking to the stub"""
+    session = requests.Session()
+    session.mount(STUB_URL, stub)
+    return AptlyApi(repo_url=STUB_URL, session=session, **kwargs)
+
+
+@pytest.fixture
+def api(stub):
+    return stub_api(stub)
+
+
+@pytest.fixture
+def debs(tmpdir):
+    """Create real, minimal Debian packages from <name>_<version>_<arch> names"""
+    def create(*names):
+        return [build_deb(str(tmpdir.join('%s.deb' % name)), *name.split('_')) for name in names]
+    return create
+
+
+@pytest.fixture
+def deb_files(tmpdir):
+    """Create dummy package files named as aptly would name them"""
+    def create(*names):
+        paths = []
+        for name in names:
+            deb = tmpdir.join('%s.deb' % name)
+            deb.write('contents of %s' % name)
+            paths.append(str(deb))
+        return paths
+    return create
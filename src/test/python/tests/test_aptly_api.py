@@ -0,0 +1,601 @@
+import re
+import threading
+import time
+
+import pytest
+
+from conftest import build_deb, stub_api
+from raptly import aptly_api
+from raptly.aptly_api import RaptlyError, listing_affected_by, import_warnings_for
+from raptly.plan import Plan
+
+BASE_URL = 'http://aptly.stub/api'
+
+
+def test_listing_affected_by():
+    assert listing_affected_by(BASE_URL, BASE_URL + '/publish/a4pizza_base') == 'publish'
+    assert listing_affected_by(BASE_URL, BASE_URL + '/publish//a4pizza_base/testing') == 'publish'
+    assert listing_affected_by(BASE_URL, BASE_URL + '/snapshots/a4pizza_base.1506701691?force=1') == 'snapshots'
+    assert listing_affected_by(BASE_URL, BASE_URL + '/repos') == 'repos'
+    assert listing_affected_by(BASE_URL, BASE_URL + '/repos/a4pizza_base?force=1') == 'repos'
+    assert listing_affected_by(BASE_URL, BASE_URL + '/repos/a4pizza_base/snapshots') == 'snapshots'
+    assert listing_affected_by(BASE_URL, BASE_URL + '/repos/a4pizza_base/packages') is None
+    assert listing_affected_by(BASE_URL, BASE_URL + '/repos/a4pizza_base/file/gino/x.deb') is None
+    assert listing_affected_by(BASE_URL, BASE_URL + '/files/gino') is None
+
+
+def test_listings_fetched_once(api, stub, deb_files):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all'), '', api.local_user)
+    stub.requests = []
+
+    api.test(public_repo_name='a4pizza/base', package_query='margherita', release_id='TKT-1', dry_run=True)
+
+    # Each listing is fetched once no matter how many lookups the dry run makes
+    assert stub.count('GET', '/publish') <= 1
+    assert stub.count('GET', '/repos') <= 1
+    assert stub.count('GET', '/snapshots') <= 1
+    assert api.listing_stats['served'] > 0
+
+
+def test_test_without_packages_touches_no_snapshots(api, stub):
+    api.create('a4pizza/base')
+    stub.requests = []
+
+    union, new_packages, snapshot = api.test('a4pizza/base', 'margherita', 'TKT-1', dry_run=False)
+    assert (union, new_packages, snapshot) == ([], [], None)
+    assert stub.count('POST', '/snapshots.*') == 0
+    assert stub.count('DELETE', '/snapshots/.*') == 0
+
+
+def test_listings_invalidated_by_mutation(api, stub, deb_files):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all'), '', api.local_user)
+
+    union, new_packages, snapshot = api.test(public_repo_name='a4pizza/base', package_query='margherita',
+                                             release_id='TKT-1', dry_run=False)
+    assert len(new_packages) == 1
+
+    # The new testing publication is seen despite /publish having been read earlier in this invocation
+    assert api.get_snapshot_for_publication('testing', 'a4pizza/base') == snapshot
+    assert [x['Name'] for x in api.find_release_candidate_snapshots('a4pizza_base', 'TKT-1')] == [snapshot]
+
+
+def test_listings_revalidated_between_runs(stub, tmpdir, deb_files):
+    stub.etags = True
+    stub_api(stub).create('a4pizza/base')
+
+    first_run = stub_api(stub, cache_dir=str(tmpdir))
+    first_run.list_distributions('a4pizza/base')
+    first_run_bytes = stub.bytes_sent
+
+    # Unchanged listings cost no bytes second time round
+    second_run = stub_api(stub, cache_dir=str(tmpdir))
+    assert second_run.list_distributions('a4pizza/base') == first_run.list_distributions('a4pizza/base')
+    assert stub.bytes_sent == first_run_bytes
+    assert second_run.listing_stats['revalidated'] == 2
+    assert second_run.listing_stats['bytes_saved'] > 0
+
+    # A changed listing is fetched in full
+    stub_api(stub).deploy('a4pizza/base', deb_files('margherita_1.0.0_all'), '', 'gino')
+    third_run = stub_api(stub, cache_dir=str(tmpdir))
+    sources = [d['Sources'][0]['Name'] for d in third_run.list_distributions('a4pizza/base')]
+    assert sources[0].startswith('a4pizza_base.deploy.')
+    assert third_run.listing_stats['revalidated'] == 1
+
+
+def test_listings_fingerprinted_without_etags(stub, tmpdir):
+    stub_api(stub).create('a4pizza/base')
+    stub_api(stub, cache_dir=str(tmpdir)).get_published_repos()
+
+    first_run_bytes = stub.bytes_sent
+    second_run = stub_api(stub, cache_dir=str(tmpdir))
+    assert second_run.get_published_repos() == ['a4pizza/base']
+    assert second_run.listing_stats['revalidated'] == 1
+    # Fetched again, but not decoded again
+    assert second_run.listing_stats['bytes_saved'] == stub.bytes_sent - first_run_bytes > 0
+
+
+def test_find_packages_keeps_source_order(api, stub):
+    stub.snapshots = [{'Name': 'snap-%s' % i, 'CreatedAt': '', 'refs': {'Pall pkg%s 1.0 %016x' % (i, i)}}
+                      for i in range(6)]
+    publication = {'SourceKind': 'snapshot', 'Sources': [{'Name': 'snap-%s' % i} for i in range(6)]}
+
+    assert api.find_packages(publication) == ['Pall pkg%s 1.0 %016x' % (i, i) for i in range(6)]
+
+
+def test_iter_packages(api, stub):
+    refs = ['Pall pkg%s 1.0 %016x' % (i, i) for i in range(1000)]
+    stub.snapshots = [{'Name': 'snap', 'CreatedAt': '', 'refs': set(refs)}]
+    publication = {'SourceKind': 'snapshot', 'Sources': [{'Name': 'snap'}]}
+
+    package_refs = api.iter_packages(publication)
+    assert not isinstance(package_refs, list)
+    assert sorted(package_refs) == sorted(refs)
+
+
+def test_iter_packages_keeps_source_order(api, stub):
+    stub.snapshots = [{'Name': 'snap-%s' % i, 'CreatedAt': '', 'refs': {'Pall pkg%s 1.0 %016x' % (i, i)}}
+                      for i in range(6)]
+    publication = {'SourceKind': 'snapshot', 'Sources': [{'Name': 'snap-%s' % i} for i in range(6)]}
+
+    assert list(api.iter_packages(publication)) == ['Pall pkg%s 1.0 %016x' % (i, i) for i in range(6)]
+
+
+def test_streamed_snapshot_packages_cached_once_read(stub, tmpdir):
+    refs = ['Pall pkg%s 1.0 %016x' % (i, i) for i in range(10)]
+    stub.snapshots = [{'Name': 'snap', 'CreatedAt': '', 'refs': set(refs)}]
+    api = stub_api(stub, cache_dir=str(tmpdir))
+
+    # A partly read stream is not cached
+    next(api.get_packages_from_snapshot('snap', stream=True))
+    assert sorted(api.get_packages_from_snapshot('snap', stream=True)) == sorted(refs)
+    assert stub.count('GET', '/snapshots/snap/packages.*') == 2
+
+    assert sorted(stub_api(stub, cache_dir=str(tmpdir)).get_packages_from_snapshot('snap', stream=True)) == sorted(refs)
+    assert stub.count('GET', '/snapshots/snap/packages.*') == 2
+
+
+def test_upload_packages_concurrently(stub, deb_files):
+    api = stub_api(stub, upload_workers=4)
+    api.create('a4pizza/base')
+    names = ['topping%s_1.0.0_all' % i for i in range(12)]
+    results = api.upload_packages(deb_files(*names), 'a4pizza/base', 'alice')
+
+    batch_dir = results[0]['path'].split('/')[0]
+    assert batch_dir.startswith('alice.')
+    assert [result['path'] for result in results] == ['%s/%s.deb' % (batch_dir, name) for name in names]
+    assert stub.count('POST', '/files/alice\\..*') == 12
+    # Imported in one operation, then cleaned up
+    assert stub.count('POST', '/repos/a4pizza_base/file/.*') == 1
+    assert stub.count('DELETE', '/files/%s' % re.escape(batch_dir)) == 1
+    assert len(stub.repos['a4pizza_base']) == 12
+    assert stub.uploads == {}
+
+
+def test_upload_packages_reports_failed_files(api, stub, deb_files):
+    api.create('a4pizza/base')
+    stub.rejects.add('anchovies_1.0.0_all.deb')
+
+    with pytest.raises(RaptlyError) as e:
+        api.upload_packages(deb_files('margherita_1.0.0_all', 'anchovies_1.0.0_all'), 'a4pizza/base', 'alice')
+    assert 'Failed to add 1 of 2 package files' in e.value.value
+    assert 'anchovies_1.0.0_all.deb - Failed to add to repo: Unable to read file' in e.value.value
+    assert 'margherita_1.0.0_all.deb' not in e.value.value
+    # The other file was still added, and the rejected one removed from the server
+    assert len(stub.repos['a4pizza_base']) == 1
+    assert stub.uploads == {}
+
+    with pytest.raises(IOError):
+        api.upload_packages(['non-existent.deb'], 'a4pizza/base', 'alice')
+
+
+def test_upload_packages_reports_each_file_its_own_warnings(api, stub, deb_files):
+    api.create('a4pizza/base')
+    stub.rejects.update(['anchovies_1.0.0_all.deb', 'olives_1.0.0_all.deb'])
+
+    with pytest.raises(RaptlyError) as e:
+        api.upload_packages(deb_files('anchovies_1.0.0_all', 'olives_1.0.0_all'), 'a4pizza/base', 'alice')
+    lines = e.value.value.splitlines()
+    anchovies, = [line.split(' - ')[1] for line in lines if 'anchovies_1.0.0_all.deb - ' in line]
+    olives, = [line.split(' - ')[1] for line in lines if 'olives_1.0.0_all.deb - ' in line]
+    assert '/anchovies_1.0.0_all.deb:' in anchovies and 'olives' not in anchovies
+    assert '/olives_1.0.0_all.deb:' in olives and 'anchovies' not in olives
+
+
+def test_import_warnings_for():
+    warnings = ['Unable to read file /var/aptly/upload/x/olives_1.0.0_all.deb: not a Debian package',
+                'Unable to save package olives_1.0.0_all: conflict',
+                'Unable to save package black-olives_1.0.0_all: conflict']
+    assert import_warnings_for('olives_1.0.0_all.deb', warnings) == warnings[:2]
+    assert import_warnings_for('black-olives_1.0.0_all.deb', warnings) == warnings[2:]
+    assert import_warnings_for('anchovies_1.0.0_all.deb', warnings) == []
+
+
+def test_deploy_skips_packages_already_in_repo(api, stub, debs):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', debs('margherita_1.0.0_all', 'pesto_2.1.0_all'), '', api.local_user)
+    assert stub.count('POST', '/files/.*') == 2
+
+    # A re-run with one new package only uploads that one
+    api.deploy('a4pizza/base', debs('margherita_1.0.0_all', 'pesto_2.1.0_all', 'pesto_2.2.0_all'), '',
+               api.local_user)
+    assert stub.count('POST', '/files/.*') == 3
+    assert len(stub.repos['a4pizza_base']) == 3
+
+
+def test_skip_requires_hash_match(stub, debs, tmpdir):
+    api = stub_api(stub, verify_hash=True)
+    api.create('a4pizza/base')
+    margherita = debs('margherita_1.0.0_all')
+    api.deploy('a4pizza/base', margherita, '', api.local_user)
+    assert api.packages_to_upload(margherita, stub.repos['a4pizza_base']) == []
+
+    # Same package identity, different contents
+    rebuilt = build_deb(str(tmpdir.join('rebuilt.deb')), 'margherita', '1.0.0', 'all', payload='extra cheese')
+    assert api.packages_to_upload([rebuilt], stub.repos['a4pizza_base']) == [rebuilt]
+
+
+def test_rebuilt_package_not_skipped(api, stub, debs, tmpdir, capsys):
+    api.create('a4pizza/base')
+    margherita = debs('margherita_1.0.0_all')
+    api.deploy('a4pizza/base', margherita, '', api.local_user)
+    assert api.packages_to_upload(margherita, stub.repos['a4pizza_base']) == []
+
+    # Same package identity, different size
+    rebuilt = build_deb(str(tmpdir.join('rebuilt.deb')), 'margherita', '1.0.0', 'all', payload='extra cheese' * 100)
+    assert api.packages_to_upload([rebuilt], stub.repos['a4pizza_base']) == [rebuilt]
+    assert 'WARNING: %s differs from Pall margherita 1.0.0' % rebuilt in capsys.readouterr()[0]
+
+
+def wait_until_spooled(stub, num_deploys):
+    """Wait until the given number of coalesced deploys have finished uploading to the spool"""
+    deadline = time.time() + 10
+    while time.time() < deadline and len([files for upload_dir, files in stub.uploads.items()
+                                          if upload_dir.startswith('a4pizza_base.spool.') and
+                                          aptly_api.SPOOL_READY in files]) < num_deploys:
+        time.sleep(0.01)
+
+
+def test_coalesced_deploys_share_publish(stub, debs, monkeypatch):
+    monkeypatch.setattr(aptly_api, 'SPOOL_POLL_INTERVAL', 0.01)
+    stub_api(stub).create('a4pizza/base')
+    package_files = debs(*['topping%s_1.0.0_all' % i for i in range(8)])
+
+    # Hold the lock while every deploy spools its package, as a long publish would
+    stub.create_snapshot('a4pizza_base.spool-lock', [], 'raptly spool lock held by gino@ci since %s'
+                         % int(time.time()))
+    threads = [threading.Thread(target=stub_api(stub).deploy_coalesced, args=('a4pizza/base', [package_file], ''))
+               for package_file in package_files]
+    for thread in threads:
+        thread.start()
+    wait_until_spooled(stub, len(package_files))
+    stub.snapshots = [s for s in stub.snapshots if s['Name'] != 'a4pizza_base.spool-lock']
+    for thread in threads:
+        thread.join()
+
+    # Every deploy's directory is imported, and published once
+    assert stub.count('POST', '/repos/a4pizza_base/file/a4pizza_base.spool.*') == len(package_files)
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 1
+    unstable = stub.find_publication('a4pizza/base', 'unstable')
+    assert len(stub.find_snapshot(unstable['Sources'][0]['Name'])['refs']) == len(package_files)
+    assert stub.find_snapshot('a4pizza_base.spool-lock') is None
+
+
+def test_coalesced_deploy_breaks_abandoned_lock(api, stub, debs, monkeypatch):
+    monkeypatch.setattr(aptly_api, 'SPOOL_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(aptly_api, 'SPOOL_LOCK_TIMEOUT', 0.1)
+    api.create('a4pizza/base')
+    # Never refreshed - however far the clock of the host that took it is from ours
+    stub.create_snapshot('a4pizza_base.spool-lock', [], 'raptly spool lock held by gino@ci (1a2b3c4d), refresh 0')
+    api.deploy_coalesced('a4pizza/base', debs('margherita_1.0.0_all'), '')
+
+    assert stub.find_publication('a4pizza/base', 'unstable') is not None
+    assert stub.find_snapshot('a4pizza_base.spool-lock') is None
+    assert stub.uploads == {}
+
+
+def test_coalesced_deploy_survives_failed_holder_publish(stub, debs, monkeypatch):
+    monkeypatch.setattr(aptly_api, 'SPOOL_POLL_INTERVAL', 0.01)
+    stub_api(stub).create('a4pizza/base')
+    package_files = debs('margherita_1.0.0_all', 'pesto_2.1.0_all')
+
+    # Whichever deploy takes the lock imports both packages, then fails to publish them
+    republish_unstable = aptly_api.AptlyApi.republish_unstable
+    calls = []
+
+    def fail_first_republish(self, *args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RaptlyError('Publish failed')
+        return republish_unstable(self, *args, **kwargs)
+    monkeypatch.setattr(aptly_api.AptlyApi, 'republish_unstable', fail_first_republish)
+
+    stub.create_snapshot('a4pizza_base.spool-lock', [], 'raptly spool lock held by gino@ci since %s'
+                         % int(time.time()))
+    errors = []
+
+    def deploy(package_file):
+        try:
+            stub_api(stub).deploy_coalesced('a4pizza/base', [package_file], '')
+        except RaptlyError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=deploy, args=(package_file,)) for package_file in package_files]
+    for thread in threads:
+        thread.start()
+    wait_until_spooled(stub, len(package_files))
+    stub.snapshots = [s for s in stub.snapshots if s['Name'] != 'a4pizza_base.spool-lock']
+    for thread in threads:
+        thread.join()
+
+    # Only the holder reports the failure, and the waiter published the batch
+    assert len(errors) == 1
+    assert stub.count('POST', '/repos/a4pizza_base/file/a4pizza_base.spool.*') == len(package_files)
+    unstable = stub.find_publication('a4pizza/base', 'unstable')
+    assert len(stub.find_snapshot(unstable['Sources'][0]['Name'])['refs']) == len(package_files)
+
+
+def test_coalesced_deploy_refreshes_held_lock(api, stub, debs, monkeypatch):
+    monkeypatch.setattr(aptly_api, 'SPOOL_LOCK_REFRESH_INTERVAL', 0.01)
+    api.create('a4pizza/base')
+    republish_unstable = aptly_api.AptlyApi.republish_unstable
+
+    def slow_republish(self, *args, **kwargs):
+        time.sleep(0.1)
+        return republish_unstable(self, *args, **kwargs)
+    monkeypatch.setattr(aptly_api.AptlyApi, 'republish_unstable', slow_republish)
+    api.deploy_coalesced('a4pizza/base', debs('margherita_1.0.0_all'), '')
+
+    assert stub.count('PUT', '/snapshots/a4pizza_base.spool-lock') > 0
+    assert stub.find_snapshot('a4pizza_base.spool-lock') is None
+
+
+def test_coalesced_deploy_leaves_unfinished_uploads(api, stub, debs):
+    api.create('a4pizza/base')
+    # Another deploy is still uploading
+    stub.uploads['a4pizza_base.spool.0badf00d'] = {'pesto_2.1.0_all.deb': 'half a package'}
+    api.deploy_coalesced('a4pizza/base', debs('margherita_1.0.0_all'), '')
+
+    assert stub.uploads == {'a4pizza_base.spool.0badf00d': {'pesto_2.1.0_all.deb': 'half a package'}}
+    assert [ref.split()[1] for ref in stub.repos['a4pizza_base']] == ['margherita']
+
+
+def test_coalesced_deploy_failures_reported_to_their_deploy(stub, debs, monkeypatch):
+    monkeypatch.setattr(aptly_api, 'SPOOL_POLL_INTERVAL', 0.01)
+    stub_api(stub).create('a4pizza/base')
+    margherita, pesto = debs('margherita_1.0.0_all', 'pesto_2.1.0_all')
+    stub.rejects.add('pesto_2.1.0_all.deb')
+
+    stub.create_snapshot('a4pizza_base.spool-lock', [], 'raptly spool lock held by gino@ci (1a2b3c4d), refresh 0')
+    errors = {}
+
+    def deploy(package_file):
+        try:
+            stub_api(stub).deploy_coalesced('a4pizza/base', [package_file], '')
+        except RaptlyError as e:
+            errors[package_file] = e
+    threads = [threading.Thread(target=deploy, args=(package_file,)) for package_file in (margherita, pesto)]
+    for thread in threads:
+        thread.start()
+    wait_until_spooled(stub, 2)
+    stub.snapshots = [s for s in stub.snapshots if s['Name'] != 'a4pizza_base.spool-lock']
+    for thread in threads:
+        thread.join()
+
+    # Whichever deploy published the batch, only the deploy of the rejected file fails
+    assert errors.keys() == [pesto]
+    assert pesto in errors[pesto].value
+    assert [ref.split()[1] for ref in stub.repos['a4pizza_base']] == ['margherita']
+    assert stub.uploads == {}
+
+
+def test_deploy_without_publish(api, stub, deb_files):
+    api.create('a4pizza/base')
+    for name in ('margherita_1.0.0_all', 'pesto_2.1.0_all', 'calzone_3.0.0_all'):
+        api.deploy('a4pizza/base', deb_files(name), '', api.local_user, publish=False)
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 0
+
+    api.republish_unstable('unstable', None, 'a4pizza/base', 'publish')
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 1
+    unstable = stub.find_publication('a4pizza/base', 'unstable')
+    assert len(stub.find_snapshot(unstable['Sources'][0]['Name'])['refs']) == 3
+
+    api.undeploy('a4pizza/base', 'pesto', 'unstable', dry_run=False, publish=False)
+    assert len(stub.repos['a4pizza_base']) == 2
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 1
+
+
+def test_undeploy_unpublished_packages(api, stub, deb_files):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all', 'pesto_2.1.0_all'), '', api.local_user,
+               publish=False)
+
+    # Not yet published, but still found in the repo - and only once
+    assert len(api.undeploy('a4pizza/base', 'pesto', 'unstable', dry_run=False, publish=False)) == 1
+    assert api.undeploy('a4pizza/base', 'pesto', 'unstable', dry_run=False, publish=False) == []
+    assert stub.count('DELETE', '/repos/a4pizza_base/packages') == 1
+    assert len(stub.repos['a4pizza_base']) == 1
+
+
+def test_unchanged_repo_not_republished(api, stub, deb_files):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all'), '', api.local_user)
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 1
+
+    # Nothing new to deploy, and an undeploy matching nothing, leave unstable as it is
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all'), '', api.local_user)
+    api.undeploy('a4pizza/base', 'calzone', 'unstable', dry_run=False)
+    assert api.republish_unstable('unstable', None, 'a4pizza/base', 'publish') is False
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 1
+
+    assert api.republish_unstable('unstable', None, 'a4pizza/base', 'publish', force=True) is True
+    assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 2
+
+
+@pytest.mark.parametrize('num_packages', [10000, 100000])
+def test_republish_switches_publication_in_place(api, stub, num_packages):
+    api.create('a4pizza/base')
+    stub.repos['a4pizza_base'].update('Pall topping%s 1.0.0 %016x' % (i, i) for i in range(num_packages))
+
+    assert api.republish_unstable('unstable', None, 'a4pizza/base', 'publish') is True
+
+    # One snapshot and an in-place switch - the distribution is never dropped
+    assert stub.count('PUT', '/publish/a4pizza_base/unstable') == 1
+    assert stub.count('DELETE', '/publish/.*') == 0
+    unstable = stub.find_publication('a4pizza/base', 'unstable')
+    assert len(stub.find_snapshot(unstable['Sources'][0]['Name'])['refs']) == num_packages
+
+
+def test_republish_replaces_publication_of_local_repo(api, stub):
+    api.create('a4pizza/base')
+    stub.repos['a4pizza_base'].add('Pall margherita 1.0.0 0000000000000001')
+    # e.g. published directly from the local repo by hand
+    stub.publications.append({'Prefix': 'a4pizza/base', 'Distribution': 'nightly', 'SourceKind': 'local',
+                              'Sources': [{'Component': 'main', 'Name': 'a4pizza_base'}]})
+
+    assert api.republish_dist('nightly', None, 'a4pizza/base', 'a4pizza_base.nightly') is True
+
+    assert stub.count('PUT', '/publish/a4pizza_base/nightly') == 0
+    assert stub.count('DELETE', '/publish/a4pizza_base/nightly') == 1
+    nightly = stub.find_publication('a4pizza/base', 'nightly')
+    assert nightly['SourceKind'] == 'snapshot'
+    assert stub.find_snapshot(nightly['Sources'][0]['Name'])['refs'] == stub.repos['a4pizza_base']
+
+
+def test_release_promoted_through_distributions(api, stub, deb_files):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all', 'pesto_2.1.0_all'), '', api.local_user)
+
+    union, new_packages, candidate = api.test('a4pizza/base', 'margherita', 'TKT-1', dry_run=False)
+    assert len(new_packages) == 1
+    with pytest.raises(RaptlyError):
+        api.release('a4pizza/base', 'staging', 'stable', 'TKT-1')
+    api.stage('a4pizza/base', 'testing', 'staging', 'TKT-1')
+    api.release('a4pizza/base', 'staging', 'stable', 'TKT-1')
+    assert api.get_snapshot_for_publication('stable', 'a4pizza/base') == candidate
+
+    # A plan is built without calling the server
+    stub.requests = []
+    plan = api.test_plan('a4pizza/base', 'pesto', 'TKT-2', dry_run=False)
+    assert plan.critical_path()[-3:] == ['temp', 'candidate', 'publish']
+    assert stub.requests == []
+
+
+def test_release_train(api, stub, deb_files):
+    repos = ['a4pizza/base', 'a4pizza/extras', 'a4pizza/sides']
+    for repo in repos:
+        api.create(repo)
+        api.deploy(repo, deb_files('margherita_1.0.0_all'), '', api.local_user)
+    outcomes = api.test_train(repos, 'margherita', 'TKT-1', dry_run=False)
+    assert [outcome['status'] for outcome in outcomes] == ['ok'] * 3
+
+    # One read of each listing for the whole train
+    stub.requests = []
+    outcomes = api.stage_train(repos, 'TKT-1')
+    assert [outcome['status'] for outcome in outcomes] == ['ok'] * 3
+    assert stub.count('GET', '/publish') == 1
+    assert stub.count('PUT', '/publish/.*/staging') + stub.count('POST', '/publish/.*') == 3
+    # Changes made during the train are seen afterwards
+    assert api.find_publication('staging', 'a4pizza/sides') is not None
+
+    outcomes = api.release_train(repos + ['a4pizza/missing'], 'TKT-2')
+    assert [outcome['status'] for outcome in outcomes] == ['failed'] * 4
+    assert outcomes[0]['error'].startswith('Cannot promote release TKT-2')
+
+
+def test_release_train_fail_fast(stub, deb_files):
+    api = stub_api(stub, workers=1)
+    api.create('a4pizza/base')
+    outcomes = api.release_train(['a4pizza/missing', 'a4pizza/base'], 'TKT-1', fail_fast=True)
+    assert [outcome['status'] for outcome in outcomes] == ['failed', 'skipped']
+
+
+def test_release_train_runs_repo_plans_one_step_at_a_time(stub, deb_files, monkeypatch):
+    api = stub_api(stub, workers=4)
+    repos = ['a4pizza/base', 'a4pizza/extras']
+    for repo in repos:
+        api.create(repo)
+        api.deploy(repo, deb_files('margherita_1.0.0_all'), '', api.local_user)
+    plan_workers = []
+    run = Plan.run
+    monkeypatch.setattr(Plan, 'run', lambda self, max_workers: plan_workers.append(max_workers) or
+                        run(self, max_workers))
+
+    api.test_train(repos, 'margherita', 'TKT-1', dry_run=False)
+    assert plan_workers == [1, 1]
+    api.test('a4pizza/base', 'margherita', 'TKT-2', dry_run=True)
+    assert plan_workers[-1] == 4
+
+
+@pytest.mark.parametrize('num_stable', [1000, 10000, 100000])
+def test_new_packages_against_large_stable(api, stub, num_stable):
+    api.create('a4pizza/base')
+    stable = set('Pall topping 1.0.%s %016x' % (i, i) for i in range(num_stable))
+    stub.create_snapshot('a4pizza_base.stable', stable)
+    stub.publications.append({'Prefix': 'a4pizza/base', 'Distribution': 'stable', 'SourceKind': 'snapshot',
+                              'Sources': [{'Component': 'main', 'Name': 'a4pizza_base.stable'}]})
+    new = set('Pall topping 2.0.%s %016x' % (i, i) for i in range(3))
+    stub.repos['a4pizza_base'] = stable | new
+    api.republish_unstable('unstable', None, 'a4pizza/base', 'deploy')
+
+    start = time.time()
+    union, new_packages, candidate = api.test('a4pizza/base', 'topping', 'TKT-1', dry_run=True)
+    assert sorted(new_packages) == sorted(new)
+    assert union == ['Pall topping 2.0.2 %016x' % 2]
+    assert time.time() - start < 10
+
+
+def test_check_only_uploads_and_publishes_changes(stub, debs, tmpdir, monkeypatch):
+    timestamps = iter(range(1506701691, 1506701791))
+    monkeypatch.setattr(aptly_api, 'get_timestamp', lambda: next(timestamps))
+    cache_dir = str(tmpdir.join('cache'))
+    api = stub_api(stub, cache_dir=cache_dir)
+    api.create('a4pizza/base')
+    stub.create_snapshot('a4pizza_base.stable', [])
+    stub.publications.append({'Prefix': 'a4pizza/base', 'Distribution': 'stable', 'SourceKind': 'snapshot',
+                              'Sources': [{'Component': 'main', 'Name': 'a4pizza_base.stable'}]})
+    package_files = debs('margherita_1.0.0_all', 'pesto_2.1.0_all')
+    check_repo = api.check('a4pizza/base', package_files, api.local_user)
+    assert stub.count('POST', '/files/.*') == 2
+    first_check = stub.find_publication(check_repo, 'check')['Sources'][0]['Name']
+
+    # Checking the same files again uploads and publishes nothing
+    stub.requests = []
+    stub_api(stub, cache_dir=cache_dir).check('a4pizza/base', package_files, api.local_user)
+    assert stub.count('POST', '/files/.*') == 0
+    assert stub.count('POST', '/snapshots') == 0
+    assert stub.find_publication(check_repo, 'check')['Sources'][0]['Name'] == first_check
+
+    # A package rebuilt without a new version replaces the one in the check repo
+    build_deb(package_files[0], 'margherita', '1.0.0', 'all', payload='extra cheese')
+    stub_api(stub, cache_dir=cache_dir).check('a4pizza/base', package_files, api.local_user)
+    assert stub.count('POST', '/files/.*') == 1
+    check_refs = stub.find_snapshot(stub.find_publication(check_repo, 'check')['Sources'][0]['Name'])['refs']
+    margherita_refs = [ref for ref in check_refs if ' margherita ' in ref]
+    assert len(check_refs) == 2
+    assert margherita_refs == [ref for ref in stub.repos['a4pizza_base.@%s@' % api.local_user]
+                               if ' margherita ' in ref]
+
+
+def test_check_compares_files_with_stable_packages(stub, debs, tmpdir, monkeypatch):
+    timestamps = iter(range(1506701691, 1506701791))
+    monkeypatch.setattr(aptly_api, 'get_timestamp', lambda: next(timestamps))
+    cache_dir = str(tmpdir.join('cache'))
+    api = stub_api(stub, cache_dir=cache_dir)
+    api.create('a4pizza/base')
+    package_files = debs('margherita_1.0.0_all', 'pesto_2.1.0_all')
+    api.deploy('a4pizza/base', package_files, '', 'gino', publish=False)
+    stub.create_snapshot('a4pizza_base.stable', stub.repos['a4pizza_base'])
+    stub.publications.append({'Prefix': 'a4pizza/base', 'Distribution': 'stable', 'SourceKind': 'snapshot',
+                              'Sources': [{'Component': 'main', 'Name': 'a4pizza_base.stable'}]})
+
+    # Files the same as the stable packages are compared once, then not again while unchanged
+    stub.requests = []
+    api.check('a4pizza/base', package_files, api.local_user)
+    assert stub.count('POST', '/files/.*') == 0
+    assert stub.count('GET', '/packages/.*') == 2
+    stub_api(stub, cache_dir=cache_dir).check('a4pizza/base', package_files, api.local_user)
+    assert stub.count('GET', '/packages/.*') == 2
+
+    # A package rebuilt without a new version is uploaded, even though stable has its identity
+    build_deb(package_files[0], 'margherita', '1.0.0', 'all', payload='extra cheese')
+    stub_api(stub, cache_dir=cache_dir).check('a4pizza/base', package_files, api.local_user)
+    assert stub.count('GET', '/packages/.*') == 3
+    assert stub.count('POST', '/files/.*') == 1
+    assert len(stub.repos['a4pizza_base.@%s@' % api.local_user]) == 1
+
+
+def test_no_op_deploy_reuses_listings(stub, debs, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    api = stub_api(stub, cache_dir=cache_dir)
+    api.create('a4pizza/base')
+    package_files = debs('margherita_1.0.0_all', 'pesto_2.1.0_all')
+    api.deploy('a4pizza/base', package_files, '', api.local_user)
+
+    for i in range(3):
+        stub.requests = []
+        stub_api(stub, cache_dir=cache_dir).deploy('a4pizza/base', package_files, '', api.local_user)
+        # The repo is listed once, and the published snapshot is fetched once and then comes from the cache
+        assert stub.count('GET', '/repos/a4pizza_base/packages') == 1
+        assert stub.count('GET', '/snapshots/.*/packages') == (1 if i == 0 else 0)
+        assert stub.count('POST', '/repos/a4pizza_base/snapshots') == 0
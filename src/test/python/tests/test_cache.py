@@ -0,0 +1,67 @@
+import hashlib
+import os
+
+from conftest import build_deb
+from raptly.cache import FileInfoCache, SnapshotCache
+from raptly.deb_util import file_checksums, inspect_deb
+
+SERVER = 'http://localhost:9876/api'
+
+
+def test_get_put(tmpdir):
+    cache = SnapshotCache(cache_dir=str(tmpdir))
+    assert cache.get(SERVER, 'a4pizza_base.test.TKT-1.1506701691.gino') is None
+
+    packages = ['Pall margherita 1.0.0 9ed826d62d1e3010', 'Pamd64 pesto 9.32.1 58f826d62d1e9010']
+    cache.put(SERVER, 'a4pizza_base.test.TKT-1.1506701691.gino', packages)
+    assert cache.get(SERVER, 'a4pizza_base.test.TKT-1.1506701691.gino') == packages
+
+    # Keyed by server as well as snapshot name
+    assert cache.get('http://elsewhere/api', 'a4pizza_base.test.TKT-1.1506701691.gino') is None
+
+    cache.invalidate(SERVER, 'a4pizza_base.test.TKT-1.1506701691.gino')
+    assert cache.get(SERVER, 'a4pizza_base.test.TKT-1.1506701691.gino') is None
+
+
+def test_lru_eviction(tmpdir):
+    packages = ['Pall margherita 1.0.%s 9ed826d62d1e3010' % i for i in range(100)]
+    cache = SnapshotCache(cache_dir=str(tmpdir), max_size=10000)
+    cache.put(SERVER, 'snap-1', packages)
+    entry_size = os.path.getsize(cache.path(SERVER, 'snap-1'))
+    cache.max_size = entry_size * 2
+
+    cache.put(SERVER, 'snap-2', packages)
+    # Make snap-1 the oldest and snap-2 the most recently used
+    os.utime(cache.path(SERVER, 'snap-1'), (1, 1))
+    os.utime(cache.path(SERVER, 'snap-2'), (2, 2))
+    assert cache.get(SERVER, 'snap-1') == packages
+
+    cache.put(SERVER, 'snap-3', packages)
+    assert cache.get(SERVER, 'snap-1') == packages
+    assert cache.get(SERVER, 'snap-2') is None
+    assert cache.get(SERVER, 'snap-3') == packages
+
+
+def test_file_info_cache(tmpdir):
+    cache = FileInfoCache(cache_dir=str(tmpdir.join('cache')))
+    deb = build_deb(str(tmpdir.join('pesto.deb')), 'pesto', '2.1.0', 'all', payload='basil')
+    with open(deb, 'rb') as f:
+        content = f.read()
+
+    assert file_checksums(deb, cache) == {'sha256': hashlib.sha256(content).hexdigest(),
+                                          'md5': hashlib.md5(content).hexdigest()}
+    assert inspect_deb(deb, cache)['Identity'] == 'Pall pesto 2.1.0'
+    facts = FileInfoCache(cache_dir=str(tmpdir.join('cache'))).get(deb)
+    assert facts['sha256'] == hashlib.sha256(content).hexdigest()
+    assert facts['control']['Package'] == 'pesto'
+
+    # Unchanged files are not hashed again
+    cache.update(deb, os.stat(deb), sha256='cached')
+    assert file_checksums(deb, cache)['sha256'] == 'cached'
+
+    # A rebuilt file is
+    build_deb(deb, 'pesto', '2.2.0', 'all', payload='more basil')
+    os.utime(deb, (1, 1))
+    assert cache.get(deb) == {}
+    assert file_checksums(deb, cache)['sha256'] != 'cached'
+    assert inspect_deb(deb, cache)['Identity'] == 'Pall pesto 2.2.0'
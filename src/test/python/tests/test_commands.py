@@ -0,0 +1,75 @@
+import pytest
+
+from conftest import STUB_URL, stub_api
+from raptly import commands
+from raptly.aptly_api import RaptlyError
+from raptly.commands import create_cmd_parsers, get_api, get_param_value, parse_duration
+
+
+def test_parse_duration():
+    assert parse_duration('120') == 120
+    assert parse_duration('120s') == 120
+    assert parse_duration('2m') == 120
+    assert parse_duration('1.5h') == 5400
+    assert parse_duration(90) == 90
+    with pytest.raises(RaptlyError):
+        parse_duration('two minutes')
+
+
+def test_check_plan_with_clean_rejected(stub, monkeypatch):
+    api = stub_api(stub)
+    api.create('a4pizza/base')
+    monkeypatch.setattr(commands, 'get_api', lambda **kwargs: api)
+    args = create_cmd_parsers().parse_args(['check', '--plan', '--clean', 'a4pizza/base'])
+    with pytest.raises(RaptlyError):
+        commands.check_cmd(args, STUB_URL, None, None)
+    assert stub.count('DELETE', '.*') == 0
+
+
+def test_deploy_without_files_always_republishes(stub, monkeypatch):
+    api = stub_api(stub)
+    api.create('a4pizza/base')
+    # Nothing has changed since the repo was created and published
+    assert api.republish_unstable('unstable', None, 'a4pizza/base', 'deploy') is False
+    monkeypatch.setattr(commands, 'get_api', lambda **kwargs: api)
+    args = create_cmd_parsers().parse_args(['deploy', '-g', 'NEWKEY', 'a4pizza/base'])
+    commands.deploy_cmd(args, STUB_URL, None, None)
+    assert stub.count('PUT', '/publish/a4pizza_base/unstable') == 1
+
+
+def test_deploy_plan_without_files_is_republish(stub, monkeypatch, capsys):
+    api = stub_api(stub)
+    api.create('a4pizza/base')
+    monkeypatch.setattr(commands, 'get_api', lambda **kwargs: api)
+    stub.requests = []
+    commands.deploy_cmd(create_cmd_parsers().parse_args(['deploy', '--plan', 'a4pizza/base']), STUB_URL, None, None)
+    plan = capsys.readouterr()[0].splitlines()
+    assert plan[1].split()[:2] == ['publish', 'write'] and plan[1].endswith('even if unchanged')
+    assert len(plan) == 3
+    assert stub.requests == []
+
+
+def test_get_api_keeps_explicit_zeros():
+    args = create_cmd_parsers().parse_args(['--no-cache', '--retries', '0', '--connect-timeout', '0',
+                                            '--read-timeout', '0', 'show', 'a4pizza/base'])
+    with get_api(args, STUB_URL, None, None) as api:
+        assert api.http.retries == 0
+        assert api.http.connect_timeout == 0
+        assert api.http.read_timeout == 0
+
+
+def test_get_api_rejects_no_workers():
+    args = create_cmd_parsers().parse_args(['--no-cache', '--workers', '0', 'show', 'a4pizza/base'])
+    with pytest.raises(RaptlyError):
+        get_api(args, STUB_URL, None, None)
+
+
+def test_get_param_value_keeps_falsy_config_values():
+    config = {'default': {'workers': 0, 'verify_hash': True, 'no_cache': False}}
+    args = create_cmd_parsers().parse_args(['show', 'a4pizza/base'])
+    assert get_param_value('workers', args, config) == 0
+    assert get_param_value('verify_hash', args, config) is True
+    assert get_param_value('no_cache', args, config) is False
+
+    args = create_cmd_parsers().parse_args(['--workers', '2', 'show', 'a4pizza/base'])
+    assert get_param_value('workers', args, config) == 2
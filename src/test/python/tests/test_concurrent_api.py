@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from conftest import stub_api
+from raptly.aptly_api import RaptlyError
+from raptly.concurrent_api import ConcurrentAptlyApi
+from raptly.plan import Plan
+
+
+def test_concurrent_workflows(api, stub, deb_files):
+    repos = ['a4pizza/base', 'a4pizza/extra', 'a4pizza/toppings']
+    package_files = deb_files('margherita_1.0.0_all', 'fiorentina_0.9.7_all')
+
+    with ConcurrentAptlyApi(api, max_concurrency=3) as concurrent_api:
+        for result in [concurrent_api.submit(api.create, repo) for repo in repos]:
+            result.get()
+        for result in [concurrent_api.deploy(repo, package_files, '', repo.replace('/', '_')) for repo in repos]:
+            result.get()
+        tests = [concurrent_api.test(public_repo_name=repo, package_query='margherita', release_id='TKT-1',
+                                     dry_run=False) for repo in repos]
+        for result in tests:
+            union, new_packages, snapshot = result.get()
+            assert len(new_packages) == 1
+
+        assert concurrent_api.get_published_repos().get() == repos
+        for repo in repos:
+            testing = concurrent_api.find_publication('testing', repo).get()
+            assert testing['Sources'][0]['Name'].startswith('%s.test.TKT-1.' % repo.replace('/', '_'))
+
+
+def test_concurrency_bounded(api):
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+
+    def operation():
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+
+    with ConcurrentAptlyApi(api, max_concurrency=2) as concurrent_api:
+        results = [concurrent_api.submit(operation) for i in range(6)]
+        for result in results:
+            result.get()
+    assert most_running[0] == 2
+
+
+def test_operations_run_their_plans_one_step_at_a_time(stub, deb_files, monkeypatch):
+    api = stub_api(stub, workers=4)
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all'), '', api.local_user)
+    plan_workers = []
+    run = Plan.run
+    monkeypatch.setattr(Plan, 'run', lambda self, max_workers: plan_workers.append(max_workers) or
+                        run(self, max_workers))
+
+    with ConcurrentAptlyApi(api, max_concurrency=2) as concurrent_api:
+        concurrent_api.test('a4pizza/base', 'margherita', 'TKT-1', dry_run=True).get()
+    assert plan_workers == [1]
+
+
+def test_errors_propagated(api):
+    with ConcurrentAptlyApi(api) as concurrent_api:
+        result = concurrent_api.stage('a4pizza/missing', 'testing', 'staging', 'TKT-1')
+        with pytest.raises(RaptlyError):
+            result.get()
+        # The pool carries on after a failed operation
+        assert concurrent_api.get_published_repos().get() == []
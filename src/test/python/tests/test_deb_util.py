@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from conftest import build_deb
+from raptly.deb_util import inspect_directory, package_identity, parse_control, read_control, read_control_from, \
+    ref_identity
+
+
+def test_read_control(tmpdir):
+    deb = build_deb(str(tmpdir.join('margherita.deb')), 'margherita', '1:1.0.0-2', 'amd64')
+    control = read_control(deb)
+    assert control['Package'] == 'margherita'
+    assert control['Description'] == 'margherita\nmore about margherita'
+    assert package_identity(deb) == 'Pamd64 margherita 1:1.0.0-2'
+
+
+def test_not_a_deb(deb_files):
+    with pytest.raises(ValueError):
+        package_identity(deb_files('margherita_1.0.0_all')[0])
+    with pytest.raises(IOError):
+        package_identity('non-existent.deb')
+
+
+def test_parse_control():
+    assert parse_control('Package: pesto\nDepends: basil, garlic\n') == {'Package': 'pesto', 'Depends': 'basil, garlic'}
+
+
+def test_ref_identity():
+    assert ref_identity('Pall margherita 1.0.0 9ed826d62d1e3010') == 'Pall margherita 1.0.0'
+
+
+class CountingFile:
+    """File wrapper counting the bytes read"""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+
+@pytest.mark.parametrize('compression', ['gz', 'xz', ''])
+def test_control_compression(tmpdir, compression):
+    deb = build_deb(str(tmpdir.join('pesto.deb')), 'pesto', '2.1.0', 'all', control_compression=compression)
+    assert package_identity(deb) == 'Pall pesto 2.1.0'
+
+
+def test_reads_only_start_of_package(tmpdir):
+    payload = os.urandom(1024 * 1024)
+    deb = build_deb(str(tmpdir.join('calzone.deb')), 'calzone', '3.0.0', 'amd64', payload=payload)
+    with open(deb, 'rb') as f:
+        counting_file = CountingFile(f)
+        assert read_control_from(counting_file)['Package'] == 'calzone'
+    assert counting_file.bytes_read < 8 * 1024
+
+
+def test_inspect_directory(tmpdir, deb_files):
+    for name in ('margherita', 'pesto', 'calzone'):
+        build_deb(str(tmpdir.join('%s.deb' % name)), name, '1.0.0', 'all')
+    deb_files('broken_1.0.0_all')
+
+    results = inspect_directory(str(tmpdir))
+    assert [os.path.basename(result['file']) for result in results] == \
+        ['broken_1.0.0_all.deb', 'calzone.deb', 'margherita.deb', 'pesto.deb']
+    assert results[0]['error'] is not None
+    assert [result['info']['Identity'] for result in results[1:]] == \
+        ['Pall calzone 1.0.0', 'Pall margherita 1.0.0', 'Pall pesto 1.0.0']
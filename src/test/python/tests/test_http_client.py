@@ -0,0 +1,232 @@
+import gzip
+import io
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from raptly.http_client import DeadlineExceeded, HttpClient, endpoint_name, percentile
+from raptly.plan import Plan, READ
+
+PACKAGES = ['Pall margherita 1.0.%s 9ed826d62d1e3010' % i for i in range(1000)]
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = '{"Version": "1.2.0"}'
+        encoding = None
+        if self.path.endswith('/slow'):
+            time.sleep(0.5)
+        if self.path.endswith('/slow-packages'):
+            # Send the listing a little at a time, taking a second in all
+            body = json.dumps(PACKAGES)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            for i in range(10):
+                self.wfile.write(body[i * len(body) / 10:(i + 1) * len(body) / 10])
+                self.wfile.flush()
+                time.sleep(0.1)
+            return
+        if self.path.endswith('/packages'):
+            body = json.dumps(PACKAGES)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                compressed = io.BytesIO()
+                with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+                    gzip_file.write(body)
+                body = compressed.getvalue()
+                encoding = 'gzip'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ScriptedAdapter(BaseAdapter):
+    """Transport adapter answering each request with the next (delay, status) of a script, then 200s."""
+
+    def __init__(self, script=()):
+        BaseAdapter.__init__(self)
+        self.script = list(script)
+        self.lock = threading.Lock()
+        self.sent = []
+        self.responses = []
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        with self.lock:
+            self.sent.append(request.method)
+            delay, status = self.script.pop(0) if self.script else (0, 200)
+        time.sleep(delay)
+        response = requests.Response()
+        response.status_code = status
+        response.raw = io.BytesIO('{}')
+        response.url = request.url
+        response.request = request
+        with self.lock:
+            self.responses.append(response)
+        return response
+
+    def close(self):
+        pass
+
+
+def scripted_client(adapter, **kwargs):
+    session = requests.Session()
+    session.mount('http://scripted', adapter)
+    return HttpClient(session=session, base_url='http://scripted/api', backoff=0.01, **kwargs)
+
+
+@pytest.fixture
+def server_url():
+    server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%s/api' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_reused(server_url):
+    client = HttpClient()
+    for i in range(5):
+        assert client.get('%s/version' % server_url).json()['Version'] == '1.2.0'
+    client.close()
+
+    stats = client.connection_stats()
+    assert stats == {'requests': 5, 'opened': 1, 'reused': 4}
+
+
+def test_no_keep_alive(server_url):
+    client = HttpClient(keep_alive=False)
+    for i in range(3):
+        client.get('%s/version' % server_url)
+    client.close()
+
+    assert client.connection_stats()['opened'] == 3
+
+
+def test_endpoint_name():
+    base_url = 'http://localhost:9876/api'
+    assert endpoint_name(base_url, 'GET', base_url + '/snapshots/a4pizza_base.1506701691/packages?q=pesto') == \
+        'GET /snapshots/*/packages'
+    assert endpoint_name(base_url, 'PUT', base_url + '/publish//a4pizza_base/testing') == 'PUT /publish/*/*'
+    assert endpoint_name(base_url, 'GET', base_url + '/version') == 'GET /version'
+
+
+def test_compressed_transfer_stats(server_url):
+    client = HttpClient(base_url=server_url)
+    assert client.get('%s/snapshots/a4pizza_base.1506701691/packages' % server_url).json() == PACKAGES
+
+    r = client.get('%s/repos/a4pizza_base/packages' % server_url, stream=True)
+    assert json.loads(''.join(client.iter_content(r, 1024))) == PACKAGES
+
+    stats = client.transfer_stats()
+    for endpoint in ('GET /snapshots/*/packages', 'GET /repos/*/packages'):
+        assert stats[endpoint]['responses'] == 1
+        assert stats[endpoint]['decoded'] == len(json.dumps(PACKAGES))
+        assert stats[endpoint]['received'] < stats[endpoint]['decoded'] / 10
+
+
+def test_deadline_names_step(server_url):
+    client = HttpClient(deadline=0.2)
+    with pytest.raises(DeadlineExceeded) as e:
+        client.get('%s/slow' % server_url)
+    assert 'GET %s/slow' % server_url in e.value.value
+
+    # No budget left, so fail before sending anything
+    with pytest.raises(DeadlineExceeded):
+        client.get('%s/version' % server_url)
+    assert client.connection_stats()['requests'] == 2
+
+
+def test_deadline_names_workflow_step(server_url):
+    client = HttpClient(deadline=0.2)
+    plan = Plan('show a4pizza/base')
+    plan.add('packages', READ, 'Get the packages', lambda results: client.get('%s/slow' % server_url))
+    with pytest.raises(DeadlineExceeded) as e:
+        plan.run()
+    assert 'show a4pizza/base: packages (GET %s/slow)' % server_url in e.value.value
+
+
+def test_deadline_bounds_streamed_read(server_url):
+    client = HttpClient(deadline=0.3)
+    r = client.get('%s/repos/a4pizza_base/slow-packages' % server_url, stream=True)
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        ''.join(client.iter_content(r, 1024))
+    assert time.time() - start < 0.6
+
+
+def test_timeout_limited_by_deadline():
+    assert HttpClient(connect_timeout=5, read_timeout=None).timeout('GET /version') == (5, None)
+    connect, read = HttpClient(connect_timeout=5, read_timeout=60, deadline=30).timeout('GET /version')
+    assert connect == 5
+    assert 29 < read <= 30
+
+
+def test_get_retried():
+    adapter = ScriptedAdapter([(0, 503), (0, 502)])
+    client = scripted_client(adapter)
+    assert client.get('http://scripted/api/publish').status_code == 200
+    assert client.latency_stats()['GET /publish']['retries'] == 2
+
+    # Gives up after the configured number of retries, returning the last response
+    adapter.script = [(0, 503)] * 3
+    assert scripted_client(adapter, retries=2).get('http://scripted/api/publish').status_code == 503
+
+
+def test_retried_stream_closed():
+    adapter = ScriptedAdapter([(0, 503), (0, 502)])
+    r = scripted_client(adapter).get('http://scripted/api/repos/a4pizza_base/packages', stream=True)
+    assert r.status_code == 200
+    # Only the response returned still holds its connection
+    assert [response.raw.closed for response in adapter.responses] == [True, True, False]
+
+
+def test_mutations_not_retried():
+    adapter = ScriptedAdapter([(0, 503)] * 3)
+    client = scripted_client(adapter)
+    for method in ('POST', 'PUT', 'DELETE'):
+        assert client.request(method, 'http://scripted/api/publish/x/testing').status_code == 503
+    assert adapter.sent == ['POST', 'PUT', 'DELETE']
+
+
+def test_hedged_reads_cut_tail_latency():
+    # After some typical reads, one in ten stalls
+    script = [(0.01, 200)] * 20 + [(0.3 if i % 10 == 5 else 0.01, 200) for i in range(100)]
+
+    def latency(**kwargs):
+        client = scripted_client(ScriptedAdapter(script), **kwargs)
+        for i in range(60):
+            client.get('http://scripted/api/snapshots')
+        # Let the requests that lost finish
+        time.sleep(0.5)
+        return client.latency_stats()['GET /snapshots']
+
+    unhedged = latency()
+    hedged = latency(hedge_percentile=80)
+    assert unhedged['p99'] >= 0.3
+    assert hedged['hedged'] >= 4
+    assert hedged['p99'] < 0.15
+    # The response of every request that lost is closed and counted
+    assert hedged['discarded'] == hedged['hedged']
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile(range(1, 101), 50) == 50
+    assert percentile(range(1, 101), 99) == 99
@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+from raptly.json_stream import iter_json_array
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_decode_in_chunks():
+    packages = ['Pall caper 4.25.%s 9ed826d62d1e3010' % i for i in range(50)]
+    text = json.dumps(packages, indent=1)
+    for size in (1, 7, 64, len(text)):
+        assert list(iter_json_array(chunked(text, size))) == packages
+
+
+def test_decode_mixed_values():
+    values = [1, 23456, -7.5, 'x', {'Name': 'snap'}, [1, [2]], None, True]
+    assert list(iter_json_array(chunked(json.dumps(values), 3))) == values
+
+
+def test_empty_array():
+    assert list(iter_json_array([' [ ', ' ]'])) == []
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"error": "not found"}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['["Pall caper 4.25.3 9ed826d62d1e3010", ']))
@@ -0,0 +1,41 @@
+import cgi
+import io
+
+import pytest
+
+from raptly.multipart import MultipartFileEncoder
+
+
+def test_encoder_streams_files(deb_files):
+    paths = deb_files('margherita_1.0.0_amd64', 'pesto_2.1.0_all')
+    body = MultipartFileEncoder(paths)
+
+    chunks = []
+    while True:
+        chunk = body.read(7)
+        if not chunk:
+            break
+        assert len(chunk) <= 7
+        chunks.append(chunk)
+        # At most the file being sent is open
+        assert body.current is None or body.current.name in paths
+    content = ''.join(chunks)
+    assert len(content) == len(body)
+    assert body.current is None
+
+    environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': body.content_type, 'CONTENT_LENGTH': str(len(content))}
+    form = cgi.FieldStorage(fp=io.BytesIO(content), environ=environ)
+    assert [(field.filename, field.value) for field in form.list] == [
+        ('margherita_1.0.0_amd64.deb', 'contents of margherita_1.0.0_amd64'),
+        ('pesto_2.1.0_all.deb', 'contents of pesto_2.1.0_all')]
+
+
+def test_encoder_missing_file():
+    with pytest.raises(IOError):
+        MultipartFileEncoder(['non-existent.deb'])
+
+
+def test_upload(api, stub, deb_files):
+    paths = api.upload(deb_files('margherita_1.0.0_amd64', 'pesto_2.1.0_all'), 'alice')
+    assert paths == ['alice/margherita_1.0.0_amd64.deb', 'alice/pesto_2.1.0_all.deb']
+    assert stub.uploads['alice']['pesto_2.1.0_all.deb'] == 'contents of pesto_2.1.0_all'
@@ -0,0 +1,47 @@
+import threading
+import time
+
+import pytest
+
+from raptly.parallel import map_ordered
+
+
+def test_results_in_order():
+    def slow_square(x):
+        time.sleep(0.01 * (5 - x))
+        return x * x
+
+    assert map_ordered(slow_square, range(5), max_workers=3) == [0, 1, 4, 9, 16]
+
+
+def test_bounded_concurrency():
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def track(x):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return x
+
+    assert map_ordered(track, range(20), max_workers=4) == range(20)
+    assert peak[0] <= 4
+
+
+def test_first_error_cancels_remaining():
+    started = []
+
+    def fail_on_first(x):
+        started.append(x)
+        if x == 0:
+            raise ValueError('source %s failed' % x)
+        time.sleep(0.01)
+        return x
+
+    with pytest.raises(ValueError):
+        map_ordered(fail_on_first, range(50), max_workers=2)
+    assert len(started) < 50
@@ -1,4 +1,8 @@
-from raptly.pkg_util import prune
+import time
+
+import pytest
+
+from raptly.pkg_util import prune, packages_not_in
 
 
 def test_prune():
@@ -22,3 +26,25 @@ def test_prune():
     assert len(pruned) == 2
     assert latest_caper_version in pruned
     assert latest_pesto_version in pruned
+
+
+def test_prune_generator():
+    packages = ['Pamd64 pesto 1.2.0 76a826d62d1e9010',
+                'Pall caper 4.26.4 2c3826d62d1e9010',
+                'Pamd64 pesto 1 76a826d62d1e9010',
+                'Pall caper 4.26.4-gamma 176826d62d1e9010']
+
+    assert prune(pkg for pkg in packages) == ['Pall caper 4.26.4-gamma 176826d62d1e9010',
+                                              'Pamd64 pesto 1.2.0 76a826d62d1e9010']
+
+
+@pytest.mark.parametrize('num_stable', [1000, 10000, 100000])
+def test_packages_not_in(num_stable):
+    stable = ['Pall topping%s 1.0.0 %016x' % (i, i) for i in range(num_stable)]
+    new = ['Pall topping%s 1.1.0 %016x' % (i, i) for i in range(10)]
+    unstable = new[:5] + stable + new[5:]
+
+    start = time.time()
+    assert packages_not_in(unstable, stable) == new
+    # Linear - a list membership test would take minutes at 100k
+    assert time.time() - start < 1
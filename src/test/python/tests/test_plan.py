@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+from raptly.plan import Plan, READ, WRITE, LOCAL
+
+
+def sleeper(seconds, result=None):
+    def step(results):
+        time.sleep(seconds)
+        return result
+    return step
+
+
+def test_independent_steps_run_concurrently():
+    plan = Plan('fetch and combine')
+    plan.add('stable', READ, 'Get stable', sleeper(0.1, ['a']))
+    plan.add('unstable', READ, 'Get unstable', sleeper(0.1, ['b']))
+    plan.add('union', LOCAL, 'Combine', lambda results: results['stable'] + results['unstable'],
+             requires=['stable', 'unstable'])
+
+    start = time.time()
+    assert plan.run(max_workers=4)['union'] == ['a', 'b']
+    assert time.time() - start < 0.19
+    assert sorted(plan.timings()) == ['stable', 'union', 'unstable']
+
+
+def test_steps_wait_for_required_steps():
+    finished = []
+    lock = threading.Lock()
+
+    def record(name):
+        def step(results):
+            time.sleep(0.01)
+            with lock:
+                finished.append(name)
+        return step
+
+    plan = Plan('chain')
+    plan.add('snapshot', WRITE, 'Snapshot', record('snapshot'))
+    plan.add('publish', WRITE, 'Publish', record('publish'), requires=['snapshot'])
+    plan.add('other', READ, 'Unrelated', record('other'))
+    plan.run(max_workers=4)
+    assert finished.index('snapshot') < finished.index('publish')
+
+
+def test_first_error_stops_later_steps():
+    plan = Plan('failing')
+    plan.add('read', READ, 'Fails', lambda results: 1 / 0)
+    plan.add('write', WRITE, 'Never runs', lambda results: pytest.fail('ran after failure'), requires=['read'])
+    with pytest.raises(ZeroDivisionError):
+        plan.run(max_workers=4)
+    assert plan.timings().keys() == ['read']
+
+
+def test_steps_must_be_added_after_required_steps():
+    plan = Plan('invalid')
+    plan.add('a', READ, 'A', sleeper(0))
+    with pytest.raises(ValueError):
+        plan.add('b', READ, 'B', sleeper(0), requires=['c'])
+    with pytest.raises(ValueError):
+        plan.add('a', READ, 'A again', sleeper(0))
+
+
+def test_critical_path_and_format():
+    plan = Plan('test a4pizza/base TKT-1')
+    plan.add('stable', READ, 'Get stable', sleeper(0))
+    plan.add('unstable', READ, 'Find unstable', sleeper(0))
+    plan.add('matching', READ, 'Query unstable', sleeper(0), requires=['unstable'])
+    plan.add('union', LOCAL, 'Combine', sleeper(0), requires=['stable', 'matching'])
+    plan.add('publish', WRITE, 'Publish', sleeper(0), requires=['union'])
+
+    # Before running, the chain with most API calls
+    assert plan.critical_path() == ['unstable', 'matching', 'union', 'publish']
+    text = plan.format()
+    assert text.splitlines()[0] == 'Plan: test a4pizza/base TKT-1'
+    assert 'union     local  Combine (after stable, matching)' in text
+    assert text.splitlines()[-1] == 'Critical path: unstable -> matching -> union -> publish'
@@ -0,0 +1,61 @@
+import io
+import json
+
+from raptly import telemetry
+from raptly.telemetry import UploadProgress, UploadStats
+
+
+class FakeTerminal(io.BytesIO):
+    def isatty(self):
+        return True
+
+
+def test_upload_stats():
+    stats = UploadStats()
+    stats.add_upload(['margherita.deb'], 2 * 1024 * 1024, 0.5)
+    stats.add_upload(['pesto.deb'], 1024 * 1024, 1.0)
+    with stats.phase('import'):
+        pass
+
+    summary = json.loads(stats.format('json'))
+    assert summary['files'] == 2
+    assert summary['bytes'] == 3 * 1024 * 1024
+    assert [upload['mb_per_second'] for upload in summary['uploads']] == [4.0, 1.0]
+    assert 'import' in summary['phases']
+    assert 'Uploaded margherita.deb: 2097152 bytes in 0.500s (4.0 MB/s)' in stats.format()
+
+
+def test_progress_only_on_terminal():
+    terminal = FakeTerminal()
+    progress = UploadProgress(2048, 2, stream=terminal)
+    progress.update(1024)
+    progress.file_done()
+    progress.finish()
+    assert '1/2 files' in terminal.getvalue()
+    assert terminal.getvalue().endswith('\n')
+
+    log = io.BytesIO()
+    progress = UploadProgress(2048, 2, stream=log)
+    progress.update(2048)
+    progress.finish()
+    assert log.getvalue() == ''
+
+
+def test_progress_without_rate(monkeypatch):
+    terminal = FakeTerminal()
+    progress = UploadProgress(2048, 2, stream=terminal)
+    # No time has passed since the start, so no rate can be computed yet
+    monkeypatch.setattr(telemetry.time, 'time', lambda: progress.start)
+    progress.file_done()
+    assert 'None' not in terminal.getvalue()
+    assert '- MB/s' in terminal.getvalue()
+
+
+def test_deploy_records_phases(api, deb_files):
+    api.create('a4pizza/base')
+    api.deploy('a4pizza/base', deb_files('margherita_1.0.0_all', 'pesto_2.1.0_all'), '', api.local_user)
+
+    summary = api.upload_stats.summary()
+    assert summary['files'] == 2
+    assert summary['bytes'] > len('contents of margherita_1.0.0_all')
+    assert sorted(summary['phases']) == ['import', 'publish', 'upload']